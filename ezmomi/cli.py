@@ -1,38 +1,104 @@
 """Command line definitions for ezmomi"""
+from __future__ import print_function
+import atexit
+import sys
+
+from . import complete
 from .params import arg_setup
 from .ezmomi import EZMomi
+from .exceptions import EZMomiError
+from .shell import Shell
 
 
 def cli():
     args = arg_setup()
 
+    try:
+        failures = run(args)
+    except EZMomiError as e:
+        print("Error: %s" % e)
+        sys.exit(1)
+    if failures:
+        sys.exit(1)
+
+
+def run(args):
+    if args.mode == 'completion':
+        if args.refresh:
+            complete.refresh(args.server)
+        else:
+            print(complete.BASH_SCRIPT, end='')
+        return
+
     # initialize ezmomi instance
     ez = EZMomi(**vars(args))
+    # clean up on exit
+    atexit.register(ez.close)
+    if ez.debug:
+        atexit.register(ez.print_debug, "Retry stats", ez.retrier.stats)
+
+    if args.mode == 'shell':
+        Shell(ez, dispatch).cmdloop()
+    else:
+        return dispatch(ez, vars(args))
 
-    kwargs = vars(args)
 
+def dispatch(ez, kwargs):
+    """
+    Run the command in kwargs['mode'].  Returns what it returns: commands
+    acting on many objects return their failures, already reported.
+    """
     # choose your adventure
     if kwargs['mode'] == 'list':
-        ez.list_objects()
+        return ez.list_objects()
     elif kwargs['mode'] == 'clone':
-        ez.clone()
+        return ez.clone()
+    elif kwargs['mode'] == 'plan':
+        return ez.plan()
+    elif kwargs['mode'] == 'apply':
+        return ez.apply()
     elif kwargs['mode'] == 'destroy':
-        ez.destroy()
+        return ez.destroy()
+    elif kwargs['mode'] == 'reconfigure':
+        return ez.reconfigure()
+    elif kwargs['mode'] == 'rolling':
+        return ez.rolling()
     elif kwargs['mode'] == 'listSnapshots':
-        ez.listSnapshots()
+        return ez.listSnapshots()
     elif kwargs['mode'] == 'createSnapshot':
-        ez.createSnapshot()
+        return ez.createSnapshot()
     elif kwargs['mode'] == 'removeSnapshot':
-        ez.removeSnapshot()
+        return ez.removeSnapshot()
     elif kwargs['mode'] == 'revertSnapshot':
-        ez.revertSnapshot()
+        return ez.revertSnapshot()
     elif kwargs['mode'] == 'status':
-        ez.status()
+        return ez.status()
     elif kwargs['mode'] == 'shutdown':
-        ez.shutdown()
+        return ez.shutdown()
     elif kwargs['mode'] == 'powerOff':
-        ez.powerOff()
+        return ez.powerOff()
     elif kwargs['mode'] == 'powerOn':
-        ez.powerOn()
+        return ez.powerOn()
     elif kwargs['mode'] == 'syncTimeWithHost':
-        ez.syncTimeWithHost()
+        return ez.syncTimeWithHost()
+    elif kwargs['mode'] == 'watch':
+        return ez.watch()
+    elif kwargs['mode'] == 'exporter':
+        return ez.exporter()
+    elif kwargs['mode'] == 'perf':
+        return ez.perf()
+    elif kwargs['mode'] == 'stats':
+        return ez.stats()
+    elif kwargs['mode'] == 'guestexec':
+        return ez.guestexec()
+    elif kwargs['mode'] == 'upload':
+        return ez.upload()
+    elif kwargs['mode'] == 'download':
+        return ez.download()
+    elif kwargs['mode'] == 'deploy-ova':
+        return ez.deploy_ova()
+    elif kwargs['mode'] == 'inventory':
+        if kwargs['inventory_mode'] == 'dump':
+            return ez.inventory_dump()
+        elif kwargs['inventory_mode'] == 'query':
+            return ez.inventory_query()
@@ -0,0 +1,240 @@
+"""
+Shell tab completion for ezmomi.  Object names are served from a local
+cache per server and type, refreshed in the background, so completing
+never waits for vCenter.  Enable it in bash with:
+
+    eval "$(ezmomi completion)"
+"""
+from __future__ import print_function
+import argparse
+import bisect
+import os
+import re
+import shlex
+import subprocess
+import sys
+import time
+
+import yaml
+
+from .params import build_parser
+
+# options completed with names of these managed object types
+COMPLETIONS = {
+    '--name': 'VirtualMachine',
+    '--vm': 'VirtualMachine',
+    '--template': 'VirtualMachine',
+    '--host': 'HostSystem',
+    '--datastore': 'Datastore',
+    '--cluster': 'ClusterComputeResource',
+    '--resource-pool': 'ResourcePool',
+    '--network': 'Network',
+}
+
+# commands whose --name is a snapshot or a new VM, not an existing VM
+SNAPSHOT_COMMANDS = ('createSnapshot', 'removeSnapshot', 'revertSnapshot')
+NEW_NAME_COMMANDS = SNAPSHOT_COMMANDS + ('deploy-ova',)
+
+# seconds before cached names are refreshed, unless completion_refresh
+# is set in config.yml
+REFRESH_SECONDS = 300
+
+BASH_SCRIPT = """_ezmomi() {
+    local IFS=$'\\n'
+    COMPREPLY=( $(EZMOMI_COMPLETE=1 COMP_LINE="$COMP_LINE" \\
+                  COMP_POINT="$COMP_POINT" "$1" 2>/dev/null) )
+}
+complete -o default -F _ezmomi ezmomi
+"""
+
+
+def object_type(command, option):
+    """Type name of the objects option of command takes, or None"""
+    if option == '--name' and command in NEW_NAME_COMMANDS:
+        return None
+    return COMPLETIONS.get(option)
+
+
+def cache_dir(server):
+    return os.path.join(os.path.expanduser("~"), ".cache", "ezmomi",
+                        "names", server)
+
+
+def read_config():
+    """config.yml as read by ezmomi, {} if there is none"""
+    path = os.environ.get('EZMOMI_CONFIG') or \
+        "%s/.config/ezmomi/config.yml" % os.path.expanduser("~")
+    try:
+        with open(path) as f:
+            return yaml.safe_load(f) or {}
+    except (IOError, yaml.YAMLError):
+        return {}
+
+
+class NameCache(object):
+    """
+    Sorted object names of one type, kept in a file per server and type
+    and looked up by prefix with a binary search.
+    """
+
+    def __init__(self, server, vimtype):
+        self.path = os.path.join(cache_dir(server), vimtype)
+        self._names = None
+
+    def age(self):
+        """Seconds since the cache was written, None if never"""
+        try:
+            return time.time() - os.path.getmtime(self.path)
+        except OSError:
+            return None
+
+    def names(self):
+        if self._names is None:
+            try:
+                with open(self.path) as f:
+                    self._names = f.read().splitlines()
+            except IOError:
+                self._names = []
+        return self._names
+
+    def starting_with(self, prefix):
+        names = self.names()
+        start = bisect.bisect_left(names, prefix)
+        end = start
+        while end < len(names) and names[end].startswith(prefix):
+            end += 1
+        return names[start:end]
+
+    def write(self, names):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # replace the file at once, completions may be reading it
+        temporary = "%s.%s" % (self.path, os.getpid())
+        with open(temporary, 'w') as f:
+            f.write("\n".join(sorted(names)))
+        os.rename(temporary, self.path)
+        self._names = sorted(names)
+
+
+def refresh(server=None):
+    """Fetch every completed type's names from vSphere into the caches"""
+    from pyVmomi import vim
+    from .ezmomi import EZMomi
+
+    kwargs = {'server': server} if server else {}
+    with EZMomi(connect=False, **kwargs) as ez:
+        for vimtype in sorted(set(COMPLETIONS.values())):
+            NameCache(ez.config['server'], vimtype).write(
+                ez.name_index(getattr(vim, vimtype)))
+
+
+def refresh_in_background(server):
+    """
+    Start a refresh of server's caches in a detached process, unless one
+    started in the last ten minutes is still running
+    """
+    lock = os.path.join(cache_dir(server), '.refreshing')
+    try:
+        if time.time() - os.path.getmtime(lock) < 600:
+            return
+        os.remove(lock)
+    except OSError:
+        pass
+    try:
+        if not os.path.isdir(cache_dir(server)):
+            os.makedirs(cache_dir(server))
+        os.close(os.open(lock, os.O_CREAT | os.O_EXCL))
+    except OSError:
+        return
+
+    with open(os.devnull, 'w') as devnull:
+        subprocess.Popen([sys.executable, '-m', 'ezmomi.complete', 'refresh',
+                          server, lock], stdin=devnull, stdout=devnull,
+                         stderr=devnull, close_fds=True,
+                         preexec_fn=getattr(os, 'setsid', None))
+
+
+def split(line):
+    """Words of a partial command line, the last one possibly empty"""
+    try:
+        words = shlex.split(line)
+    except ValueError:
+        # inside a quoted word
+        words = shlex.split(line + '"') if '"' in line else line.split()
+    if not line or line[-1].isspace():
+        words.append('')
+    return words
+
+
+def escape(word):
+    return re.sub(r'([^\w@%+=:,./-])', r'\\\1', word)
+
+
+def complete(line, config=None):
+    """Completions of the last word of line, an ezmomi command line"""
+    words = split(line)[1:]
+    current = words.pop()
+
+    # descend into subcommands
+    parser = build_parser()
+    command = None
+    for word in words:
+        subparsers = [action for action in parser._actions
+                      if isinstance(action, argparse._SubParsersAction)]
+        if subparsers and word in subparsers[0].choices:
+            parser = subparsers[0].choices[word]
+            command = command or word
+
+    if current.startswith('-'):
+        return sorted(option for option in parser._option_string_actions
+                      if option.startswith(current))
+    subparsers = [action for action in parser._actions
+                  if isinstance(action, argparse._SubParsersAction)]
+    if subparsers:
+        return sorted(name for name in subparsers[0].choices
+                      if name.startswith(current))
+
+    # complete the value of the last option given
+    options = [word for word in words if word.startswith('--')]
+    if not options:
+        return []
+    action = parser._option_string_actions.get(options[-1])
+    if action is not None and action.choices:
+        return sorted(choice for choice in action.choices
+                      if choice.startswith(current))
+    vimtype = object_type(command, options[-1])
+    if vimtype is None:
+        return []
+
+    config = read_config() if config is None else config
+    if '--server' in words[:-1]:
+        server = words[words.index('--server') + 1]
+    else:
+        server = config.get('server')
+    if not server:
+        return []
+
+    cache = NameCache(server, vimtype)
+    age = cache.age()
+    if age is None or age > config.get('completion_refresh',
+                                       REFRESH_SECONDS):
+        refresh_in_background(server)
+    return cache.starting_with(current)
+
+
+def main():
+    """Print completions for the shell, see BASH_SCRIPT"""
+    line = os.environ.get('COMP_LINE', '')
+    point = int(os.environ.get('COMP_POINT', len(line)))
+    for word in complete(line[:point]):
+        print(escape(word))
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['refresh']:
+        try:
+            refresh(sys.argv[2] if len(sys.argv) > 2 else None)
+        finally:
+            if len(sys.argv) > 3 and os.path.exists(sys.argv[3]):
+                os.remove(sys.argv[3])
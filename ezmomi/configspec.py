@@ -0,0 +1,106 @@
+"""Declarative VM configuration changes, see EZMomi.reconfigure_vms"""
+import six
+
+from pyVmomi import vim
+
+# ConfigSpec paths stored under another name in VirtualMachine.config
+PROPERTY_PATHS = {
+    'numCPUs': 'config.hardware.numCPU',
+    'numCoresPerSocket': 'config.hardware.numCoresPerSocket',
+    'memoryMB': 'config.hardware.memoryMB',
+}
+
+EXTRA_CONFIG = 'extraConfig.'
+
+
+def parse_changes(changes):
+    """
+    Normalize changes, a dict of ConfigSpec property paths to values, e.g.
+        {'cpuHotAddEnabled': True,
+         'tools.toolsUpgradePolicy': 'upgradeAtPowerCycle',
+         'extraConfig': {'disk.EnableUUID': 'TRUE'}}
+    Advanced settings may also be given as 'extraConfig.<key>'; their
+    values are strings.
+
+    Returns a flat dict of paths to values, raises ValueError if a path
+    or value isn't valid for a ConfigSpec.
+    """
+    parsed = dict()
+    for path, value in changes.items():
+        if path == EXTRA_CONFIG.rstrip('.'):
+            if not isinstance(value, dict):
+                raise ValueError("extraConfig must be a mapping of keys to "
+                                 "values")
+            for key, option in value.items():
+                parsed[EXTRA_CONFIG + key] = option_value(option)
+        elif path.startswith(EXTRA_CONFIG):
+            parsed[path] = option_value(value)
+        else:
+            parsed[path] = value
+
+    # let pyVmomi check every path and type up front
+    build_spec(parsed)
+    return parsed
+
+
+def option_value(value):
+    if isinstance(value, bool):
+        # the spelling used in .vmx files
+        return 'TRUE' if value else 'FALSE'
+    return six.text_type(value)
+
+
+def property_paths(changes):
+    """VirtualMachine property paths holding the current values"""
+    paths = set()
+    for path in changes:
+        if path.startswith(EXTRA_CONFIG):
+            paths.add('config.extraConfig')
+        else:
+            paths.add(PROPERTY_PATHS.get(path, 'config.' + path))
+    return sorted(paths)
+
+
+def diff(changes, props):
+    """
+    Changes (as returned by parse_changes) that differ from a VM's
+    current properties, as {path: (current value, new value)}
+    """
+    extra_config = dict((option.key, option.value) for option in
+                        props.get('config.extraConfig') or [])
+
+    differences = dict()
+    for path, value in changes.items():
+        if path.startswith(EXTRA_CONFIG):
+            current = extra_config.get(path[len(EXTRA_CONFIG):])
+            if current is not None:
+                current = six.text_type(current)
+        else:
+            current = props.get(PROPERTY_PATHS.get(path, 'config.' + path))
+        if current != value:
+            differences[path] = (current, value)
+    return differences
+
+
+def build_spec(changes):
+    """ConfigSpec applying changes, a dict of paths to values"""
+    spec = vim.vm.ConfigSpec()
+    for path, value in sorted(changes.items()):
+        if path.startswith(EXTRA_CONFIG):
+            spec.extraConfig.append(vim.option.OptionValue(
+                key=path[len(EXTRA_CONFIG):], value=value))
+            continue
+
+        obj = spec
+        names = path.split('.')
+        try:
+            for name in names[:-1]:
+                if getattr(obj, name) is None:
+                    setattr(obj, name, obj._GetPropertyInfo(name).type())
+                obj = getattr(obj, name)
+            setattr(obj, names[-1], value)
+        except AttributeError:
+            raise ValueError("%s is not a ConfigSpec property" % path)
+        except TypeError as e:
+            raise ValueError("Invalid value for %s: %s" % (path, e))
+    return spec
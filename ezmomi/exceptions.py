@@ -0,0 +1,48 @@
+"""Exceptions raised by EZMomi instead of exiting, see cli.cli"""
+
+
+class EZMomiError(Exception):
+    """Base class for every ezmomi error"""
+
+
+class ConfigError(EZMomiError):
+    """The configuration is missing, unreadable or incomplete"""
+
+
+class ConnectError(EZMomiError):
+    """Unable to connect to the vSphere server"""
+
+
+class NotFoundError(EZMomiError):
+    """A VM, host, folder, snapshot or type doesn't exist"""
+
+
+class InvalidArgumentError(EZMomiError):
+    """An argument isn't valid, e.g. an unknown property path"""
+
+
+class CloneSpecError(EZMomiError):
+    """A clone can't be built, e.g. its template or network doesn't exist"""
+
+
+class TaskError(EZMomiError):
+    """A vSphere task failed; the vmodl fault is kept as fault"""
+
+    def __init__(self, description, fault):
+        super(TaskError, self).__init__(
+            "%s failed: %s" % (description,
+                               getattr(fault, 'msg', None) or
+                               type(fault).__name__))
+        self.description = description
+        self.fault = fault
+
+
+class GuestNotReadyError(EZMomiError):
+    """Guests didn't become ready in time; their names are kept as vms"""
+
+    def __init__(self, vms, timeout_seconds):
+        super(GuestNotReadyError, self).__init__(
+            "%s not ready after %s seconds" % (", ".join(vms),
+                                               timeout_seconds))
+        self.vms = vms
+        self.timeout_seconds = timeout_seconds
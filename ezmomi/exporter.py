@@ -0,0 +1,165 @@
+"""Prometheus metrics kept current from a PropertyCollector update stream"""
+import threading
+import time
+from six.moves import BaseHTTPServer
+
+# properties watched per type, see EZMomi.exporter
+WATCH_PROPERTIES = {
+    'VirtualMachine': ['name', 'runtime.powerState', 'runtime.host',
+                       'datastore', 'snapshot'],
+    'HostSystem': ['name', 'parent'],
+    'ClusterComputeResource': ['name'],
+    'Datastore': ['name', 'summary.freeSpace', 'summary.capacity'],
+}
+
+
+def moid(obj):
+    return obj._moId if obj is not None else None
+
+
+def count_snapshots(snapshot_trees):
+    return sum(1 + count_snapshots(tree.childSnapshotList)
+               for tree in snapshot_trees or [])
+
+
+def escape(value):
+    return (str(value if value is not None else '')
+            .replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+
+
+class InventoryMetrics(object):
+    """
+    In-memory inventory fed with watch events (see EZMomi.watch_updates).
+    Scrapes render from this state, never from vCenter; the rendered text
+    is cached until the next change.
+    """
+
+    def __init__(self, stats=None):
+        self.lock = threading.Lock()
+        self.objects = dict()
+        self.last_update = 0
+        # live counters, e.g. Retrier.stats, rendered on every scrape
+        self.stats = stats or dict()
+        self._rendered = None
+
+    def apply(self, event):
+        """Apply a watch event to the inventory"""
+        with self.lock:
+            if event['event'] == 'leave':
+                self.objects.pop(event['moid'], None)
+            else:
+                obj = self.objects.setdefault(
+                    event['moid'], {'type': event['type']})
+                for path, value in event['changes'].items():
+                    if path == 'snapshot':
+                        obj[path] = count_snapshots(
+                            value.rootSnapshotList if value else [])
+                    elif path in ('runtime.host', 'parent'):
+                        obj[path] = moid(value)
+                    elif path == 'datastore':
+                        obj[path] = [moid(ds) for ds in value or []]
+                    else:
+                        obj[path] = value
+            self.last_update = time.time()
+            self._rendered = None
+
+    def render(self):
+        with self.lock:
+            if self._rendered is None:
+                self._rendered = self._render()
+            lines = []
+            for stat, value in sorted(self.stats.items()):
+                lines += ['# TYPE ezmomi_%s counter' % stat,
+                          'ezmomi_%s %d' % (stat, value)]
+            return self._rendered + ''.join(line + '\n' for line in lines)
+
+    def _render(self):
+        objects = self.objects
+
+        def name(moid, default=''):
+            return objects.get(moid, {}).get('name', default)
+
+        vms = dict()
+        datastore_vms = dict()
+        lines = []
+
+        lines += ['# HELP ezmomi_vm_snapshots Snapshots per virtual machine',
+                  '# TYPE ezmomi_vm_snapshots gauge']
+        for obj_moid, obj in sorted(objects.items()):
+            if obj['type'] != 'VirtualMachine':
+                continue
+
+            # standalone hosts' parents aren't watched, so have no cluster
+            host = objects.get(obj.get('runtime.host'), {})
+            key = (obj.get('runtime.powerState'), host.get('name', ''),
+                   name(host.get('parent')))
+            vms[key] = vms.get(key, 0) + 1
+
+            for ds in obj.get('datastore', []):
+                datastore_vms[ds] = datastore_vms.get(ds, 0) + 1
+
+            lines.append('ezmomi_vm_snapshots{vm="%s",moid="%s"} %d' % (
+                escape(obj.get('name')), obj_moid, obj.get('snapshot', 0)))
+
+        lines += ['# HELP ezmomi_vms Virtual machines by power state, host '
+                  'and cluster',
+                  '# TYPE ezmomi_vms gauge']
+        for (power_state, host, cluster), count in sorted(vms.items()):
+            lines.append(
+                'ezmomi_vms{power_state="%s",host="%s",cluster="%s"} %d' % (
+                    escape(power_state), escape(host), escape(cluster),
+                    count))
+
+        lines += ['# HELP ezmomi_datastore_vms Virtual machines per datastore',
+                  '# TYPE ezmomi_datastore_vms gauge']
+        for ds, count in sorted(datastore_vms.items()):
+            lines.append('ezmomi_datastore_vms{datastore="%s"} %d'
+                         % (escape(name(ds, ds)), count))
+
+        for metric, path, help in [
+                ('ezmomi_datastore_free_bytes', 'summary.freeSpace',
+                 'Datastore free space'),
+                ('ezmomi_datastore_capacity_bytes', 'summary.capacity',
+                 'Datastore capacity')]:
+            lines += ['# HELP %s %s' % (metric, help),
+                      '# TYPE %s gauge' % metric]
+            for obj_moid, obj in sorted(objects.items()):
+                if obj['type'] == 'Datastore' and obj.get(path) is not None:
+                    lines.append('%s{datastore="%s"} %d' % (
+                        metric, escape(obj.get('name')), obj[path]))
+
+        lines += ['# HELP ezmomi_inventory_last_update_timestamp_seconds '
+                  'Time of the last inventory change',
+                  '# TYPE ezmomi_inventory_last_update_timestamp_seconds '
+                  'gauge',
+                  'ezmomi_inventory_last_update_timestamp_seconds %f'
+                  % self.last_update]
+
+        return '\n'.join(lines) + '\n'
+
+
+def serve(metrics, address, port):
+    """Serve metrics.render() on /metrics from a background thread"""
+
+    class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer((address, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
@@ -1,25 +1,120 @@
 #!/usr/bin/env python
+from __future__ import print_function
 from pyVim.connect import SmartConnect, SmartConnectNoSSL, Disconnect
 from pyVmomi import vim, vmodl
-import atexit
+from pyVmomi.SoapAdapter import Serialize, Deserialize
+from pyVmomi.VmomiSupport import ManagedObject
 import os
 import sys
 import errno
+import fnmatch
+import getpass
 from pprint import pprint, pformat
 import time
 from netaddr import IPNetwork, IPAddress
 import yaml
 import ssl
 import requests
+import csv
+import datetime
+import json
+import six
+import socket
+import sqlite3
+import tarfile
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from six.moves import http_client, input, shlex_quote
+from six.moves.urllib.parse import quote
+
+from . import (configspec, exporter, inventory, ipam, journal, ovf,
+               replicas, transfer, waves)
+from .exceptions import (CloneSpecError, ConfigError, ConnectError,
+                         EZMomiError, GuestNotReadyError,
+                         InvalidArgumentError, NotFoundError, TaskError)
+from .retry import CONNECTION_ERRORS, Retrier
+from .scheduler import Job, TaskScheduler
+
+
+# optional clone settings, as defaulted by the clone command's options
+CLONE_DEFAULTS = {
+    'template_folder': '',
+    'host': '',
+    'disks': [],
+    'resource_pool': 'Resources',
+    'destination_folder': '',
+    'datastore': '',
+    'auto_ip': [],
+    'ips': [],
+}
+
+# settings the command line always supplies, for configs given as data
+CONFIG_DEFAULTS = {
+    'debug': False,
+    'no_ssl_verify': False,
+    'port': 443,
+}
+
+
+# task properties watched by run_tasks, for its state and the journal
+TASK_PROPERTIES = ['info.state', 'info.error', 'info.descriptionId',
+                   'info.entityName', 'info.queueTime', 'info.startTime',
+                   'info.completeTime']
 
 
 class EZMomi(object):
-    def __init__(self, **kwargs):
-        """load up our configs and connect to the vSphere server"""
-        self.config = self.get_configs(kwargs)
+    def __init__(self, config=None, connect=True, **kwargs):
+        """
+        load up our configs and connect to the vSphere server
+
+        config is the configuration as a dict, in place of config.yml;
+        kwargs override its settings.  Call close() when done, or, with
+        connect=False, use the instance as a context manager:
+
+            with EZMomi(config={'server': ..., 'username': ...,
+                                'password': ...}, connect=False) as ez:
+                ez.vm_status('web01')
+        """
+        self.config = self.get_configs(kwargs, config)
         self.debug = self.config['debug']
-        self.connect()
+        self.retrier = Retrier(self.login, debug=self.debug,
+                               **self.config.get('retry') or {})
+        self.si = None
+        self._views = OrderedDict()
+        self._views_lock = threading.Lock()
         self._column_spacing = 4
+        self._perf_counters = None
+        # name -> object indexes per type, see name_index
+        self.cache_names = False
+        self._names = dict()
+        # task journal, see journal_task
+        self._journal = None
+        self._placement_names = None
+        # addresses guests report, see used_addresses
+        self._used_addresses = None
+        # requests sessions for file transfers, see http_session
+        self._http = threading.local()
+        # template replicas, see find_replicas
+        self._replicas = None
+        self.scheduler = TaskScheduler(**self.config.get('scheduler') or {})
+        if connect and self.needs_connection():
+            self.connect()
+
+    def __enter__(self):
+        if self.si is None:
+            self.connect()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def needs_connection(self):
+        """Commands that work offline, e.g. on an inventory dump"""
+        mode = self.config.get('mode')
+        return not (mode == 'stats' or
+                    (mode == 'inventory' and
+                     self.config.get('inventory_mode') == 'query'))
 
     def print_debug(self, title, obj):
         try:
@@ -29,7 +124,37 @@ class EZMomi(object):
 
         print("DEBUG: %s\n%s" % (title, pformat(msg)))
 
-    def get_configs(self, kwargs):
+    def get_configs(self, kwargs, config=None):
+        if config is None:
+            config = self.read_config_file()
+        config = dict(CONFIG_DEFAULTS, **config)
+
+        # Check all required values were supplied either via command line
+        # or config. override defaults from config.yml with any supplied
+        # command line arguments
+        notset = list()
+        for key, value in kwargs.items():
+            if value is not None:
+                config[key] = value
+            elif (value is None) and (key not in config):
+                # compile list of parameters that were not set
+                notset.append(key)
+        if notset:
+            raise ConfigError("Required parameters not set: %s" % notset)
+
+        # Rename 'distributedvirtualportgroup' config while leaving it
+        # backwards-compatible
+        networks = config['networks'] = dict(config.get('networks') or {})
+        for network in networks:
+            networks[network] = dict(networks[network])
+            if 'distributedvirtualportgroup' in networks[network]:
+                networks[network]['dvportgroup'] = (
+                    networks[network]['distributedvirtualportgroup'])
+                del networks[network]['distributedvirtualportgroup']
+
+        return config
+
+    def read_config_file(self):
         default_cfg_dir = "%s/.config/ezmomi" % os.path.expanduser("~")
         default_config_file = "%s/config.yml" % default_cfg_dir
 
@@ -38,10 +163,10 @@ class EZMomi(object):
             if os.path.isfile(os.environ['EZMOMI_CONFIG']):
                 config_file = os.environ['EZMOMI_CONFIG']
             else:
-                print("%s does not exist.  Set the EZMOMI_CONFIG environment "
-                      "variable to your config file's path."
-                      % os.environ['EZMOMI_CONFIG'])
-                sys.exit(1)
+                raise ConfigError(
+                    "%s does not exist.  Set the EZMOMI_CONFIG environment "
+                    "variable to your config file's path."
+                    % os.environ['EZMOMI_CONFIG'])
 
         # or use the default config file path if it exists
         elif os.path.isfile(default_config_file):
@@ -60,118 +185,402 @@ class EZMomi(object):
             try:
                 copy(ezmomi_ex_config, default_cfg_dir)
             except:
-                print("Error copying example config file from %s to %s"
-                      % (ezmomi_ex_config, default_cfg_dir))
-                sys.exit(1)
-
-            print("Could not find a config.yml file, so I copied an example "
-                  "to your home directory at %s/config.yml.example.  Please "
-                  "rename this to config.yml and add your vSphere "
-                  "environment's settings." % default_cfg_dir)
-            sys.exit(0)
+                raise ConfigError("Error copying example config file from "
+                                  "%s to %s"
+                                  % (ezmomi_ex_config, default_cfg_dir))
+
+            raise ConfigError(
+                "Could not find a config.yml file, so I copied an example "
+                "to your home directory at %s/config.yml.example.  Please "
+                "rename this to config.yml and add your vSphere "
+                "environment's settings." % default_cfg_dir)
         try:
-            config = yaml.load(open(config_file))
+            return yaml.load(open(config_file))
         except IOError:
-            print("Unable to open config file. The default ezmomi config "
-                  "filepath is ~/.config/ezmomi/config.yml. You can also "
-                  "specify the config file path by setting the "
-                  "EZMOMI_CONFIG environment variable.")
-            sys.exit(1)
+            raise ConfigError(
+                "Unable to open config file. The default ezmomi config "
+                "filepath is ~/.config/ezmomi/config.yml. You can also "
+                "specify the config file path by setting the "
+                "EZMOMI_CONFIG environment variable.")
         except Exception as e:
-            print('Unable to read config file.  YAML syntax issue, perhaps?')
-            print(e)
-            sys.exit(1)
-
-        # Check all required values were supplied either via command line
-        # or config. override defaults from config.yml with any supplied
-        # command line arguments
-        notset = list()
-        for key, value in kwargs.items():
-            if value is not None:
-                config[key] = value
-            elif (value is None) and (key not in config):
-                # compile list of parameters that were not set
-                notset.append(key)
-        if notset:
-            print("Required parameters not set: %s\n" % notset)
-            sys.exit(1)
-
-        # Rename 'distributedvirtualportgroup' config while leaving it
-        # backwards-compatible
-        for network in config['networks']:
-            if 'distributedvirtualportgroup' in config['networks'][network]:
-                config['networks'][network]['dvportgroup'] = (
-                    config['networks'][network]['distributedvirtualportgroup'])
-                del config['networks'][network]['distributedvirtualportgroup']
-
-        return config
+            raise ConfigError("Unable to read config file.  YAML syntax "
+                              "issue, perhaps?\n%s" % e)
 
     def connect(self):
         """Connect to vCenter server"""
-        try:
-            context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
-            if self.config['no_ssl_verify']:
-                requests.packages.urllib3.disable_warnings()
-                context.verify_mode = ssl.CERT_NONE
-                self.si = SmartConnectNoSSL(
-                    host=self.config['server'],
-                    user=self.config['username'],
-                    pwd=self.config['password'],
-                    port=int(self.config['port']),
-                    certFile=None,
-                    keyFile=None,
-                )
-            else:
-                self.si = SmartConnect(
-                    host=self.config['server'],
-                    user=self.config['username'],
-                    pwd=self.config['password'],
-                    port=int(self.config['port']),
-                    sslContext=context,
-                    certFile=None,
-                    keyFile=None,
-                )
-        except Exception as e:
-            print('Unable to connect to vsphere server.')
-            print(e)
-            sys.exit(1)
+        attempt = 0
+        while True:
+            try:
+                self.si = self.smart_connect()
+                break
+            except CONNECTION_ERRORS as e:
+                # vCenter may be restarting, or the network flapping
+                attempt += 1
+                if attempt < self.retrier.max_attempts:
+                    delay = self.retrier.delay(attempt)
+                    if self.debug:
+                        self.print_debug("connect failed, retrying in "
+                                         "%.1fs" % delay, e)
+                    time.sleep(delay)
+                    self.retrier.stats['retries_total'] += 1
+                    continue
+                raise ConnectError('Unable to connect to vsphere server.\n%s'
+                                   % e)
+            except Exception as e:
+                raise ConnectError('Unable to connect to vsphere server.\n%s'
+                                   % e)
+
+        # retry transient failures of every call made in this session
+        self.retrier.install(self.si._stub)
 
-        # add a clean up routine
-        atexit.register(Disconnect, self.si)
+        # views belong to the previous session, if any
+        self._views = OrderedDict()
 
         self.content = self.si.RetrieveContent()
 
+    def close(self):
+        """Destroy this session's views and disconnect"""
+        if self.si is None:
+            return
+        self.destroy_views()
+        try:
+            Disconnect(self.si)
+        except Exception:
+            # the session may already be gone
+            pass
+        self.si = None
+
+    def smart_connect(self):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+        if self.config['no_ssl_verify']:
+            requests.packages.urllib3.disable_warnings()
+            context.verify_mode = ssl.CERT_NONE
+            return SmartConnectNoSSL(
+                host=self.config['server'],
+                user=self.config['username'],
+                pwd=self.config['password'],
+                port=int(self.config['port']),
+                certFile=None,
+                keyFile=None,
+            )
+        else:
+            return SmartConnect(
+                host=self.config['server'],
+                user=self.config['username'],
+                pwd=self.config['password'],
+                port=int(self.config['port']),
+                sslContext=context,
+                certFile=None,
+                keyFile=None,
+            )
+
+    def login(self):
+        """Log in again on the current connection, e.g. after a timeout"""
+        self.content.sessionManager.Login(self.config['username'],
+                                          self.config['password'])
+        # views died with the old session
+        with self._views_lock:
+            self._views.clear()
+
     def list_objects(self):
         """
         Command Section: list
         List available VMware objects
         """
         vimtype = self.config['type']
-        vim_obj = "vim.%s" % vimtype
 
-        try:
-            container = self.content.viewManager.CreateContainerView(
-                self.content.rootFolder, [eval(vim_obj)], True)
-        except AttributeError:
-            print("%s is not a Managed Object Type.  See the vSphere API "
-                  "docs for possible options." % vimtype)
-            sys.exit(1)
-
-        # print header line
-        print("%s list" % vimtype)
-
-        if vimtype == "VirtualMachine":
-            rows = [['MOID', 'Name', 'Status']]
+        if self.config['properties']:
+            properties = [p.strip() for p in
+                          self.config['properties'].split(',') if p.strip()]
+            header = ['MOID', 'Name'] + properties
+        elif vimtype == "VirtualMachine":
+            properties = ['runtime.powerState']
+            header = ['MOID', 'Name', 'Status']
         else:
-            rows = [['MOID', 'Name']]
+            properties = []
+            header = ['MOID', 'Name']
+
+        objects = self.get_objects(vimtype, properties)
+        if self.output_format() == 'table':
+            # print header line
+            print("%s list" % vimtype)
+
+        self.print_rows(header, (list(obj.values()) for obj in objects))
+
+    def get_objects(self, vimtype, properties=()):
+        """
+        Retrieve every object of a Managed Object Type (e.g.
+        'VirtualMachine') with the given property paths, in one paged
+        request.
+
+        Returns an iterator of OrderedDicts, one per object: moid, name,
+        then properties.
+        """
+        vim_type = self.managed_object_type(vimtype)
 
-        for c in container.view:
-            if vimtype == "VirtualMachine":
-                rows.append([c._moId, c.name, c.runtime.powerState])
+        def objects():
+            try:
+                for obj, props in self.retrieve_properties(
+                        vim_type, ['name'] + list(properties)):
+                    yield OrderedDict(
+                        [('moid', obj._moId), ('name', props.get('name'))] +
+                        [(p, props.get(p)) for p in properties])
+            except vmodl.query.InvalidProperty as e:
+                raise InvalidArgumentError("%s is not a property of %s"
+                                           % (e.name, vimtype))
+
+        return objects()
+
+    def managed_object_type(self, vimtype):
+        """The vim type named vimtype, e.g. 'VirtualMachine' or 'dvs.X'"""
+        vim_type = vim
+        for attr in vimtype.split('.'):
+            vim_type = getattr(vim_type, attr, None)
+        if not isinstance(vim_type, type) or \
+                not issubclass(vim_type, ManagedObject):
+            raise NotFoundError("%s is not a Managed Object Type.  See the "
+                                "vSphere API docs for possible options."
+                                % vimtype)
+        return vim_type
+
+    def inventory_path(self):
+        return (self.config['db'] or self.config.get('inventory_db') or
+                inventory.default_path())
+
+    def inventory_dump(self):
+        """
+        Command Section: inventory dump
+        Export VMs, hosts, clusters, datastores, networks and their
+        relations to a sqlite file, one PropertyCollector pass per type
+        """
+        path = self.inventory_path()
+        db, tmp_path = inventory.create(path)
+
+        def moid(obj):
+            return obj._moId if obj is not None else None
+
+        print("Dumping inventory to %s..." % path)
+
+        vms, vm_datastores, vm_networks = [], [], []
+        for vm, props in self.retrieve_properties(
+                vim.VirtualMachine,
+                inventory.VM_PROPERTIES + ['datastore', 'network']):
+            vms.append([
+                vm._moId,
+                props.get('name'),
+                props.get('runtime.powerState'),
+                moid(props.get('runtime.host')),
+                props.get('config.guestFullName'),
+                props.get('guest.ipAddress'),
+                props.get('config.hardware.numCPU'),
+                props.get('config.hardware.memoryMB'),
+                props.get('config.template'),
+                props.get('config.annotation'),
+            ])
+            vm_datastores += [[vm._moId, ds._moId]
+                              for ds in props.get('datastore', [])]
+            vm_networks += [[vm._moId, net._moId]
+                            for net in props.get('network', [])]
+        db.executemany("INSERT INTO vm VALUES (?,?,?,?,?,?,?,?,?,?)", vms)
+        db.executemany("INSERT INTO vm_datastore VALUES (?,?)",
+                       vm_datastores)
+        db.executemany("INSERT INTO vm_network VALUES (?,?)", vm_networks)
+
+        hosts = []
+        for host, props in self.retrieve_properties(
+                vim.HostSystem, inventory.HOST_PROPERTIES):
+            # standalone hosts have a ComputeResource parent, not a cluster
+            parent = props.get('parent')
+            hosts.append([
+                host._moId,
+                props.get('name'),
+                moid(parent) if isinstance(
+                    parent, vim.ClusterComputeResource) else None,
+                props.get('runtime.connectionState'),
+                props.get('runtime.powerState'),
+            ])
+        db.executemany("INSERT INTO host VALUES (?,?,?,?,?)", hosts)
+
+        clusters = [[cluster._moId, props.get('name')]
+                    for cluster, props in self.retrieve_properties(
+                        vim.ClusterComputeResource,
+                        inventory.CLUSTER_PROPERTIES)]
+        db.executemany("INSERT INTO cluster VALUES (?,?)", clusters)
+
+        datastores = [[ds._moId] + [props.get(p) for p in
+                                    inventory.DATASTORE_PROPERTIES]
+                      for ds, props in self.retrieve_properties(
+                          vim.Datastore, inventory.DATASTORE_PROPERTIES)]
+        db.executemany("INSERT INTO datastore VALUES (?,?,?,?,?,?)",
+                       datastores)
+
+        networks = [[net._moId, props.get('name')]
+                    for net, props in self.retrieve_properties(
+                        vim.Network, inventory.NETWORK_PROPERTIES)]
+        db.executemany("INSERT INTO network VALUES (?,?)", networks)
+
+        db.executemany("INSERT INTO meta VALUES (?,?)", [
+            ['server', self.config['server']],
+            ['dumped_at', datetime.datetime.utcnow().isoformat()],
+        ])
+
+        inventory.replace(db, tmp_path, path)
+
+        print("Dumped %s VMs, %s hosts, %s clusters, %s datastores and "
+              "%s networks" % (len(vms), len(hosts), len(clusters),
+                               len(datastores), len(networks)))
+
+    def inventory_query(self):
+        """
+        Command Section: inventory query
+        Query an inventory dump offline
+        """
+        try:
+            if self.config['sql']:
+                header, rows = inventory.query(self.inventory_path(),
+                                               sql=self.config['sql'])
+            else:
+                header, rows = inventory.query(
+                    self.inventory_path(),
+                    name=self.config['name'],
+                    power_state=self.config['power_state'],
+                    host=self.config['host'],
+                    cluster=self.config['cluster'],
+                    datastore=self.config['datastore'],
+                    network=self.config['network'],
+                )
+        except IOError as e:
+            raise NotFoundError(str(e))
+        except sqlite3.Error as e:
+            raise InvalidArgumentError("inventory query failed: %s" % e)
+
+        if header:
+            self.print_rows(header, rows)
+
+    def watch(self):
+        """
+        Command Section: watch
+        Stream inventory changes as NDJSON events
+        """
+        type_props = dict()
+        for vimtype in self.config['type']:
+            vim_type = self.managed_object_type(vimtype)
+
+            if self.config['properties']:
+                type_props[vim_type] = [
+                    p.strip() for p in self.config['properties'].split(',')
+                    if p.strip()]
+            elif vimtype == "VirtualMachine":
+                type_props[vim_type] = ['name', 'runtime.powerState',
+                                        'runtime.host']
             else:
-                rows.append([c._moId, c.name])
+                type_props[vim_type] = ['name']
 
-        self.print_as_table(rows)
+        try:
+            for event in self.watch_updates(type_props,
+                                            self.config['max_wait']):
+                event['time'] = datetime.datetime.utcnow().isoformat()
+                print(json.dumps(event, default=self.to_json))
+                sys.stdout.flush()
+        except vmodl.query.InvalidProperty as e:
+            raise InvalidArgumentError("%s is not a valid property" % e.name)
+        except KeyboardInterrupt:
+            pass
+
+    def exporter(self):
+        """
+        Command Section: exporter
+        Serve inventory metrics for Prometheus, kept current from a
+        PropertyCollector update stream rather than queried per scrape
+        """
+        metrics = exporter.InventoryMetrics(stats=self.retrier.stats)
+        type_props = dict((getattr(vim, vimtype), paths) for vimtype, paths
+                          in exporter.WATCH_PROPERTIES.items())
+
+        exporter.serve(metrics, self.config['listen_address'],
+                       self.config['listen_port'])
+        print("Serving metrics on http://%s:%s/metrics" % (
+            self.config['listen_address'], self.config['listen_port']))
+
+        try:
+            for event in self.watch_updates(type_props):
+                metrics.apply(event)
+        except KeyboardInterrupt:
+            pass
+
+    def perf(self):
+        """
+        Command Section: perf
+        Query performance counters for many entities, batching QuerySpecs
+        into as few QueryPerf calls as possible
+        """
+        vim_type = getattr(vim, self.config['type'])
+        counter_ids = self.perf_counters()
+
+        counters = [c.strip() for c in self.config['counters'].split(',')
+                    if c.strip()]
+        unknown = [c for c in counters if c not in counter_ids]
+        if unknown:
+            raise InvalidArgumentError(
+                "unknown performance counters %s. Counters are named "
+                "group.name.rollup, e.g. cpu.usage.average"
+                % ", ".join(unknown))
+
+        counter_names = dict((counter_ids[c], c) for c in counters)
+        instance = '*' if self.config['all_instances'] else ''
+        metric_ids = [vim.PerformanceManager.MetricId(
+            counterId=counter_ids[c], instance=instance) for c in counters]
+
+        names = set(self.config['names'])
+        entities = [(obj, props['name']) for obj, props in
+                    self.retrieve_properties(vim_type, ['name'])
+                    if not names or props.get('name') in names]
+
+        missing = names - set(name for obj, name in entities)
+        if missing:
+            raise NotFoundError("%s '%s' does not exist"
+                                % (self.config['type'],
+                                   "', '".join(sorted(missing))))
+
+        def rows():
+            batch_size = max(1, self.config['batch_size'])
+            for start in range(0, len(entities), batch_size):
+                batch = entities[start:start + batch_size]
+                batch_names = dict((obj._moId, name) for obj, name in batch)
+                specs = [vim.PerformanceManager.QuerySpec(
+                    entity=obj,
+                    metricId=metric_ids,
+                    intervalId=self.config['interval'],
+                    maxSample=self.config['max_sample'])
+                    for obj, name in batch]
+
+                for metric in self.content.perfManager.QueryPerf(specs):
+                    timestamps = [sample.timestamp
+                                  for sample in metric.sampleInfo]
+                    for series in metric.value:
+                        for timestamp, value in zip(timestamps,
+                                                    series.value):
+                            yield [batch_names[metric.entity._moId],
+                                   metric.entity._moId,
+                                   counter_names[series.id.counterId],
+                                   series.id.instance,
+                                   timestamp,
+                                   value]
+
+        self.print_rows(['Name', 'MOID', 'Counter', 'Instance', 'Timestamp',
+                         'Value'], rows())
+
+    def perf_counters(self):
+        """
+        Map of performance counter names (group.name.rollup) to counter
+        ids.  Fetched once per session, the list is large.
+        """
+        if self._perf_counters is None:
+            self._perf_counters = dict(
+                ("%s.%s.%s" % (counter.groupInfo.key, counter.nameInfo.key,
+                               counter.rollupType), counter.key)
+                for counter in self.content.perfManager.perfCounter)
+        return self._perf_counters
 
     def clone(self):
         """
@@ -179,19 +588,126 @@ class EZMomi(object):
         Clone a VM from a template
         """
         self.config['hostname'] = self.config['hostname'].lower()
-        self.config['mem'] = int(self.config['mem'] * 1024)  # convert GB to MB
 
         print("Cloning %s to new host %s with %sMB RAM..." % (
             self.config['template'],
             self.config['hostname'],
-            self.config['mem']
+            int(self.config['mem'] * 1024)
         ))
 
+        clone = self.clone_vm(self.config)
+        if clone['ips']:
+            print("%s got %s" % (clone['name'], ", ".join(clone['ips'])))
+
+        if self.config['wait_ready']:
+            self.wait_ready([clone['vm']])
+
+        if self.config['post_clone_cmd']:
+            try:
+                # helper env variables
+                os.environ['EZMOMI_CLONE_HOSTNAME'] = self.config['hostname']
+                print("Running --post-clone-cmd %s"
+                      % self.config['post_clone_cmd'])
+                os.system(self.config['post_clone_cmd'])
+
+            except Exception as e:
+                print("Error running post-clone command. Exception: %s" % e)
+                pass
+
+        # send notification email
+        if self.config['mail']:
+            self.send_email()
+
+    def clone_vm(self, settings, ready_condition=None,
+                 ready_timeout=600):
+        """
+        Clone a VM from a template.  settings takes the clone command's
+        options (hostname, template, ips...) on top of the config's.  With
+        a ready_condition (see guestReady), also wait for the guest.
+
+        Returns a dict with the new VM's name, moid, VirtualMachine and
+        the ips allocated for it.
+        """
+        clone = self.build_clone(dict(self.config, **settings))
+        problems = self.preflight([clone])
+        if problems:
+            self.release_ips(clone['ips'])
+            raise CloneSpecError("; ".join(problems))
+
+        # fire the clone task
+        try:
+            self.use_replicas([clone])
+            job = self.clone_job(clone)
+            self.run_tasks([job])
+        except EZMomiError:
+            self.release_ips(clone['ips'])
+            raise
+        # the clone task's result is the new VirtualMachine
+        vm = job.task.info.result
+
+        if ready_condition:
+            ready = self.WaitForGuestReady([vm], ready_condition,
+                                           ready_timeout)
+            if not all(ready.values()):
+                raise GuestNotReadyError([clone['name']], ready_timeout)
+
+        return OrderedDict([('name', clone['name']), ('moid', vm._moId),
+                            ('vm', vm), ('ips', clone['ips'])])
+
+    def clone_job(self, clone):
+        """Job submitting a clone built by build_clone (or loaded by apply)"""
+        return Job(lambda: clone['template'].Clone(folder=clone['folder'],
+                                                   name=clone['name'],
+                                                   spec=clone['spec']),
+                   description="Clone %s" % clone['name'],
+                   host=clone['spec'].location.host,
+                   datastores=[clone['spec'].location.datastore])
+
+    def build_clone(self, settings):
+        """
+        Resolve every object a clone needs and build its CloneSpec.
+        settings holds the clone command's options (hostname, template,
+        ips, cpus, mem...), see CLONE_DEFAULTS for optional ones.
+
+        settings['auto_ip'] lists networks to allocate a free address in
+        (see allocate_ip), after any given ips.
+
+        Returns a dict with the 'template' VM, destination 'folder', new
+        VM 'name', 'spec', allocated 'ips' and whether to 'replicate' the
+        template (see use_replicas).  Raises CloneSpecError if anything
+        can't be resolved.
+        """
+        settings = dict(CLONE_DEFAULTS, **settings)
+        for key in ('template', 'cpus', 'mem', 'domain'):
+            if settings.get(key) is None:
+                raise CloneSpecError("No %s given for %s"
+                                     % (key, settings['hostname']))
+        hostname = settings['hostname'].lower()
+
+        networks = settings['auto_ip'] or []
+        if isinstance(networks, six.string_types):
+            networks = [networks]
+        allocated = list()
+        try:
+            for network in networks:
+                allocated.append(self.allocate_ip(network, hostname))
+            settings['ips'] = list(settings['ips'] or []) + allocated
+            clone = self.build_clone_spec(settings, hostname)
+        except BaseException:
+            self.release_ips(allocated)
+            raise
+        clone['ips'] = allocated
+        return clone
+
+    def build_clone_spec(self, settings, hostname):
+        """build_clone once addresses are allocated"""
+        mem = int(settings['mem'] * 1024)  # convert GB to MB
+
         # initialize a list to hold our network settings
         ip_settings = list()
 
         # Get network settings for each IP
-        for key, ip_string in enumerate(self.config['ips']):
+        for key, ip_string in enumerate(settings['ips'] or []):
 
             # convert ip from string to the 'IPAddress' type
             ip = IPAddress(ip_string)
@@ -199,51 +715,69 @@ class EZMomi(object):
             # determine network this IP is in
             for network in self.config['networks']:
                 if ip in IPNetwork(network):
-                    self.config['networks'][network]['ip'] = ip
+                    # copy, several IPs may be in the same network
+                    network_settings = dict(self.config['networks'][network])
+                    network_settings['ip'] = ip
                     ipnet = IPNetwork(network)
-                    self.config['networks'][network]['subnet_mask'] = str(
-                        ipnet.netmask
-                    )
-                    ip_settings.append(self.config['networks'][network])
+                    network_settings['subnet_mask'] = str(ipnet.netmask)
+                    ip_settings.append(network_settings)
 
             # throw an error if we couldn't find a network for this ip
             if not any(d['ip'] == ip for d in ip_settings):
-                print("I don't know what network %s is in.  You can supply "
-                      "settings for this network in config.yml." % ip_string)
-                sys.exit(1)
+                raise CloneSpecError(
+                    "I don't know what network %s is in.  You can supply "
+                    "settings for this network in config.yml." % ip_string)
+
+        if not ip_settings:
+            raise CloneSpecError("No IPs given for %s" % hostname)
 
-        # network to place new VM in
-        self.get_obj([vim.Network], ip_settings[0]['network'])
         datacenter = self.get_obj([vim.Datacenter],
                                   ip_settings[0]['datacenter']
                                   )
+        if datacenter is None:
+            raise CloneSpecError("Unable to find Datacenter '%s'"
+                                 % ip_settings[0]['datacenter'])
 
         # get the folder where VMs are kept for this datacenter
-        if self.config['destination_folder']:
+        if settings['destination_folder']:
             destfolder = self.content.searchIndex.FindByInventoryPath(
-                self.config['destination_folder']
+                settings['destination_folder']
             )
+            if destfolder is None:
+                raise CloneSpecError("Unable to find destination folder '%s'"
+                                     % settings['destination_folder'])
         else:
             destfolder = datacenter.vmFolder
 
         cluster = self.get_obj([vim.ClusterComputeResource],
                                ip_settings[0]['cluster']
                                )
+        if cluster is None:
+            raise CloneSpecError("Unable to find Cluster '%s'"
+                                 % ip_settings[0]['cluster'])
 
-        resource_pool_str = self.config['resource_pool']
+        resource_pool_str = settings['resource_pool']
         # resource_pool setting in config file takes priority over the
         # default 'Resources' pool
         if resource_pool_str == 'Resources' \
-                and ('resource_pool' in ip_settings[key]):
-            resource_pool_str = ip_settings[key]['resource_pool']
+                and ('resource_pool' in ip_settings[-1]):
+            resource_pool_str = ip_settings[-1]['resource_pool']
 
         resource_pool = self.get_resource_pool(cluster, resource_pool_str)
+        # 'Resources' is the cluster's own pool, used when none is found
+        if resource_pool is None and resource_pool_str != 'Resources':
+            raise CloneSpecError("Unable to find Resource Pool '%s' in "
+                                 "Cluster '%s'" % (resource_pool_str,
+                                                   ip_settings[0]['cluster']))
 
-        host_system = self.config['host']
+        host_system = settings['host']
         if host_system != "":
             host_system = self.get_obj([vim.HostSystem],
-                                       self.config['host']
+                                       settings['host']
                                        )
+            if host_system is None:
+                raise CloneSpecError("Unable to find HostSystem '%s'"
+                                     % settings['host'])
 
         if self.debug:
             self.print_debug(
@@ -261,31 +795,30 @@ class EZMomi(object):
 
         datastore = None
 
-        if self.config['datastore']:
+        if settings['datastore']:
             datastore = self.get_obj(
-                [vim.Datastore], self.config['datastore'])
+                [vim.Datastore], settings['datastore'])
         elif 'datastore' in ip_settings[0]:
             datastore = self.get_obj(
                 [vim.Datastore],
                 ip_settings[0]['datastore'])
         if datastore is None:
-            print("Error: Unable to find Datastore '%s'"
-                  % ip_settings[0]['datastore'])
-            sys.exit(1)
-
-        if self.config['template_folder']:
-            template_vm = self.get_vm_failfast(
-                self.config['template'],
-                False,
-                'Template VM',
-                path=self.config['template_folder']
-            )
+            raise CloneSpecError("Unable to find Datastore '%s'"
+                                 % (settings['datastore'] or
+                                    ip_settings[0].get('datastore')))
+
+        if settings['template_folder']:
+            try:
+                template_vm = self.get_vm(settings['template'],
+                                          path=settings['template_folder'])
+            except NotFoundError as e:
+                # reported with the batch's other clone problems
+                raise CloneSpecError(str(e))
         else:
-            template_vm = self.get_vm_failfast(
-                self.config['template'],
-                False,
-                'Template VM'
-            )
+            template_vm = self.get_vm(settings['template'])
+        if template_vm is None:
+            raise CloneSpecError("Template VM '%s' does not exist"
+                                 % settings['template'])
 
         # Relocation spec
         relospec = vim.vm.RelocateSpec()
@@ -296,7 +829,7 @@ class EZMomi(object):
         if resource_pool:
             relospec.pool = resource_pool
 
-        # Networking self.config for VM and guest OS
+        # Networking settings for VM and guest OS
         devices = []
         adaptermaps = []
 
@@ -334,6 +867,9 @@ class EZMomi(object):
                 dvpg = ip_settings[key]['dvportgroup']
                 nic.device.deviceInfo.summary = dvpg
                 pg_obj = self.get_obj([vim.dvs.DistributedVirtualPortgroup], dvpg)  # noqa
+                if pg_obj is None:
+                    raise CloneSpecError("Unable to find dvportgroup '%s'"
+                                         % dvpg)
                 dvs_port_connection = vim.dvs.PortConnection()
                 dvs_port_connection.portgroupKey = pg_obj.key
                 dvs_port_connection.switchUuid = (
@@ -354,6 +890,9 @@ class EZMomi(object):
                 nic.device.backing.network = (
                     self.get_obj([vim.Network], ip_settings[key]['network'])
                 )
+                if nic.device.backing.network is None:
+                    raise CloneSpecError("Unable to find Network '%s'"
+                                         % ip_settings[key]['network'])
                 nic.device.backing.deviceName = ip_settings[key]['network']
                 nic.device.backing.useAutoDetect = False
 
@@ -384,31 +923,31 @@ class EZMomi(object):
             if 'gateway' in ip_settings[key]:
                 guest_map.adapter.gateway = ip_settings[key]['gateway']
 
-            if self.config['domain']:
-                guest_map.adapter.dnsDomain = self.config['domain']
+            if settings['domain']:
+                guest_map.adapter.dnsDomain = settings['domain']
 
             adaptermaps.append(guest_map)
 
         # DNS settings
-        if 'dns_servers' in self.config:
+        if 'dns_servers' in settings:
             globalip = vim.vm.customization.GlobalIPSettings()
-            globalip.dnsServerList = self.config['dns_servers']
-            globalip.dnsSuffixList = self.config['domain']
+            globalip.dnsServerList = settings['dns_servers']
+            globalip.dnsSuffixList = settings['domain']
             customspec.globalIPSettings = globalip
 
         # Hostname settings
         ident = vim.vm.customization.LinuxPrep()
-        ident.domain = self.config['domain']
+        ident.domain = settings['domain']
         ident.hostName = vim.vm.customization.FixedName()
-        ident.hostName.name = self.config['hostname']
+        ident.hostName.name = hostname
 
         customspec.nicSettingMap = adaptermaps
         customspec.identity = ident
 
         # VM config spec
         vmconf = vim.vm.ConfigSpec()
-        vmconf.numCPUs = self.config['cpus']
-        vmconf.memoryMB = self.config['mem']
+        vmconf.numCPUs = settings['cpus']
+        vmconf.memoryMB = mem
         vmconf.cpuHotAddEnabled = True
         vmconf.memoryHotAddEnabled = True
         vmconf.deviceChange = devices
@@ -421,35 +960,249 @@ class EZMomi(object):
         clonespec.powerOn = True
         clonespec.template = False
 
-        self.addDisks(template_vm, clonespec)
+        self.addDisks(template_vm, clonespec, settings['disks'])
 
         if self.debug:
             self.print_debug("CloneSpec", clonespec)
 
-        # fire the clone task
-        tasks = [template_vm.Clone(folder=destfolder,
-                                   name=self.config['hostname'],
-                                   spec=clonespec
-                                   )]
-        result = self.WaitForTasks(tasks)
+        return {
+            'name': hostname,
+            'template': template_vm,
+            'folder': destfolder,
+            'spec': clonespec,
+            'replicate': bool(settings.get('template_replicas')),
+        }
 
-        if self.config['post_clone_cmd']:
+    def allocate_ip(self, network, hostname):
+        """
+        Reserve the next free address of network, a key of networks in
+        config.yml or its network name, for hostname.  Addresses any
+        guest reports, the gateway and those reserved by earlier runs
+        (see ipam.allocate) are skipped; auto_ip_range ('first-last') in
+        the network's settings narrows the range used.
+        """
+        cidr = self.find_network(network)
+        network_settings = self.config['networks'][cidr]
+        ipnet = IPNetwork(cidr)
+        # skip the network and broadcast addresses
+        first, last = ipnet.first + 1, ipnet.last - 1
+        if network_settings.get('auto_ip_range'):
             try:
-                # helper env variables
-                os.environ['EZMOMI_CLONE_HOSTNAME'] = self.config['hostname']
-                print("Running --post-clone-cmd %s"
-                      % self.config['post_clone_cmd'])
-                os.system(self.config['post_clone_cmd'])
+                first, last = [int(IPAddress(ip.strip())) for ip in
+                               network_settings['auto_ip_range'].split('-')]
+            except ValueError:
+                raise ConfigError("auto_ip_range of %s should be like "
+                                  "'10.0.0.100-10.0.0.199'" % cidr)
+
+        excluded = [network_settings['gateway']] \
+            if network_settings.get('gateway') else []
+        try:
+            ip = ipam.allocate(self.ip_reservations_path(),
+                               self.used_addresses(), cidr, first, last,
+                               hostname, excluded,
+                               ttl=self.config.get('ip_reservation_hours',
+                                                   24) * 3600)
+        except ValueError as e:
+            raise CloneSpecError(str(e))
+        except sqlite3.Error as e:
+            raise CloneSpecError("Unable to reserve an address in %s: %s"
+                                 % (cidr, e))
 
-            except Exception as e:
-                print("Error running post-clone command. Exception: %s" % e)
-                pass
+        if self.debug:
+            self.print_debug("Allocated address for %s" % hostname, ip)
+        return ip
+
+    def find_network(self, network):
+        """Key of networks in config.yml for a CIDR or network name"""
+        networks = self.config.get('networks') or {}
+        if network in networks:
+            return network
+        for cidr, network_settings in networks.items():
+            if network_settings.get('network') == network:
+                return cidr
+        raise CloneSpecError("I don't know network %s.  Add it to networks "
+                             "in config.yml to allocate addresses in it."
+                             % network)
+
+    def ip_reservations_path(self):
+        return self.config.get('ip_reservations_db') or ipam.default_path()
+
+    def release_ips(self, ips):
+        """Drop reservations made by allocate_ip"""
+        try:
+            ipam.release(self.ip_reservations_path(), ips)
+        except sqlite3.Error:
+            # they expire anyway
+            pass
 
-        # send notification email
-        if self.config['mail']:
-            self.send_email()
+    def used_addresses(self):
+        """
+        Index of every address guests report, from one retrieval of all
+        VMs' guest.ipAddress and guest.net, fetched once per session.
+        """
+        if self._used_addresses is None:
+            addresses = list()
+            for vm, props in self.retrieve_properties(
+                    vim.VirtualMachine, ['guest.ipAddress', 'guest.net']):
+                if props.get('guest.ipAddress'):
+                    addresses.append(props['guest.ipAddress'])
+                for nic in props.get('guest.net') or []:
+                    addresses.extend(nic.ipAddress or [])
+            self._used_addresses = ipam.AddressIndex(addresses)
+        return self._used_addresses
+
+    def use_replicas(self, clones):
+        """
+        Clone from a replica of the template on the target datastore (see
+        template_replica) for the clones built with template_replicas set.
+        Replicas may be created or destroyed on the way, so this is only
+        done right before the clones are submitted.
+        """
+        for clone in clones:
+            if clone.get('replicate'):
+                clone['template'] = self.template_replica(
+                    clone['template'], clone['spec'].location.datastore)
+
+    def template_replica(self, template, datastore):
+        """
+        The copy of template to clone from onto datastore: template
+        itself if it lives there, else its replica on datastore, created
+        (or recreated when the template's config.changeVersion moved on)
+        by a clone to a template.  Least recently used replicas on the
+        datastore are destroyed when it would otherwise keep less than
+        replica_min_free_gb (config.yml, default 50) free; if that isn't
+        enough, template is used as is.
+        """
+        props = dict(next(self.retrieve_properties(
+            vim.VirtualMachine, ['name', 'datastore', 'parent',
+                                 'config.changeVersion',
+                                 'summary.storage.committed'],
+            objects=[template]))[1])
+        if datastore in (props.get('datastore') or []):
+            return template
+
+        version = props.get('config.changeVersion')
+
+        def local_replicas():
+            for replica, replica_props in self.find_replicas():
+                if replica_props['replica'][replicas.MARKER] == \
+                        template._moId and \
+                        datastore in replica_props['datastore']:
+                    yield replica, replica_props
+
+        for replica, replica_props in list(local_replicas()):
+            if replica_props['replica'].get('version') == version:
+                self.touch_replica(replica)
+                return replica
+            print("Replacing outdated replica %s" % replica_props['name'])
+            self.run_tasks([Job(replica.Destroy,
+                                description="Destroy %s"
+                                % replica_props['name'])])
+            self._replicas = None
+
+        if not self.make_room(datastore,
+                              props.get('summary.storage.committed', 0)):
+            if self.debug:
+                self.print_debug("No room for a replica of %s"
+                                 % props['name'], datastore)
+            return template
+
+        name = "%s-%s" % (props['name'], datastore.name)
+        print("Creating replica %s of %s" % (name, props['name']))
+        job = Job(lambda: template.Clone(
+            folder=props['parent'], name=name,
+            spec=vim.vm.CloneSpec(
+                location=vim.vm.RelocateSpec(datastore=datastore),
+                config=vim.vm.ConfigSpec(annotation=replicas.annotation(
+                    template._moId, version)),
+                powerOn=False, template=True)),
+            description="Replicate %s" % props['name'],
+            datastores=[datastore])
+        self._replicas = None
+        try:
+            self.run_tasks([job])
+        except TaskError as e:
+            if not isinstance(e.fault, vim.fault.DuplicateName):
+                raise
+            # created meanwhile by another run?
+            self._replicas = None
+            for replica, replica_props in local_replicas():
+                if replica_props['replica'].get('version') == version:
+                    self.touch_replica(replica)
+                    return replica
+            raise CloneSpecError("Unable to create replica %s of %s: a VM "
+                                 "with that name already exists"
+                                 % (name, props['name']))
+        replica = job.task.info.result
+        self.touch_replica(replica)
+        return replica
+
+    def find_replicas(self):
+        """
+        (VirtualMachine, properties) of every template replica, with the
+        parsed annotation as 'replica'; retrieved once until replicas
+        are created or destroyed.
+        """
+        if self._replicas is None:
+            self._replicas = list()
+            for vm, props in self.retrieve_properties(
+                    vim.VirtualMachine,
+                    ['name', 'config.annotation', 'datastore',
+                     'summary.storage.committed']):
+                info = replicas.parse_annotation(
+                    props.get('config.annotation'))
+                if info:
+                    props['replica'] = info
+                    props['datastore'] = props.get('datastore') or []
+                    self._replicas.append((vm, props))
+        return self._replicas
+
+    def make_room(self, datastore, size):
+        """
+        Destroy least recently used replicas on datastore until size
+        bytes fit with replica_min_free_gb to spare; none are destroyed
+        if that can't be reached.  Returns whether size fits.
+        """
+        reserve = self.config.get('replica_min_free_gb', 50) * 1024 ** 3
+        free = next(self.retrieve_properties(
+            vim.Datastore, ['summary.freeSpace'],
+            objects=[datastore]))[1].get('summary.freeSpace', 0)
+
+        local = dict((vm._moId, (vm, props)) for vm, props in
+                     self.find_replicas() if datastore in props['datastore'])
+        reclaimable = sum(props.get('summary.storage.committed', 0)
+                          for vm, props in local.values())
+        if free + reclaimable - size < reserve:
+            # evicting every replica wouldn't be enough
+            return False
+
+        for moid, info in replicas.least_recently_used(
+                self.replicas_path(), self.config['server'],
+                [(moid, props['replica'])
+                 for moid, (vm, props) in local.items()]):
+            if free - size >= reserve:
+                break
+            vm, props = local[moid]
+            print("Evicting replica %s" % props['name'])
+            self.run_tasks([Job(vm.Destroy,
+                                description="Destroy %s" % props['name'])])
+            self._replicas = None
+            free += props.get('summary.storage.committed', 0)
+        return free - size >= reserve
+
+    def replicas_path(self):
+        return self.config.get('replicas_db') or replicas.default_path()
+
+    def touch_replica(self, replica):
+        try:
+            replicas.touch(self.replicas_path(), self.config['server'],
+                           replica._moId)
+        except (sqlite3.Error, EnvironmentError) as e:
+            # only makes the eviction order less accurate
+            if self.debug:
+                self.print_debug("Unable to record replica use", e)
 
-    def addDisks(self, vm, spec):
+    def addDisks(self, vm, spec, disks=None):
         # get all disks on the VM, set unit_number to the last taken
         unit_number = 0
         controller = None
@@ -460,8 +1213,11 @@ class EZMomi(object):
             if isinstance(dev, vim.vm.device.VirtualSCSIController):
                 controller = dev
 
+        if disks is None:
+            disks = self.config['disks']
+
         dev_changes = []
-        for key, disk_spec in enumerate(self.config['disks']):
+        for key, disk_spec in enumerate(disks or []):
             disk_size_str, disk_type = disk_spec.partition(",")[::2]
             new_disk_kb = int(disk_size_str) * 1024 * 1024
             if new_disk_kb <= 0:
@@ -473,7 +1229,11 @@ class EZMomi(object):
             if unit_number == 7:
                 unit_number += 1
             if unit_number >= 16:
-                raise "too many disks"
+                raise CloneSpecError("Too many disks for the SCSI controller "
+                                     "of %s" % vm.name)
+            if controller is None:
+                raise CloneSpecError("%s has no SCSI controller to add "
+                                     "disks to" % vm.name)
 
             if self.debug:
                 self.print_debug("disk size %s[GB]" % key, disk_size_str)
@@ -497,60 +1257,316 @@ class EZMomi(object):
             dev_changes.append(disk_spec)
         spec.config.deviceChange += dev_changes
 
+    def preflight(self, clones):
+        """
+        Check clones built by build_clone against the inventory in a few
+        bulk retrievals, before any is submitted: their names must not be
+        taken (nor repeat within the batch), and every datastore must have
+        room for the templates cloned to it plus their added disks.
+
+        Returns the problems found, as messages; empty if none.
+        """
+        problems = list()
+        existing = self.name_index(vim.VirtualMachine)
+        names = set()
+        for clone in clones:
+            if clone['name'] in existing:
+                problems.append("%s: a VM with that name already exists"
+                                % clone['name'])
+            elif clone['name'] in names:
+                problems.append("%s: named more than once in the batch"
+                                % clone['name'])
+            names.add(clone['name'])
+
+        templates = dict((clone['template']._moId, clone['template'])
+                         for clone in clones)
+        template_bytes = dict(
+            (vm._moId, props.get('summary.storage.committed', 0))
+            for vm, props in self.retrieve_properties(
+                vim.VirtualMachine, ['summary.storage.committed'],
+                objects=list(templates.values())))
+
+        needed = OrderedDict()
+        datastores = dict()
+        for clone in clones:
+            datastore = clone['spec'].location.datastore
+            datastores[datastore._moId] = datastore
+            disk_bytes = sum(
+                change.device.capacityInKB * 1024
+                for change in clone['spec'].config.deviceChange or []
+                if change.fileOperation == 'create' and
+                isinstance(change.device, vim.vm.device.VirtualDisk))
+            needed[datastore._moId] = needed.get(datastore._moId, 0) + \
+                template_bytes.get(clone['template']._moId, 0) + disk_bytes
+
+        gb = 1024.0 ** 3
+        for datastore, props in self.retrieve_properties(
+                vim.Datastore, ['name', 'summary.freeSpace'],
+                objects=list(datastores.values())):
+            free = props.get('summary.freeSpace', 0)
+            if needed[datastore._moId] > free:
+                problems.append(
+                    "Datastore %s has %.1fGB free, the clones on it need "
+                    "%.1fGB" % (props.get('name'), free / gb,
+                                needed[datastore._moId] / gb))
+        return problems
+
+    def plan(self):
+        """
+        Command Section: plan
+        Resolve and validate a batch of clones up front and write their
+        specs, with MOIDs for every referenced object, to a plan file
+        """
+        batch = self.load_batch(self.config['batch'])
+
+        # resolve names from one retrieval per type, not a scan per lookup
+        cache_names = self.cache_names
+        self.cache_names = True
+        clones = list()
+        errors = list()
+        try:
+            for entry in batch:
+                try:
+                    clones.append(self.build_clone(dict(self.config,
+                                                        **entry)))
+                except CloneSpecError as e:
+                    errors.append("%s: %s" % (entry.get('hostname'), e))
+            errors.extend(self.preflight(clones))
+        finally:
+            self.cache_names = cache_names
+            if not cache_names:
+                self.forget_names()
+
+        if errors:
+            for clone in clones:
+                self.release_ips(clone['ips'])
+            raise CloneSpecError(
+                "found %s problems in the batch of %s clones, nothing was "
+                "planned:\n  %s"
+                % (len(errors), len(batch), "\n  ".join(errors)))
+
+        plan = {
+            'server': self.config['server'],
+            'created': datetime.datetime.utcnow().isoformat(),
+            'clones': [{
+                'name': clone['name'],
+                'template': clone['template']._moId,
+                'folder': clone['folder']._moId,
+                'replicate': clone['replicate'],
+                'spec': Serialize(clone['spec'],
+                                  version=self.si._stub.version).decode(
+                                      'utf-8'),
+            } for clone in clones],
+        }
+
+        with open(self.config['plan_file'], 'w') as f:
+            json.dump(plan, f, indent=2)
+
+        for clone in clones:
+            if clone['ips']:
+                print("%s got %s" % (clone['name'], ", ".join(clone['ips'])))
+        print("Planned %s clones in %s" % (len(clones),
+                                           self.config['plan_file']))
+
+    def apply(self):
+        """
+        Command Section: apply
+        Submit the clones of a plan file without any lookups
+
+        Returns the (job, fault) of every clone that failed.
+        """
+        try:
+            with open(self.config['plan_file']) as f:
+                plan = json.load(f)
+        except (IOError, ValueError) as e:
+            raise InvalidArgumentError("unable to read plan file %s: %s"
+                                       % (self.config['plan_file'], e))
+
+        if plan['server'] != self.config['server']:
+            raise InvalidArgumentError(
+                "%s was planned against %s, not %s"
+                % (self.config['plan_file'], plan['server'],
+                   self.config['server']))
+
+        stub = self.si._stub
+        clones = [{
+            'name': clone['name'],
+            'template': vim.VirtualMachine(clone['template'], stub),
+            'folder': vim.Folder(clone['folder'], stub),
+            'spec': Deserialize(clone['spec'].encode('utf-8'),
+                                vim.vm.CloneSpec, stub),
+            'replicate': clone.get('replicate', False),
+        } for clone in plan['clones']]
+
+        if self.config['concurrency']:
+            self.scheduler.set_max_inflight(self.config['concurrency'])
+
+        self.use_replicas(clones)
+        jobs = [self.clone_job(clone) for clone in clones]
+        print("Cloning %s VMs..." % len(jobs))
+        failures = self.run_tasks(jobs, raise_on_error=False)
+
+        for job, fault in failures:
+            print("Error: %s failed: %s"
+                  % (job.description, fault.msg or type(fault).__name__))
+
+        if self.config['wait_ready']:
+            self.wait_ready([job.task.info.result for job in jobs
+                             if job.task and job.task.info.result])
+
+        return failures
+
+    def load_batch(self, path):
+        """
+        Load a batch file: a YAML list of clone settings, one dict per VM
+        with the same keys as config.yml and the clone options, e.g.
+            - hostname: web01
+              ips: [172.10.16.21]
+              cpus: 2
+            - hostname: web02
+              auto_ip: [172.10.16.0/20]
+        """
+        try:
+            with open(path) as f:
+                batch = yaml.safe_load(f)
+        except IOError:
+            raise NotFoundError("Unable to open batch file %s" % path)
+        except yaml.YAMLError as e:
+            raise InvalidArgumentError("Unable to read batch file.  YAML "
+                                       "syntax issue, perhaps?\n%s" % e)
+
+        if not isinstance(batch, list) or \
+                not all(isinstance(entry, dict) and 'hostname' in entry
+                        for entry in batch):
+            raise InvalidArgumentError("%s must be a list of clone "
+                                       "settings, each with a hostname"
+                                       % path)
+
+        return batch
+
     def destroy(self):
-        tasks = list()
+        """
+        Command Section: destroy
+        Destroy VMs selected by name, glob or folder after one confirmation.
+        Powered on VMs are powered off first: each VM's Destroy task is
+        submitted when its PowerOff task completes.
 
-        destroyed = 'no'
+        Returns the (job, fault) of every task that failed.
+        """
+        vms = self.select_target_vms(
+            "destroy",
+            properties=['runtime.powerState', 'runtime.host', 'datastore'])
+        if not vms:
+            print("No VMs selected")
+            return
 
+        names = sorted(props['name'] for vm, props in vms)
         if self.config['silent']:
             destroyed = 'yes'
+        elif len(names) == 1:
+            destroyed = input(
+                "Do you really want to destroy %s ? [yes/no] " % names[0])
         else:
-            destroyed = raw_input(
-                "Do you really want to destroy %s ? [yes/no] "
-                % self.config['name'])
+            shown = names if len(names) <= 20 else names[:20] + [
+                "... and %s more" % (len(names) - 20)]
+            print("\n".join(shown))
+            destroyed = input(
+                "Do you really want to destroy these %s VMs ? [yes/no] "
+                % len(names))
+
+        if destroyed != 'yes':
+            return
+
+        if self.config['concurrency']:
+            self.scheduler.set_max_inflight(self.config['concurrency'])
+
+        def destroy_job(vm, props):
+            def on_done(task):
+                print("Destroyed %s" % props['name'])
+
+            return Job(vm.Destroy, description="Destroy %s" % props['name'],
+                       host=props.get('runtime.host'),
+                       datastores=props.get('datastore', []),
+                       on_done=on_done)
+
+        def power_off_job(vm, props):
+            def on_done(task):
+                print("%s poweredOff" % props['name'])
+                return [destroy_job(vm, props)]
 
-        if destroyed == 'yes':
-            vm = self.get_vm_failfast(self.config['name'], True)
+            return Job(vm.PowerOff,
+                       description="PowerOff %s" % props['name'],
+                       host=props.get('runtime.host'),
+                       datastores=props.get('datastore', []),
+                       on_done=on_done)
+
+        jobs = list()
+        for vm, props in vms:
             # need to shut the VM down before destroying it
-            if vm.runtime.powerState == vim.VirtualMachinePowerState.poweredOn:
-                tasks.append(vm.PowerOff())
+            if props['runtime.powerState'] == \
+                    vim.VirtualMachinePowerState.poweredOn:
+                jobs.append(power_off_job(vm, props))
+            else:
+                jobs.append(destroy_job(vm, props))
 
-            tasks.append(vm.Destroy())
-            print("Destroying %s..." % self.config['name'])
-            result = self.WaitForTasks(tasks)
+        print("Destroying %s VMs..." % len(jobs))
+        failures = self.run_tasks(jobs, raise_on_error=False)
+
+        for job, fault in failures:
+            print("Error: %s failed: %s"
+                  % (job.description, fault.msg or type(fault).__name__))
+        return failures
 
     def status(self):
         """Check power status"""
-        vm = self.get_vm_failfast(self.config['name'])
+        vm = self.get_target_vm()
         extra = self.config['extra']
         parserFriendly = self.config['parserFriendly']
 
-        status_to_print = []
+        status = self.vm_status(vm, extra=extra)
+        header = list(status)
+        if self.output_format() != 'table':
+            self.print_rows(header, [list(status.values())])
+            return
+
+        row = [str(self.to_cell(value)) for value in status.values()]
         if extra:
-            status_to_print = \
-                [["vmname", "powerstate", "ipaddress", "hostname", "memory",
-                  "cpunum", "uuid", "guestid", "uptime"]] + \
-                [[vm.name, vm.runtime.powerState,
-                  vm.summary.guest.ipAddress or '',
-                  vm.summary.guest.hostName or '',
-                  str(vm.summary.config.memorySizeMB),
-                  str(vm.summary.config.numCpu),
-                  vm.summary.config.uuid, vm.summary.guest.guestId,
-                  str(vm.summary.quickStats.uptimeSeconds) or '0']]
+            status_to_print = [header, row]
         else:
-            status_to_print = [[vm.name, vm.runtime.powerState]]
+            status_to_print = [row]
 
         if parserFriendly:
             self.print_as_lines(status_to_print)
         else:
             self.print_as_table(status_to_print)
 
+    def vm_status(self, vm, extra=False):
+        """
+        Power state of vm (a VirtualMachine or its name) and, with extra,
+        its guest, hardware and uptime details, as an OrderedDict
+        """
+        vm = self.resolve_vm(vm)
+        status = OrderedDict([('vmname', vm.name),
+                              ('powerstate', vm.runtime.powerState)])
+        if extra:
+            summary = vm.summary
+            status.update([
+                ('ipaddress', summary.guest.ipAddress),
+                ('hostname', summary.guest.hostName),
+                ('memory', summary.config.memorySizeMB),
+                ('cpunum', summary.config.numCpu),
+                ('uuid', summary.config.uuid),
+                ('guestid', summary.guest.guestId),
+                ('uptime', summary.quickStats.uptimeSeconds or 0),
+            ])
+        return status
+
     def shutdown(self):
         """
         Shutdown guest
         fallback to power off if guest tools aren't installed
         """
-        vm = self.get_vm_failfast(self.config['name'])
+        vm = self.get_target_vm()
 
         if vm.runtime.powerState == vim.VirtualMachinePowerState.poweredOff:
             print("%s already poweredOff" % vm.name)
@@ -576,16 +1592,289 @@ class EZMomi(object):
                 print("GuestTools not running or not installed: will powerOff")
                 self.powerOff()
 
-    def createSnapshot(self):
-        tasks = []
+    def rolling(self):
+        """
+        Command Section: rolling
+        Shut down, power on, restart or revert the selected VMs in waves.
+        Each wave runs concurrently and must come back ready before the
+        next one starts; the rollout stops once more than --max-failures
+        VMs have failed.
+
+        Returns {VM name: error} for the VMs that failed.
+        """
+        action = self.config['action']
+        if action == 'revert' and not self.config['snapshot']:
+            raise InvalidArgumentError("revert needs --snapshot")
+
+        vms = sorted(self.select_target_vms("roll", properties=[
+            'runtime.host', 'datastore']), key=lambda vm: vm[1]['name'])
+        if not vms:
+            print("No VMs selected")
+            return
+
+        key = None
+        if self.config['group_by']:
+            hosts = dict((host._moId, props) for host, props in
+                         self.retrieve_properties(vim.HostSystem,
+                                                  ['name', 'parent']))
+            clusters = dict()
+            if self.config['group_by'] == 'cluster':
+                clusters = dict(
+                    (cluster._moId, props.get('name')) for cluster, props in
+                    self.retrieve_properties(vim.ClusterComputeResource,
+                                             ['name']))
+
+            def key(vm):
+                host = hosts.get(getattr(vm[1].get('runtime.host'),
+                                         '_moId', None), {})
+                parent = getattr(host.get('parent'), '_moId', None)
+                # standalone hosts are their own cluster
+                return clusters.get(parent) or host.get('name')
+
+        rollout = waves.split(vms, size=self.config['wave_size'],
+                              percent=self.config['wave_percent'], key=key)
+
+        for number, (label, wave) in enumerate(rollout, 1):
+            print("Wave %s/%s%s: %s" % (
+                number, len(rollout), " (%s)" % label if label else "",
+                ", ".join(props['name'] for vm, props in wave)))
+        if self.config['dry_run']:
+            return
 
-        vm = self.get_vm_failfast(self.config['vm'])
-        tasks.append(vm.CreateSnapshot(self.config['name'],
-                                       memory=self.config['memory'],
-                                       quiesce=self.config['quiesce']))
-        result = self.WaitForTasks(tasks)
+        if not self.config['silent']:
+            answer = input("Do you really want to %s these %s VMs ? "
+                           "[yes/no] " % (action, len(vms)))
+            if answer != 'yes':
+                return
+
+        failed = dict()
+        for number, (label, wave) in enumerate(rollout, 1):
+            print("Wave %s/%s: %s %s VMs..." % (number, len(rollout), action,
+                                                len(wave)))
+            started = time.time()
+            errors = self.rolling_wave(action, wave)
+            for name, error in sorted(errors.items()):
+                print("Error: %s: %s" % (name, error))
+            failed.update(errors)
+            print("Wave %s/%s done in %ss, %s failed" % (
+                number, len(rollout), int(time.time() - started),
+                len(errors)))
+
+            if len(failed) > self.config['max_failures']:
+                remaining = sum(len(vms) for label, vms in rollout[number:])
+                print("Error: %s VMs failed (--max-failures %s), aborting "
+                      "with %s VMs left" % (len(failed),
+                                            self.config['max_failures'],
+                                            remaining))
+                break
+
+        return failed
+
+    def rolling_wave(self, action, wave):
+        """
+        Run a rolling action ('shutdown', 'powerOn', 'restart' or
+        'revert' to --snapshot) on one wave of VMs, a list of (vm,
+        {'name': name}), at once, then wait for the powered on guests to
+        satisfy --ready-condition.
+
+        Returns {VM name: error} for the VMs that failed.
+        """
+        errors = dict()
+        vms = [vm for vm, props in wave]
+
+        if action in ('shutdown', 'restart'):
+            errors.update(self.shutdown_vms(
+                vms, self.config['shutdown_timeout']))
+        elif action == 'revert':
+            errors.update(self.revert_vms(vms, self.config['snapshot']))
+
+        if action == 'shutdown':
+            return errors
+
+        vms = [vm for vm, props in wave if props['name'] not in errors]
+        errors.update(self.power_on_vms(vms))
+
+        vms = [vm for vm, props in wave if props['name'] not in errors]
+        if vms:
+            timeout_seconds = self.config['ready_timeout']
+            ready = self.WaitForGuestReady(
+                vms, self.config['ready_condition'], timeout_seconds)
+            names = dict((vm._moId, props['name']) for vm, props in wave)
+            errors.update((names[moid], "not ready after %s seconds"
+                           % timeout_seconds)
+                          for moid in ready if not ready[moid])
+
+        return errors
+
+    def shutdown_vms(self, vms, timeout_seconds):
+        """
+        Shut down the guests of vms at once, powering off those without
+        VMware Tools or still running after timeout_seconds.
+
+        Returns {VM name: error} for the VMs that failed.
+        """
+        errors = dict()
+        guests = list()
+        jobs = list()
+
+        def power_off(vm, props):
+            return Job(vm.PowerOff, description=props['name'],
+                       host=props.get('runtime.host'),
+                       datastores=props.get('datastore', []))
+
+        vm_props = list(self.retrieve_properties(
+            vim.VirtualMachine, ['name', 'runtime.powerState', 'runtime.host',
+                                 'datastore', 'guest.toolsRunningStatus'],
+            objects=vms))
+        for vm, props in vm_props:
+            if props['runtime.powerState'] == \
+                    vim.VirtualMachinePowerState.poweredOff:
+                continue
+            elif props.get('guest.toolsRunningStatus') == \
+                    'guestToolsRunning':
+                try:
+                    vm.ShutdownGuest()
+                    guests.append(vm)
+                    continue
+                except vmodl.MethodFault:
+                    # e.g. tools stopped responding
+                    pass
+            jobs.append(power_off(vm, props))
+
+        if guests:
+            off = self.WaitForPowerState(
+                guests, vim.VirtualMachinePowerState.poweredOff,
+                timeout_seconds)
+            for vm, props in vm_props:
+                if vm in guests and not off[vm._moId]:
+                    print("%s has not shutdown after %s seconds: will "
+                          "powerOff" % (props['name'], timeout_seconds))
+                    jobs.append(power_off(vm, props))
+
+        for job, fault in self.run_tasks(jobs, raise_on_error=False):
+            errors[job.description] = fault.msg or type(fault).__name__
+        return errors
+
+    def power_on_vms(self, vms):
+        """
+        Power on those of vms that are off, at once.
+
+        Returns {VM name: error} for the VMs that failed.
+        """
+        jobs = list()
+        for vm, props in self.retrieve_properties(
+                vim.VirtualMachine, ['name', 'runtime.powerState',
+                                     'runtime.host', 'datastore'],
+                objects=vms):
+            if props['runtime.powerState'] != \
+                    vim.VirtualMachinePowerState.poweredOn:
+                jobs.append(Job(vm.PowerOn, description=props['name'],
+                                host=props.get('runtime.host'),
+                                datastores=props.get('datastore', [])))
+
+        return dict((job.description, fault.msg or type(fault).__name__)
+                    for job, fault in self.run_tasks(jobs,
+                                                     raise_on_error=False))
+
+    def revert_vms(self, vms, snapshot_name):
+        """
+        Revert each of vms to its snapshot named snapshot_name, at once.
+
+        Returns {VM name: error} for the VMs that failed.
+        """
+        errors = dict()
+        jobs = list()
+        for vm, props in self.retrieve_properties(
+                vim.VirtualMachine, ['name', 'snapshot', 'runtime.host',
+                                     'datastore'], objects=vms):
+            info = props.get('snapshot')
+            snapshots = [tree.snapshot for tree in
+                         self.get_snapshots_recursive(
+                             info.rootSnapshotList if info else [])
+                         if tree.name == snapshot_name]
+            if not snapshots:
+                errors[props['name']] = "no snapshot named '%s'" \
+                    % snapshot_name
+                continue
+            jobs.append(Job(
+                lambda snapshot=snapshots[0]: snapshot.Revert(),
+                description=props['name'],
+                host=props.get('runtime.host'),
+                datastores=props.get('datastore', [])))
+
+        for job, fault in self.run_tasks(jobs, raise_on_error=False):
+            errors[job.description] = fault.msg or type(fault).__name__
+        return errors
+
+    def createSnapshot(self):
+        vm = self.get_target_vm('vm')
+        self.create_snapshot(vm, self.config['name'],
+                             memory=self.config['memory'],
+                             quiesce=self.config['quiesce'])
         print("Created snapshot for %s" % vm.name)
 
+    def create_snapshot(self, vm, name, memory=False, quiesce=False):
+        """
+        Snapshot vm (a VirtualMachine or its name), returns a dict with
+        the snapshot's vm, name and moid
+        """
+        vm = self.resolve_vm(vm)
+        job = self.vm_job(vm, "CreateSnapshot",
+                          lambda: vm.CreateSnapshot(name, memory=memory,
+                                                    quiesce=quiesce))
+        self.run_tasks([job])
+        return OrderedDict([('vm', vm.name), ('name', name),
+                            ('moid', job.task.info.result._moId)])
+
+    def remove_snapshot(self, vm, name, remove_children=False,
+                        consolidate=True):
+        """
+        Remove snapshot name of vm (a VirtualMachine or its name), returns
+        a dict with the snapshot's vm and name
+        """
+        vm = self.resolve_vm(vm)
+        snapshot = self.get_snapshot_by_name(vm, name)
+        self.run_tasks([self.vm_job(
+            vm, "RemoveSnapshot",
+            lambda: snapshot.Remove(remove_children, consolidate))])
+        return OrderedDict([('vm', vm.name), ('name', name)])
+
+    def revert_snapshot(self, vm, name, host=None, suppress_power_on=False):
+        """
+        Revert vm (a VirtualMachine or its name) to snapshot name, on host
+        (a HostSystem or its name, default: the VM's current host).
+        Returns a dict with the snapshot's vm and name.
+        """
+        vm = self.resolve_vm(vm)
+        snapshot = self.get_snapshot_by_name(vm, name)
+        if not host:
+            host_system = vm.runtime.host
+        elif isinstance(host, six.string_types):
+            host_system = self.get_host_system_failfast(host)
+        else:
+            host_system = host
+
+        self.run_tasks([Job(
+            lambda: snapshot.Revert(host=host_system,
+                                    suppressPowerOn=suppress_power_on),
+            description="RevertSnapshot %s" % vm.name,
+            host=host_system)])
+        return OrderedDict([('vm', vm.name), ('name', name)])
+
+    def list_snapshots(self, vm):
+        """
+        Snapshots of vm (a VirtualMachine or its name), parents first, as
+        a list of dicts with their name, description, create_time, state
+        and moid
+        """
+        vm = self.resolve_vm(vm)
+        return [OrderedDict([('name', snapshot.name),
+                             ('description', snapshot.description),
+                             ('create_time', snapshot.createTime),
+                             ('state', snapshot.state),
+                             ('moid', snapshot.snapshot._moId)])
+                for snapshot in self.get_all_snapshots(vm) or []]
+
     def get_snapshots_recursive(self, snap_tree):
         local_snap = []
         for snap in snap_tree:
@@ -596,8 +1885,8 @@ class EZMomi(object):
                 local_snap.extend(recurse_snap)
         return local_snap
 
-    def get_all_snapshots(self, vm_name):
-        vm = self.get_vm_failfast(vm_name)
+    def get_all_snapshots(self, vm):
+        vm = self.resolve_vm(vm)
 
         try:
             vm_snapshot_info = vm.snapshot
@@ -610,9 +1899,13 @@ class EZMomi(object):
                 )
 
     def get_snapshot_by_name(self, vm, name):
-        return next(snapshot.snapshot for snapshot in
-                    self.get_all_snapshots(vm) if
-                    snapshot.name == name)
+        vm = self.resolve_vm(vm)
+        for snapshot in self.get_all_snapshots(vm) or []:
+            if snapshot.name == name:
+                return snapshot.snapshot
+
+        raise NotFoundError("Snapshot '%s' of %s does not exist"
+                            % (name, vm.name))
 
     def print_as_table(self, data):
         column_widths = []
@@ -651,89 +1944,252 @@ class EZMomi(object):
                 sys.stdout.write(str(data[row][index]))
                 sys.stdout.write("=")
             sys.stdout.write(str(data[rowNr - 1][index]))
-            print
+            print()
+
+    def output_format(self):
+        """Output format chosen with --output, defaults to table"""
+        return self.config.get('output') or 'table'
+
+    def print_rows(self, header, rows):
+        """
+        Print rows (any iterable of lists, in header's column order) in the
+        format chosen with --output.  ndjson and csv are written and
+        flushed one row at a time so large results can be piped as they
+        are retrieved; table and json need every row before printing.
+        """
+        output = self.output_format()
+
+        if output == 'ndjson':
+            for row in rows:
+                print(json.dumps(dict(zip(header, row)),
+                                 default=self.to_json))
+                sys.stdout.flush()
+        elif output == 'csv':
+            writer = csv.writer(sys.stdout)
+            writer.writerow(header)
+            for row in rows:
+                writer.writerow([self.to_cell(value) for value in row])
+                sys.stdout.flush()
+        elif output == 'json':
+            print(json.dumps([dict(zip(header, row)) for row in rows],
+                             default=self.to_json, indent=2))
+        else:
+            self.print_as_table([header] + [[str(self.to_cell(value))
+                                             for value in row]
+                                            for row in rows])
+
+    def to_cell(self, value):
+        """Flatten a value into a single table or csv cell"""
+        if value is None:
+            return ''
+        elif isinstance(value, six.string_types + (int, float)):
+            return value
+        elif hasattr(value, '_moId') or isinstance(value, datetime.date):
+            return self.to_json(value)
+        return json.dumps(value, default=self.to_json)
+
+    def to_json(self, obj):
+        """
+        json.dumps default hook for vSphere values: managed objects become
+        their MOID and datetimes become ISO 8601 strings
+        """
+        if hasattr(obj, '_moId'):
+            # managed object reference
+            return obj._moId
+        elif hasattr(obj, '_propList'):
+            # data object, e.g. a GuestNicInfo
+            return dict((prop.name, getattr(obj, prop.name))
+                        for prop in obj._propList
+                        if getattr(obj, prop.name) is not None)
+        elif isinstance(obj, (datetime.datetime, datetime.date)):
+            return obj.isoformat()
+        return str(obj)
 
     def listSnapshots(self):
-        root_snapshot_list = self.get_all_snapshots(self.config['vm'])
+        vm = self.get_target_vm('vm')
+        root_snapshot_list = self.list_snapshots(vm)
 
         if root_snapshot_list:
             snapshots = []
             for snapshot in root_snapshot_list:
-                snapshots.append([str(snapshot.vm), snapshot.name,
-                                  str(snapshot.createTime)])
+                snapshots.append([vm.name, vm._moId, snapshot['name'],
+                                  snapshot['create_time']])
 
-            data = [['VM', 'Snapshot', 'Create Time']] + snapshots
-            self.print_as_table(data)
+            self.print_rows(['VM', 'MOID', 'Snapshot', 'Create Time'],
+                            snapshots)
         else:
-            print("No snapshots for %s" % self.config['vm'])
+            print("No snapshots for %s" % vm.name)
 
     def removeSnapshot(self):
-        tasks = []
-
-        snapshot = self.get_snapshot_by_name(self.config['vm'],
-                                             self.config['name'])
-        tasks.append(snapshot.Remove(self.config['remove_children'],
-                                     self.config['consolidate']))
-        result = self.WaitForTasks(tasks)
+        vm = self.get_target_vm('vm')
+        self.remove_snapshot(vm, self.config['name'],
+                             remove_children=self.config['remove_children'],
+                             consolidate=self.config['consolidate'])
         print("Removed snapshot %s for virtual machine %s" %
-              (self.config['name'], self.config['vm']))
+              (self.config['name'], vm.name))
 
     def revertSnapshot(self):
-        tasks = []
-        snapshot = self.get_snapshot_by_name(self.config['vm'],
-                                             self.config['name'])
-        if self.config['host']:
-            host = self.config['host']
-        else:
-            vm = self.get_vm_failfast(self.config['vm'])
-            host = vm.runtime.host.name
-        host_system = self.get_host_system_failfast(host)
-
-        tasks.append(
-            snapshot.Revert(host=host_system,
-                            suppressPowerOn=self.config['suppress_power_on'])
-        )
-        result = self.WaitForTasks(tasks)
+        vm = self.get_target_vm('vm')
+        self.revert_snapshot(
+            vm, self.config['name'], host=self.config['host'],
+            suppress_power_on=self.config['suppress_power_on'])
         print("Reverted snapshot %s for virtual machine %s" %
-              (self.config['name'], self.config['vm']))
+              (self.config['name'], vm.name))
 
     def powerOff(self):
-        vm = self.get_vm_failfast(self.config['name'])
+        vm = self.get_target_vm()
 
         if vm.runtime.powerState == vim.VirtualMachinePowerState.poweredOff:
             print("%s already poweredOff" % vm.name)
         else:
-            tasks = list()
-            tasks.append(vm.PowerOff())
-            result = self.WaitForTasks(tasks)
+            self.run_tasks([self.vm_job(vm, "PowerOff", vm.PowerOff)])
             print("%s poweredOff" % vm.name)
 
     def powerOn(self):
-        vm = self.get_vm_failfast(self.config['name'])
+        vm = self.get_target_vm()
 
         if vm.runtime.powerState == vim.VirtualMachinePowerState.poweredOn:
             print("%s already poweredOn" % vm.name)
         else:
-            tasks = list()
-            tasks.append(vm.PowerOn())
-            result = self.WaitForTasks(tasks)
+            self.run_tasks([self.vm_job(vm, "PowerOn", vm.PowerOn)])
             print("%s poweredOn" % vm.name)
 
+        if self.config['wait_ready']:
+            self.wait_ready([vm])
+
     def syncTimeWithHost(self):
-        vm = self.get_vm_failfast(self.config['name'])
+        vm = self.get_target_vm()
         flag = self.config['value']
 
-        if vm.config.tools.syncTimeWithHost == flag:
+        result = self.reconfigure_vms(
+            [vm], {'tools.syncTimeWithHost': flag}, raise_on_error=True)[0]
+        if result['result'] == 'compliant':
             print("%s syncTimeWithHost already %s" % (vm.name, str(flag)))
         else:
-            spec = vim.vm.ConfigSpec()
-            spec.tools = vim.vm.ToolsConfigInfo()
-            spec.tools.syncTimeWithHost = flag
-
-            task = vm.ReconfigVM_Task(spec)
-            result = self.WaitForTasks([task])
             print("%s syncTimeWithHost %s" % (vm.name, str(flag)))
 
+    def reconfigure(self):
+        """
+        Command Section: reconfigure
+        Apply a declarative configuration change to the selected VMs,
+        skipping those already compliant
+
+        Returns the results (see reconfigure_vms) of the VMs that failed.
+        """
+        changes = dict()
+        if self.config['spec']:
+            try:
+                with open(self.config['spec']) as f:
+                    changes.update(yaml.safe_load(f))
+            except (IOError, TypeError, ValueError, yaml.YAMLError) as e:
+                raise InvalidArgumentError(
+                    "Unable to read spec file %s, it must be a mapping of "
+                    "ConfigSpec paths to values: %s" % (self.config['spec'],
+                                                        e))
+        for change in self.config['change']:
+            path, sep, value = change.partition('=')
+            if not sep:
+                raise InvalidArgumentError("--change takes path=value, not "
+                                           "%s" % change)
+            if path.startswith(configspec.EXTRA_CONFIG):
+                # advanced settings are strings, keep them verbatim
+                changes[path] = value
+            else:
+                changes[path] = yaml.safe_load(value)
+        if not changes:
+            raise InvalidArgumentError("no changes given, use --spec or "
+                                       "--change")
+
+        vms = self.select_target_vms("reconfigure")
+        if not vms:
+            print("No VMs selected")
+            return
+
+        if self.config['concurrency']:
+            self.scheduler.set_max_inflight(self.config['concurrency'])
+
+        results = self.reconfigure_vms([vm for vm, props in vms], changes,
+                                       dry_run=self.config['dry_run'])
+
+        def rows():
+            for result in results:
+                yield [result['name'], result['result'],
+                       ", ".join("%s: %s -> %s" % (path, old, new)
+                                 for path, (old, new) in
+                                 sorted(result['changes'].items())),
+                       result['error']]
+
+        self.print_rows(['VM', 'Result', 'Changes', 'Error'], rows())
+
+        return [result for result in results if result['result'] == 'failed']
+
+    def reconfigure_vms(self, vms, changes, dry_run=False,
+                        raise_on_error=False):
+        """
+        Apply changes, a dict of ConfigSpec property paths to values (see
+        configspec.parse_changes), to vms (VirtualMachines or names).
+        Current values are fetched for all VMs at once and a ReconfigVM
+        task, holding only the differing settings, is submitted for each
+        VM that doesn't already comply.
+
+        Returns a dict per VM with its name, moid, result ('compliant',
+        'planned' with dry_run, 'reconfigured' or 'failed'), changes as
+        {path: (current value, new value)} and error.
+        """
+        try:
+            changes = configspec.parse_changes(changes)
+        except ValueError as e:
+            raise InvalidArgumentError(str(e))
+
+        vms = [self.resolve_vm(vm) for vm in vms]
+        paths = ['name', 'runtime.host', 'datastore'] + \
+            configspec.property_paths(changes)
+
+        results = list()
+        jobs = list()
+        try:
+            retrieved = list(self.retrieve_properties(
+                vim.VirtualMachine, paths, objects=vms))
+        except vmodl.query.InvalidProperty as e:
+            raise InvalidArgumentError("%s can't be compared, it is not a "
+                                       "VirtualMachine property" % e.name)
+
+        for vm, props in retrieved:
+            result = OrderedDict([
+                ('name', props.get('name')),
+                ('moid', vm._moId),
+                ('result', 'compliant'),
+                ('changes', configspec.diff(changes, props)),
+                ('error', None),
+            ])
+            results.append(result)
+
+            if not result['changes']:
+                continue
+            elif dry_run:
+                result['result'] = 'planned'
+                continue
+
+            def on_done(task, result=result):
+                result['result'] = 'reconfigured'
+
+            spec = configspec.build_spec(dict(
+                (path, new) for path, (old, new) in
+                result['changes'].items()))
+            job = Job(lambda vm=vm, spec=spec: vm.ReconfigVM_Task(spec),
+                      description="Reconfigure %s" % result['name'],
+                      host=props.get('runtime.host'),
+                      datastores=props.get('datastore', []),
+                      on_done=on_done)
+            job.result = result
+            jobs.append(job)
+
+        for job, fault in self.run_tasks(jobs, raise_on_error=raise_on_error):
+            job.result['result'] = 'failed'
+            job.result['error'] = fault.msg or type(fault).__name__
+
+        return results
+
     '''
      Helper methods
     '''
@@ -802,17 +2258,50 @@ class EZMomi(object):
 
     def get_obj(self, vimtype, name, return_all=False, path=""):
         """Get the vsphere object associated with a given text name or MOID"""
+        if self.cache_names and not path and not return_all and \
+                len(vimtype) == 1:
+            obj = self.name_index(vimtype[0]).get(name)
+            try:
+                # catch renames and removals since the index was built
+                if obj is not None and obj.name == name:
+                    return obj
+            except vmodl.fault.ManagedObjectNotFound:
+                pass
+            if obj is not None:
+                self.forget_names(vimtype[0])
+
         obj = list()
-        if path:
-            obj_folder = self.content.searchIndex.FindByInventoryPath(path)
-            container = self.content.viewManager.CreateContainerView(
-                obj_folder, vimtype, True
-            )
-        else:
-            container = self.content.viewManager.CreateContainerView(
-                self.content.rootFolder, vimtype, True)
+        while True:
+            session = self.retrier.session
+            if path:
+                obj_folder = \
+                    self.content.searchIndex.FindByInventoryPath(path)
+                if obj_folder is None:
+                    raise NotFoundError("folder '%s' does not exist" % path)
+
+                if not return_all:
+                    # direct children can be looked up server side
+                    child = self.content.searchIndex.FindChild(obj_folder,
+                                                               name)
+                    if child is not None and \
+                            isinstance(child, tuple(vimtype)):
+                        return child
+
+                container = self.get_container_view(obj_folder, vimtype)
+            else:
+                container = self.get_container_view(
+                    self.content.rootFolder, vimtype)
 
-        for c in container.view:
+            try:
+                view = container.view
+                break
+            except vmodl.fault.ManagedObjectNotFound:
+                # the cached view went with an expired session, login()
+                # dropped it so the next one is new
+                if not self.relogged_in(session):
+                    raise
+
+        for c in view:
             if name in [c.name, c._GetMoId()]:
                 if return_all is False:
                     return c
@@ -826,6 +2315,228 @@ class EZMomi(object):
             # for backwards-compat
             return None
 
+    def name_index(self, vimtype):
+        """
+        {name: object} for every object of vimtype, retrieved in one
+        request.  With cache_names set, the index is kept for the session
+        and get_obj looks names up in it, checking the one object found
+        instead of scanning every object's name.
+        """
+        key = vimtype._wsdlName
+        index = self._names.get(key)
+        if index is None:
+            index = dict((props['name'], obj) for obj, props in
+                         self.retrieve_properties(vimtype, ['name'])
+                         if 'name' in props)
+            if self.cache_names:
+                self._names[key] = index
+        return index
+
+    def forget_names(self, vimtype=None):
+        """Drop the name index of vimtype, or of every type"""
+        if vimtype is None:
+            self._names.clear()
+        else:
+            self._names.pop(vimtype._wsdlName, None)
+
+    def retrieve_properties(self, vimtype, path_set, root=None,
+                            page_size=1000, objects=None):
+        """
+        Fetch the property paths in path_set for every object of vimtype
+        under root (default: the root folder), or for the given objects,
+        in one PropertyCollector retrieval, paged page_size objects at a
+        time.
+
+        Yields (object, {property path: value}) as each page arrives.
+        Unset properties are missing from the dict.
+
+        If the session expires part way, the view and paging token go with
+        it: the retrieval starts over in the new session, skipping the
+        objects already yielded.
+        """
+        if objects is not None and not objects:
+            return
+
+        yielded = set()
+        while True:
+            session = self.retrier.session
+            pages = self.retrieve_pages(vimtype, path_set, root, page_size,
+                                        objects)
+            try:
+                for obj, props in pages:
+                    if obj._moId not in yielded:
+                        yielded.add(obj._moId)
+                        yield obj, props
+                return
+            except vmodl.MethodFault:
+                if not self.relogged_in(session):
+                    raise
+            finally:
+                # cancels the paging token if the consumer stopped early
+                pages.close()
+
+    def retrieve_pages(self, vimtype, path_set, root, page_size, objects):
+        """One paged retrieval for retrieve_properties"""
+        pc = self.content.propertyCollector
+        if objects is not None:
+            objSpecs = [vmodl.query.PropertyCollector.ObjectSpec(obj=obj)
+                        for obj in objects]
+        else:
+            container = self.get_container_view(
+                root or self.content.rootFolder, [vimtype])
+            objSpecs = [self.view_object_spec(container)]
+
+        propSpec = vmodl.query.PropertyCollector.PropertySpec(
+            type=vimtype, pathSet=list(path_set), all=False)
+        filterSpec = vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=objSpecs, propSet=[propSpec])
+        options = vmodl.query.PropertyCollector.RetrieveOptions(
+            maxObjects=page_size)
+
+        token = None
+        try:
+            result = pc.RetrievePropertiesEx([filterSpec], options)
+            while result:
+                token = result.token
+                for obj in result.objects:
+                    yield obj.obj, dict((prop.name, prop.val)
+                                        for prop in obj.propSet)
+                if not token:
+                    break
+                result = pc.ContinueRetrievePropertiesEx(token)
+                token = None
+        finally:
+            if token:
+                # consumer stopped before the last page
+                try:
+                    pc.CancelRetrievePropertiesEx(token)
+                except vmodl.MethodFault:
+                    # the token went with an expired session
+                    pass
+
+    def select_vms(self, names=(), globs=(), folder="", properties=()):
+        """
+        Select VMs by name or MOID, by name pattern, and/or by folder
+        inventory path with a single property retrieval.  With only a
+        folder, every VM under it is selected.
+
+        Returns a list of (vm, {property path: value}) including 'name'.
+        """
+        if not (names or globs or folder):
+            raise InvalidArgumentError("select VMs by name, pattern or "
+                                       "folder")
+
+        root = None
+        if folder:
+            root = self.content.searchIndex.FindByInventoryPath(folder)
+            if root is None:
+                raise NotFoundError("folder '%s' does not exist" % folder)
+
+        names = set(names)
+        found = set()
+        selected = list()
+        for vm, props in self.retrieve_properties(
+                vim.VirtualMachine, ['name'] + list(properties), root=root):
+            name = props.get('name')
+            if name in names or vm._moId in names:
+                found.update([name, vm._moId])
+            elif not any(fnmatch.fnmatchcase(name, g) for g in globs) and \
+                    (names or globs):
+                continue
+            selected.append((vm, props))
+
+        missing = names - found
+        if missing:
+            raise NotFoundError("VM '%s' does not exist"
+                                % "', '".join(sorted(missing)))
+
+        return selected
+
+    def select_target_vms(self, action, properties=()):
+        """
+        select_vms() for the VMs chosen on the command line with --name
+        (a name, MOID or inventory path), --uuid, --ip, --dns-name, --glob
+        and --folder
+        """
+        selectors = ('name', 'uuid', 'ip', 'dns_name', 'glob', 'folder')
+        if not any(self.config[selector] for selector in selectors):
+            raise InvalidArgumentError(
+                "select VMs to %s with --name, --uuid, --ip, --dns-name, "
+                "--glob or --folder" % action)
+
+        # VMs found through the SearchIndex are selected by MOID
+        moids = list()
+        for selector in ('uuid', 'ip', 'dns_name'):
+            for value in self.config[selector]:
+                vms = self.find_vms(**{selector + 's': [value]})
+                if not vms:
+                    raise NotFoundError("VM with %s '%s' does not exist"
+                                        % (selector.replace('_', ' '),
+                                           value))
+                moids.extend(vm._moId for vm in vms)
+        names = list()
+        for name in self.config['name']:
+            if name.startswith('/'):
+                # inventory path, e.g. /DC/vm/folder/name
+                moids.append(self.get_vm_failfast(name)._moId)
+            else:
+                names.append(name)
+
+        return self.select_vms(
+            names=names + moids,
+            globs=self.config['glob'],
+            folder=self.config['folder'],
+            properties=properties)
+
+    def relogged_in(self, session):
+        """
+        Whether the session expired and the retry layer logged in again
+        since session, a value of retrier.session
+        """
+        return self.retrier.session != session
+
+    def get_container_view(self, root, vimtypes):
+        """
+        ContainerView of vimtypes under root.  One view is created per
+        (root, types) and reused for every lookup in this session; the least
+        recently used view is destroyed once more than max_views are open,
+        and all of them on exit.
+        """
+        key = (root._moId, tuple(sorted(t._wsdlName for t in vimtypes)))
+
+        with self._views_lock:
+            view = self._views.pop(key, None)
+            if view is None:
+                view = self.content.viewManager.CreateContainerView(
+                    root, vimtypes, True)
+                while len(self._views) >= self.config.get('max_views', 16):
+                    self._views.popitem(last=False)[1].DestroyView()
+            # most recently used last
+            self._views[key] = view
+
+        return view
+
+    def destroy_views(self):
+        """Destroy every ContainerView created by get_container_view"""
+        with self._views_lock:
+            while self._views:
+                try:
+                    self._views.popitem()[1].DestroyView()
+                except Exception:
+                    # the session may already be gone
+                    pass
+
+    def view_object_spec(self, container):
+        """
+        ObjectSpec selecting every object in a ContainerView, but not the
+        view itself
+        """
+        traversal = vmodl.query.PropertyCollector.TraversalSpec(
+            name='traverseView', path='view', skip=False,
+            type=vim.view.ContainerView)
+        return vmodl.query.PropertyCollector.ObjectSpec(
+            obj=container, skip=True, selectSet=[traversal])
+
     def get_host_system(self, name):
         return self.get_obj([vim.HostSystem], name)
 
@@ -845,8 +2556,8 @@ class EZMomi(object):
         hs = self.get_host_system(name)
 
         if hs is None:
-            print("Error: %s '%s' does not exist" % (host_system_term, name))
-            sys.exit(1)
+            raise NotFoundError("%s '%s' does not exist"
+                                % (host_system_term, name))
 
         if verbose:
             print("Found HostSystem: {0} Name: {1}" % (hs, hs.name))
@@ -855,7 +2566,11 @@ class EZMomi(object):
 
     def get_vm(self, name, path=""):
         """Get a VirtualMachine object"""
-        if path:
+        if name.startswith('/'):
+            # inventory path, e.g. /DC/vm/folder/name
+            vm = self.content.searchIndex.FindByInventoryPath(name)
+            return vm if isinstance(vm, vim.VirtualMachine) else None
+        elif path:
             return self.get_obj([vim.VirtualMachine], name, path=path)
         else:
             return self.get_obj([vim.VirtualMachine], name)
@@ -872,14 +2587,116 @@ class EZMomi(object):
         else:
             vm = self.get_vm(name)
         if vm is None:
-            print("Error: %s '%s' does not exist" % (vm_term, name))
-            sys.exit(1)
+            raise NotFoundError("%s '%s' does not exist" % (vm_term, name))
 
         if verbose:
             print("Found VirtualMachine: %s Name: %s" % (vm, vm.name))
 
         return vm
 
+    def resolve_vm(self, vm):
+        """VirtualMachine for vm, either one already or a VM name"""
+        if isinstance(vm, six.string_types):
+            return self.get_vm_failfast(vm)
+        return vm
+
+    def wait_ready(self, vms):
+        """
+        Wait for the guests of the given VMs to satisfy --ready-condition,
+        raise GuestNotReadyError if any of them time out
+        """
+        condition = self.config['ready_condition']
+        timeout_seconds = self.config['ready_timeout']
+
+        names = self.vm_names(vms)
+        print("waiting for %s to be ready (condition: %s, timeout: %ss)" % (
+            ", ".join(names[vm._moId] for vm in vms), condition,
+            timeout_seconds
+        ))
+
+        def on_ready(name, props):
+            print("%s ready (%s)" % (
+                name,
+                props.get('guest.ipAddress') or
+                props['guest.toolsRunningStatus']
+            ))
+
+        ready = self.WaitForGuestReady(vms, condition, timeout_seconds,
+                                       on_ready=on_ready)
+
+        not_ready = [names[moid] for moid in ready if not ready[moid]]
+        if not_ready:
+            raise GuestNotReadyError(not_ready, timeout_seconds)
+
+    def guestReady(self, props, condition):
+        """
+        Evaluate a readiness condition against a VM's guest properties
+        as collected by WaitForGuestReady
+        """
+        if props.get('guest.toolsRunningStatus') != 'guestToolsRunning':
+            return False
+
+        if condition == 'tools':
+            return True
+        elif condition == 'ip':
+            return bool(props.get('guest.ipAddress'))
+        elif condition == 'net':
+            nics = [nic for nic in props.get('guest.net') or []
+                    if nic.connected]
+            return bool(nics) and all(nic.ipAddress for nic in nics)
+
+        raise ValueError("Unknown readiness condition '%s'" % condition)
+
+    def get_target_vm(self, name_key='name'):
+        """
+        Get the VirtualMachine selected on the command line with
+        --name (or name_key), --uuid, --ip or --dns-name; raise if it
+        doesn't exist or the ip or DNS name matches several VMs.  UUID,
+        IP and DNS name lookups are a single SearchIndex call instead of
+        an inventory scan.
+        """
+        for selector in ('uuid', 'ip', 'dns_name'):
+            if self.config.get(selector):
+                vms = self.find_vms(**{selector + 's':
+                                       [self.config[selector]]})
+                if not vms:
+                    raise NotFoundError("VM with %s '%s' does not exist"
+                                        % (selector.replace('_', ' '),
+                                           self.config[selector]))
+                if len(set(vm._moId for vm in vms)) > 1:
+                    names = self.vm_names(vms)
+                    raise InvalidArgumentError(
+                        "%s '%s' matches several VMs: %s"
+                        % (selector.replace('_', ' '), self.config[selector],
+                           ", ".join("%s (%s)" % (names.get(moid), moid)
+                                     for moid in sorted(names))))
+                return vms[0]
+
+        return self.get_vm_failfast(self.config[name_key])
+
+    def find_vms(self, uuids=(), ips=(), dns_names=()):
+        """
+        Find VMs by BIOS or instance UUID, IP address or DNS name through
+        the SearchIndex.  Every VM reporting a given IP or DNS name is
+        returned.
+        """
+        search_index = self.content.searchIndex
+        vms = list()
+
+        for uuid in uuids:
+            vm = search_index.FindByUuid(uuid=uuid, vmSearch=True) or \
+                search_index.FindByUuid(uuid=uuid, vmSearch=True,
+                                        instanceUuid=True)
+            if vm is not None:
+                vms.append(vm)
+        for ip in ips:
+            vms += search_index.FindAllByIp(ip=ip, vmSearch=True)
+        for dns_name in dns_names:
+            vms += search_index.FindAllByDnsName(dnsName=dns_name,
+                                                 vmSearch=True)
+
+        return vms
+
     def guestToolsRunning(self, vm):
         """simple helper to avoid potential typos on the string comparison"""
         return 'guestToolsRunning' == vm.guest.toolsRunningStatus
@@ -887,72 +2704,1044 @@ class EZMomi(object):
     def WaitForTasks(self, tasks):
         """
         Given the service instance si and tasks, it returns after all the
-        tasks are complete
+        tasks are complete, raises TaskError if one fails
         """
-        pc = self.si.content.propertyCollector
+        self.run_tasks([Job(lambda task=task: task, description=str(task))
+                        for task in tasks])
 
-        taskList = [str(task) for task in tasks]
+    def vm_job(self, vm, description, submit, **kwargs):
+        """
+        Job for a task on vm, placed on the VM's current host and
+        datastores for the scheduler's caps
+        """
+        return Job(submit, description="%s %s" % (description, vm.name),
+                   host=vm.runtime.host, datastores=vm.datastore, **kwargs)
 
-        # Create filter
-        objSpecs = [vmodl.query.PropertyCollector.ObjectSpec(
-            obj=task) for task in tasks]
-        propSpec = vmodl.query.PropertyCollector.PropertySpec(
-            type=vim.Task, pathSet=[], all=True)
-        filterSpec = vmodl.query.PropertyCollector.FilterSpec()
-        filterSpec.objectSet = objSpecs
-        filterSpec.propSet = [propSpec]
-        filter = pc.CreateFilter(filterSpec, True)
+    def run_tasks(self, jobs, raise_on_error=True):
+        """
+        Submit jobs (see scheduler.Job) when the task scheduler allows it
+        and wait for them, and any follow-up jobs returned by their on_done
+        callbacks, to complete.  Jobs failing with busy faults are
+        resubmitted after backing off.  Every attempt is recorded in the
+        task journal.
+
+        With raise_on_error a TaskError is raised for the first failure,
+        otherwise a list of (job, fault) is returned for every job that
+        failed.
+        """
+        scheduler = self.scheduler
+        pending = list(jobs)
+        inflight = dict()
+        failures = list()
+
+        # a private collector, so versions don't interfere with other
+        # filters in this session
+        session = self.retrier.session
+        collector = \
+            self.si.content.propertyCollector.CreatePropertyCollector()
+
+        def watch(task):
+            filterSpec = vmodl.query.PropertyCollector.FilterSpec(
+                objectSet=[vmodl.query.PropertyCollector.ObjectSpec(
+                    obj=task)],
+                propSet=[vmodl.query.PropertyCollector.PropertySpec(
+                    type=vim.Task, pathSet=TASK_PROPERTIES)])
+            return collector.CreateFilter(filterSpec, True)
+
+        def failed(job, fault, info=None):
+            scheduler.finished(job, success=False)
+            self.journal_task(job, info, fault)
+            if scheduler.retryable(job, fault):
+                if self.debug:
+                    self.print_debug("%s busy, resubmitting"
+                                     % job.description, fault)
+                scheduler.congested()
+                pending.append(job)
+            elif raise_on_error:
+                raise TaskError(job.description, fault)
+            else:
+                failures.append((job, fault))
+
+        try:
+            version = None
+
+            while pending or inflight:
+                try:
+                    # submit everything the scheduler allows right now
+                    for job in list(pending):
+                        if not scheduler.can_submit():
+                            break
+                        if not scheduler.fits(job):
+                            continue
+
+                        pending.remove(job)
+                        scheduler.started(job)
+                        try:
+                            job.task = job.submit()
+                        except vmodl.MethodFault as fault:
+                            job.task = None
+                            failed(job, fault)
+                            continue
+                        except BaseException:
+                            # e.g. a connection error, not retried for
+                            # submissions: give the slot back
+                            job.task = None
+                            scheduler.finished(job, success=False)
+                            raise
+
+                        # tracked before the filter is made, so it is
+                        # watched again if the session expired meanwhile
+                        inflight[job.task._moId] = (job, None, {})
+                        inflight[job.task._moId] = (job, watch(job.task), {})
+
+                    if not inflight:
+                        time.sleep(scheduler.delay())
+                        continue
+
+                    if pending and scheduler.delay():
+                        wait = max(1, int(scheduler.delay() + 1))
+                    else:
+                        wait = 60
+                    options = vmodl.query.PropertyCollector.WaitOptions(
+                        maxWaitSeconds=wait)
+                    update = collector.WaitForUpdatesEx(version, options)
+                except vmodl.MethodFault:
+                    if not self.relogged_in(session):
+                        raise
+                    # the collector and its filters went with the expired
+                    # session, the tasks did not: watch them again
+                    session = self.retrier.session
+                    collector = self.si.content.propertyCollector\
+                        .CreatePropertyCollector()
+                    for moid, (job, filter, info) in list(inflight.items()):
+                        inflight[moid] = (job, watch(job.task), info)
+                    version = None
+                    continue
+
+                if update is None:
+                    continue
+
+                for filterSet in update.filterSet:
+                    for objSet in filterSet.objectSet:
+                        moid = objSet.obj._moId
+                        if moid not in inflight:
+                            continue
+                        job, filter, info = inflight[moid]
+                        info.update((change.name, change.val)
+                                    for change in objSet.changeSet)
+                        state = info.get('info.state')
+
+                        if state == vim.TaskInfo.State.queued:
+                            if any(change.name == 'info.state'
+                                   for change in objSet.changeSet):
+                                # vCenter is queueing our tasks
+                                scheduler.congested()
+                            continue
+                        elif state not in (vim.TaskInfo.State.success,
+                                           vim.TaskInfo.State.error):
+                            continue
+
+                        try:
+                            filter.Destroy()
+                        except vmodl.MethodFault:
+                            # gone with an expired session
+                            pass
+                        del inflight[moid]
+
+                        if state == vim.TaskInfo.State.success:
+                            scheduler.finished(job)
+                            self.journal_task(job, info)
+                            if job.on_done:
+                                pending.extend(job.on_done(job.task) or [])
+                        else:
+                            failed(job, info.get('info.error') or
+                                   job.task.info.error, info)
+                # Move to next version
+                version = update.version
+        finally:
+            # tasks we stop waiting for, on an error, must not keep their
+            # slots in the scheduler
+            for job, filter, info in inflight.values():
+                scheduler.finished(job, success=False)
+            try:
+                collector.DestroyPropertyCollector()
+            except vmodl.MethodFault:
+                pass
+
+        return failures
+
+    def journal_task(self, job, info=None, fault=None):
+        """
+        Record a finished job attempt, with the queue and run times
+        vCenter reported for its task (info, from run_tasks), in the task
+        journal.  The journal is kept at journal_db from config.yml
+        (default: ~/.config/ezmomi/journal.db); set journal: false to turn
+        it off.
+        """
+        if self.config.get('journal') is False:
+            return
+        info = info or {}
+
+        def seconds(start, end):
+            if start is None or end is None:
+                return None
+            return (end - start).total_seconds()
+
+        try:
+            if self._journal is None:
+                self._journal = journal.connect(
+                    self.config.get('journal_db') or journal.default_path())
+            if self._placement_names is None:
+                try:
+                    self._placement_names = dict(
+                        (obj._moId, props.get('name'))
+                        for vimtype in (vim.HostSystem, vim.Datastore)
+                        for obj, props in self.retrieve_properties(
+                            vimtype, ['name']))
+                except vmodl.MethodFault as e:
+                    # journal host and datastore MOIDs this time
+                    if self.debug:
+                        self.print_debug("Unable to fetch placement names",
+                                         e)
+            names = self._placement_names or {}
+
+            journal.record(
+                self._journal,
+                server=self.config['server'],
+                task=job.task._moId if job.task is not None else None,
+                operation=(info.get('info.descriptionId') or
+                           job.description.split(' ')[0]),
+                target=info.get('info.entityName') or job.description,
+                host=names.get(job.host, job.host),
+                datastore=",".join(names.get(ds, ds)
+                                   for ds in job.datastores) or None,
+                attempt=job.attempts,
+                queue_seconds=seconds(info.get('info.queueTime'),
+                                      info.get('info.startTime')),
+                run_seconds=seconds(info.get('info.startTime'),
+                                    info.get('info.completeTime')),
+                outcome='error' if fault else 'success',
+                error=(getattr(fault, 'msg', None) or type(fault).__name__
+                       if fault else None))
+        except (sqlite3.Error, EnvironmentError) as e:
+            # a journal problem must not fail the task
+            if self.debug:
+                self.print_debug("Unable to journal %s" % job.description, e)
+
+    def stats(self):
+        """
+        Command Section: stats
+        Task latency percentiles from the task journal
+        """
+        since = None
+        if self.config['days']:
+            since = time.time() - self.config['days'] * 86400
+
+        try:
+            columns, rows = journal.stats(
+                self.config['db'] or self.config.get('journal_db') or
+                journal.default_path(),
+                group_by=self.config['group_by'],
+                operation=self.config['operation'], since=since)
+        except IOError as e:
+            raise NotFoundError(str(e))
+
+        self.print_rows(columns, rows)
+
+    def guestexec(self):
+        """
+        Command Section: guestexec
+        Run a command in the guests of the selected VMs through VMware
+        Tools, concurrently, and print each one's exit code and output
+
+        Returns the results (see run_in_guests) of the guests where the
+        command failed or exited non-zero.
+        """
+        vms = self.select_target_vms("run the command in")
+        if not vms:
+            print("No VMs selected")
+            return
+
+        results = self.run_in_guests(
+            [vm for vm, props in vms], self.config['command'],
+            self.guest_auth(),
+            timeout=self.config['timeout'],
+            capture_output=not self.config['no_output'],
+            concurrency=self.config['concurrency'])
+
+        if self.output_format() == 'table':
+            for result in results:
+                status = result['error'] or "exit %s" % result['exit_code']
+                print("==> %s (%s, %.1fs) <==" % (result['name'], status,
+                                                  result['seconds']))
+                if result['output']:
+                    print(result['output'].rstrip('\n'))
+        else:
+            self.print_rows(list(results[0].keys()),
+                            [list(result.values()) for result in results])
+
+        return [result for result in results if result['exit_code'] != 0]
+
+    def guest_auth(self):
+        """
+        Guest credentials: --guest-user or guest_username from
+        config.yml, and guest_password from config.yml, prompted for if
+        unset.
+        """
+        username = self.config.get('guest_user') or \
+            self.config.get('guest_username')
+        if not username:
+            raise ConfigError("Set the guest user with --guest-user or "
+                              "guest_username in config.yml")
+        password = self.config.get('guest_password')
+        if not password:
+            password = getpass.getpass("Password for %s in the guests: "
+                                       % username)
+        return vim.vm.guest.NamePasswordAuthentication(username=username,
+                                                       password=password)
+
+    def run_in_guests(self, vms, command, auth, timeout=600,
+                      poll_interval=2, capture_output=True, concurrency=16):
+        """
+        Run command (a shell command line: /bin/sh -c, or cmd.exe /c on
+        Windows) in the guest of each VM through the guest operations
+        manager, concurrency guests at a time.  Exit codes are polled
+        every poll_interval seconds with ListProcessesInGuest, one call
+        per guest for all its running processes; processes still running
+        after timeout seconds are killed.  With capture_output, stdout and
+        stderr go to a temporary file in the guest that is fetched and
+        deleted once the command exits.
+
+        Returns a list of dicts with each VM's name, moid, exit_code,
+        seconds, output and error (a message if the command could not
+        be run, or timed out), in the order of vms.
+        """
+        guest_ops = self.content.guestOperationsManager
+        processes = guest_ops.processManager
+        files = guest_ops.fileManager
+        props = dict((vm._moId, vm_props) for vm, vm_props in
+                     self.retrieve_properties(
+                         vim.VirtualMachine,
+                         ['name', 'guest.toolsRunningStatus',
+                          'guest.guestFamily'], objects=list(vms)))
+
+        results = OrderedDict()
+        for vm in vms:
+            results[vm._moId] = OrderedDict([
+                ('name', props.get(vm._moId, {}).get('name')),
+                ('moid', vm._moId),
+                ('exit_code', None),
+                ('seconds', 0.0),
+                ('output', None),
+                ('error', None),
+            ])
+
+        def fail(vm, error):
+            results[vm._moId]['error'] = error
+            return None
+
+        def start(vm):
+            vm_props = props.get(vm._moId, {})
+            if vm_props.get('guest.toolsRunningStatus') != \
+                    'guestToolsRunning':
+                return fail(vm, "VMware Tools not running")
+
+            windows = vm_props.get('guest.guestFamily') == 'windowsGuest'
+            try:
+                output_path = None
+                line = command
+                if capture_output:
+                    output_path = files.CreateTemporaryFileInGuest(
+                        vm, auth, prefix='ezmomi-', suffix='.out')
+                    line = "(%s) > %s 2>&1" % (
+                        command, '"%s"' % output_path if windows
+                        else shlex_quote(output_path))
+                if windows:
+                    spec = vim.vm.guest.ProcessManager.ProgramSpec(
+                        programPath="C:\\Windows\\System32\\cmd.exe",
+                        arguments="/c %s" % line)
+                else:
+                    spec = vim.vm.guest.ProcessManager.ProgramSpec(
+                        programPath="/bin/sh",
+                        arguments="-c %s" % shlex_quote(line))
+                pid = processes.StartProgramInGuest(vm, auth, spec)
+            except vmodl.MethodFault as e:
+                return fail(vm, e.msg or type(e).__name__)
+            return (vm, pid, output_path, time.time())
+
+        def poll(process):
+            vm, pid, output_path, started = process
+            try:
+                info = processes.ListProcessesInGuest(vm, auth, [pid])
+            except vmodl.MethodFault as e:
+                return fail(vm, e.msg or type(e).__name__)
+            result = results[vm._moId]
+            result['seconds'] = time.time() - started
+            if info and info[0].endTime is None:
+                if result['seconds'] < timeout:
+                    return process
+                try:
+                    processes.TerminateProcessInGuest(vm, auth, pid)
+                except vmodl.MethodFault:
+                    pass
+                result['error'] = "timed out after %ss" % timeout
+            elif info:
+                result['exit_code'] = info[0].exitCode
+            if output_path:
+                try:
+                    result['output'] = self.guest_download(
+                        vm, auth, output_path).decode('utf-8', 'replace')
+                    files.DeleteFileInGuest(vm, auth, output_path)
+                except (vmodl.MethodFault, requests.RequestException) as e:
+                    result['error'] = result['error'] or \
+                        "unable to fetch output: %s" % (
+                            getattr(e, 'msg', None) or e)
+            return None
+
+        pool = ThreadPool(max(1, concurrency))
+        try:
+            running = [process for process in pool.map(start, vms)
+                       if process]
+            while running:
+                time.sleep(poll_interval)
+                running = [process for process in pool.map(poll, running)
+                           if process]
+        finally:
+            pool.close()
+
+        return list(results.values())
+
+    def guest_download(self, vm, auth, path):
+        """Content of the file at path in the guest of vm"""
+        info = self.content.guestOperationsManager.fileManager.\
+            InitiateFileTransferFromGuest(vm, auth, path)
+        response = self.http_session().get(self.transfer_url(info.url))
+        response.raise_for_status()
+        return response.content
+
+    def transfer_url(self, url):
+        """A file transfer URL, with its '*' host replaced by the server"""
+        return url.replace("://*", "://%s" % self.config['server'], 1)
+
+    def http_session(self):
+        """requests session for file transfers, one per thread"""
+        session = getattr(self._http, 'session', None)
+        if session is None:
+            session = self._http.session = requests.Session()
+            session.verify = not self.config['no_ssl_verify']
+        return session
+
+    def upload(self):
+        """
+        Command Section: upload
+        Upload local files to a datastore, or into a guest with --vm
+        """
+        return self.transfer_files('upload')
+
+    def download(self):
+        """
+        Command Section: download
+        Download files from a datastore, or from a guest with --vm
+        """
+        return self.transfer_files('download')
+
+    def transfer_files(self, direction):
+        """
+        Transfer --source files to --destination, --concurrency at a time.
+        Datastore paths are written '[datastore] path'; with --vm, remote
+        paths are in the guest instead.  Several sources, or a destination
+        ending with a separator, go into the destination directory.
+
+        Returns an error message for every file that failed.
+        """
+        vm = auth = None
+        if self.config['vm']:
+            vm = self.get_vm_failfast(self.config['vm'])
+            auth = self.guest_auth()
+
+        sources = self.config['source']
+        many = len(sources) > 1
+        if direction == 'upload':
+            # Windows guest paths
+            separator = '\\' if vm and '\\' in self.config['destination'] \
+                else '/'
+            if not vm and not transfer.parse_datastore_path(
+                    self.config['destination']):
+                raise InvalidArgumentError(
+                    "--destination must be a datastore path like "
+                    "'[datastore1] iso/', or a guest path with --vm")
+        else:
+            separator = os.sep
+            if not vm and not all(transfer.parse_datastore_path(source)
+                                  for source in sources):
+                raise InvalidArgumentError(
+                    "--source must be datastore paths like '[datastore1] "
+                    "iso/centos.iso', or guest paths with --vm")
+            if many or os.path.isdir(self.config['destination']):
+                many = True
+        pairs = [(source, transfer.target_path(
+            source, self.config['destination'], many, separator))
+            for source in sources]
+
+        def copy(pair):
+            source, target = pair
+            started = time.time()
+            try:
+                if direction == 'upload':
+                    size = self.upload_file(
+                        source, target, vm=vm, auth=auth,
+                        overwrite=self.config['overwrite'])
+                else:
+                    size = self.download_file(source, target, vm=vm,
+                                              auth=auth)
+            except (EnvironmentError, requests.RequestException,
+                    vmodl.MethodFault, NotFoundError) as e:
+                return "%s: %s" % (source, getattr(e, 'msg', None) or e)
+            if size is None:
+                print("%s: %s is up to date" % (source, target))
+            else:
+                print("%s -> %s (%.1fMB in %.1fs)" % (
+                    source, target, size / 1048576.0, time.time() - started))
+            sys.stdout.flush()
 
+        pool = ThreadPool(max(1, min(self.config['concurrency'],
+                                     len(pairs))))
         try:
-            version, state = None, None
+            errors = [error for error in pool.map(copy, pairs) if error]
+        finally:
+            pool.close()
+
+        for error in errors:
+            print("Error: %s" % error)
+        return errors
+
+    def upload_file(self, path, target, vm=None, auth=None,
+                    overwrite=False):
+        """
+        Upload the local file at path to target, a '[datastore] path',
+        or with vm and auth a path in its guest.  Without overwrite, a
+        datastore file of the same size is left alone (a previous,
+        complete upload) and an existing guest file is an error.
+
+        Returns the bytes sent, None if skipped.
+        """
+        session = self.http_session()
+        if vm is not None:
+            url = self.content.guestOperationsManager.\
+                fileManager.InitiateFileTransferToGuest(
+                    vm, auth, target,
+                    vim.vm.guest.FileManager.FileAttributes(),
+                    os.path.getsize(path), overwrite)
+            return transfer.put(session, self.transfer_url(url), path)
+
+        url, params = self.datastore_url(target)
+        headers = {'Cookie': self.session_cookie()}
+        if not overwrite and transfer.remote_size(
+                session, url, params=params,
+                headers=headers) == os.path.getsize(path):
+            return None
+        return transfer.put(session, url, path, params=params,
+                            headers=headers)
+
+    def download_file(self, source, path, vm=None, auth=None):
+        """
+        Download source, a '[datastore] path' or with vm and auth a path
+        in its guest, to the local file path.  An interrupted download
+        is resumed where it stopped.  Returns the bytes received.
+        """
+        session = self.http_session()
+        if vm is not None:
+            info = self.content.guestOperationsManager.fileManager.\
+                InitiateFileTransferFromGuest(vm, auth, source)
+            return transfer.get(session, self.transfer_url(info.url), path)
+
+        url, params = self.datastore_url(source)
+        return transfer.get(session, url, path, params=params,
+                            headers={'Cookie': self.session_cookie()})
+
+    def datastore_url(self, datastore_path):
+        """
+        URL and query parameters of a '[datastore] path' on the server's
+        /folder endpoint
+        """
+        datastore_name, path = transfer.parse_datastore_path(datastore_path)
+        datastore = self.get_obj([vim.Datastore], datastore_name)
+        if datastore is None:
+            raise NotFoundError("Datastore '%s' does not exist"
+                                % datastore_name)
+
+        # the datacenter's inventory path, e.g. folder/DC
+        parent = self.datacenter_of(datastore)
+        names = list()
+        while parent != self.content.rootFolder:
+            names.insert(0, parent.name)
+            parent = parent.parent
+
+        url = "https://%s:%s/folder/%s" % (
+            self.config['server'], self.config['port'],
+            quote(path))
+        return url, {'dcPath': '/'.join(names), 'dsName': datastore_name}
+
+    def datacenter_of(self, obj):
+        """Datacenter an inventory object is in"""
+        parent = obj.parent
+        while not isinstance(parent, vim.Datacenter):
+            parent = parent.parent
+        return parent
+
+    def deploy_ova(self):
+        """
+        Command Section: deploy-ova
+        Deploy a VM or vApp from an OVA or OVF package
+        """
+        networks = dict()
+        for mapping in self.config['network']:
+            source, _, target = mapping.rpartition('=')
+            networks[source or '*'] = target
+
+        print("Deploying %s as %s..." % (self.config['ova'],
+                                         self.config['name']))
+        last = [-10]
+
+        def on_progress(percent):
+            if percent >= last[0] + 10:
+                last[0] = percent
+                print("%s%% uploaded" % percent)
+                sys.stdout.flush()
+
+        entity = self.deploy_ovf(
+            self.config['ova'], self.config['name'],
+            datastore=self.config['datastore'],
+            cluster=self.config['cluster'],
+            host=self.config['host'],
+            resource_pool=self.config['resource_pool'],
+            folder=self.config['destination_folder'],
+            networks=networks,
+            disk_provisioning=self.config['disk_provisioning'],
+            concurrency=self.config['concurrency'],
+            on_progress=on_progress)
+        print("Deployed %s (%s)" % (self.config['name'], entity._moId))
+
+    def deploy_ovf(self, path, name, datastore, cluster='', host='',
+                   resource_pool='', folder='', networks=None,
+                   disk_provisioning='thin', concurrency=4,
+                   on_progress=None):
+        """
+        Import the OVF package at path (an .ova, or an .ovf next to its
+        disks) as name.  The descriptor is parsed and turned into an
+        import spec by the ovfManager; the disks are then streamed, from
+        the archive and concurrency at a time, to the upload URLs of the
+        import's HttpNfcLease.  Progress is reported to the lease (and
+        on_progress(percent)) every few seconds so it doesn't time out.
+
+        networks maps OVF network names to vSphere network names, '*'
+        matching any.  Returns the new VirtualMachine or VirtualApp.
+        """
+        try:
+            package = ovf.Package(path)
+            descriptor = package.descriptor()
+        except (EnvironmentError, ValueError, tarfile.TarError) as e:
+            raise InvalidArgumentError("Unable to read %s: %s" % (path, e))
+
+        datastore_obj = self.get_obj([vim.Datastore], datastore)
+        if datastore_obj is None:
+            raise NotFoundError("Datastore '%s' does not exist" % datastore)
+        host_obj = self.get_host_system_failfast(host) if host else None
+        if cluster:
+            compute = self.get_obj([vim.ClusterComputeResource], cluster)
+            if compute is None:
+                raise NotFoundError("Cluster '%s' does not exist" % cluster)
+        elif host_obj is not None:
+            compute = host_obj.parent
+        else:
+            raise InvalidArgumentError("Give a cluster or host to deploy "
+                                       "%s to" % name)
+        pool = compute.resourcePool
+        if resource_pool:
+            pool = self.get_resource_pool(compute, resource_pool)
+            if pool is None:
+                raise NotFoundError("Resource Pool '%s' does not exist in "
+                                    "%s" % (resource_pool, compute.name))
+        if folder:
+            folder_obj = self.content.searchIndex.FindByInventoryPath(folder)
+            if folder_obj is None:
+                raise NotFoundError("Folder '%s' does not exist" % folder)
+        else:
+            folder_obj = self.datacenter_of(compute).vmFolder
+
+        ovf_manager = self.content.ovfManager
+        parsed = ovf_manager.ParseDescriptor(
+            descriptor, vim.OvfManager.ParseDescriptorParams())
+        if parsed.error:
+            raise InvalidArgumentError("Invalid OVF descriptor: %s"
+                                       % parsed.error[0].msg)
+
+        network_mapping = list()
+        for network in parsed.network or []:
+            target = (networks or {}).get(network.name) or \
+                (networks or {}).get('*')
+            if not target:
+                continue
+            network_obj = self.get_obj([vim.Network], target)
+            if network_obj is None:
+                raise NotFoundError("Network '%s' does not exist" % target)
+            network_mapping.append(vim.OvfManager.NetworkMapping(
+                name=network.name, network=network_obj))
+
+        result = ovf_manager.CreateImportSpec(
+            descriptor, pool, datastore_obj,
+            vim.OvfManager.CreateImportSpecParams(
+                entityName=name, hostSystem=host_obj,
+                networkMapping=network_mapping,
+                diskProvisioning=disk_provisioning))
+        if result.error:
+            raise InvalidArgumentError(
+                "Unable to import %s: %s" % (path, "; ".join(
+                    error.msg or type(error).__name__
+                    for error in result.error)))
+
+        lease = pool.ImportVApp(result.importSpec, folder_obj, host_obj)
+        while lease.state == vim.HttpNfcLease.State.initializing:
+            time.sleep(1)
+        if lease.state == vim.HttpNfcLease.State.error:
+            raise TaskError("Import %s" % name, lease.error)
+
+        urls = dict((device.importKey, device.url)
+                    for device in lease.info.deviceUrl)
+        items = list(result.fileItem or [])
+        total = sum(package.size(item.path) for item in items) or 1
+        sent = [0]
+        lock = threading.Lock()
+
+        def count(size):
+            with lock:
+                sent[0] += size
+
+        def upload(item):
+            fileobj, size = package.open(item.path)
+            with fileobj:
+                transfer.send(
+                    self.http_session(), 'PUT' if item.create else 'POST',
+                    self.transfer_url(urls[item.deviceId]), fileobj, size,
+                    on_progress=count,
+                    headers={'Content-Type':
+                             'application/x-vnd.vmware-streamVmdk'})
+
+        done = threading.Event()
+
+        def keep_alive():
+            while not done.wait(5):
+                percent = int(sent[0] * 100 / total)
+                try:
+                    lease.HttpNfcLeaseProgress(min(percent, 99))
+                except vmodl.MethodFault:
+                    pass
+                if on_progress:
+                    on_progress(percent)
+
+        progress = threading.Thread(target=keep_alive)
+        progress.daemon = True
+        progress.start()
+        uploads = ThreadPool(max(1, min(concurrency, len(items) or 1)))
+        completed = False
+        try:
+            uploads.map(upload, items)
+            completed = True
+        except (requests.RequestException, EnvironmentError,
+                ValueError) as e:
+            raise TaskError("Import %s" % name, vmodl.fault.SystemError(
+                msg=str(e), reason=str(e)))
+        finally:
+            done.set()
+            uploads.close()
+            if not completed:
+                try:
+                    lease.HttpNfcLeaseAbort()
+                except vmodl.MethodFault:
+                    pass
+
+        lease.HttpNfcLeaseProgress(100)
+        lease.HttpNfcLeaseComplete()
+        if on_progress:
+            on_progress(100)
+        return lease.info.entity
+
+    def session_cookie(self):
+        """Cookie header value of the vSphere session, for HTTP requests"""
+        return self.si._stub.cookie.split(';')[0].strip()
+
+    def WaitForGuestReady(self, vms, condition, timeout_seconds,
+                          on_ready=None):
+        """
+        Wait until the guest of each VM satisfies the readiness condition
+        (see guestReady).  A single PropertyCollector filter watches
+        guest.toolsRunningStatus, guest.ipAddress and guest.net for all
+        VMs, so changes are pushed to us instead of being polled.
+        on_ready, if set, is called with each VM's name and guest
+        properties as it becomes ready.
+
+        Returns a dict of VM MOID -> True if ready, False if timed out.
+        """
+        names = self.vm_names(vms)
+        props = dict((moid, {}) for moid in names)
+        ready = dict((moid, False) for moid in names)
+        pending = set(names)
+
+        for moid, changes in self.vm_updates(
+                vms, ['guest.toolsRunningStatus', 'guest.ipAddress',
+                      'guest.net'], timeout_seconds):
+            for change in changes:
+                if change.op == 'remove':
+                    props[moid].pop(change.name, None)
+                else:
+                    props[moid][change.name] = change.val
+
+            if moid in pending and self.guestReady(props[moid], condition):
+                pending.remove(moid)
+                ready[moid] = True
+                if on_ready:
+                    on_ready(names[moid], props[moid])
+            if not pending:
+                break
+
+        return ready
+
+    def vm_names(self, vms):
+        """{moid: name} of vms, retrieved in one request"""
+        return dict((vm._moId, props.get('name')) for vm, props in
+                    self.retrieve_properties(vim.VirtualMachine, ['name'],
+                                             objects=vms))
+
+    def WaitForPowerState(self, vms, state, timeout_seconds):
+        """
+        Wait until each VM reaches the power state, through a single
+        PropertyCollector filter on runtime.powerState for all VMs.
+
+        Returns a dict of VM MOID -> True if reached, False if timed out.
+        """
+        pending = set(vm._moId for vm in vms)
+        reached = dict((moid, False) for moid in pending)
+
+        for moid, changes in self.vm_updates(vms, ['runtime.powerState'],
+                                             timeout_seconds):
+            if moid in pending and \
+                    any(change.val == state for change in changes):
+                pending.remove(moid)
+                reached[moid] = True
+            if not pending:
+                break
+
+        return reached
+
+    def vm_updates(self, vms, path_set, timeout_seconds):
+        """
+        Yield (moid, property changes) as the paths in path_set change on
+        vms, starting with their current values, until timeout_seconds
+        have passed or the consumer stops.
+
+        The filter lives on a private PropertyCollector.  If the session
+        expires meanwhile, both are recreated in the new one and current
+        values are yielded again.
+        """
+        filterSpec = vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=[vmodl.query.PropertyCollector.ObjectSpec(obj=vm)
+                       for vm in vms],
+            propSet=[vmodl.query.PropertyCollector.PropertySpec(
+                type=vim.VirtualMachine, pathSet=list(path_set))])
+        deadline = time.time() + timeout_seconds
+        collector = None
+
+        try:
+            while True:
+                remaining = int(deadline - time.time())
+                if remaining <= 0:
+                    return
+
+                try:
+                    if collector is None:
+                        session = self.retrier.session
+                        collector = self.si.content.propertyCollector\
+                            .CreatePropertyCollector()
+                        collector.CreateFilter(filterSpec, True)
+                        version = None
+
+                    options = vmodl.query.PropertyCollector.WaitOptions(
+                        maxWaitSeconds=min(remaining, 60))
+                    update = collector.WaitForUpdatesEx(version, options)
+                except vmodl.MethodFault:
+                    if not self.relogged_in(session):
+                        raise
+                    # the collector and filter went with the expired
+                    # session
+                    collector = None
+                    continue
+
+                if update is None:
+                    # maxWaitSeconds elapsed without any changes
+                    continue
+
+                for filterSet in update.filterSet:
+                    for objSet in filterSet.objectSet:
+                        yield objSet.obj._moId, objSet.changeSet
+                # Move to next version
+                version = update.version
+        finally:
+            if collector is not None:
+                try:
+                    # destroys its filter too
+                    collector.DestroyPropertyCollector()
+                except vmodl.MethodFault:
+                    # gone with an expired session
+                    pass
+
+    def watch_updates(self, type_props, max_wait_seconds=60):
+        """
+        Watch the property paths in type_props ({vim type: [paths]}) on
+        every object of those types, through one PropertyCollector filter
+        over a ContainerView, looping on WaitForUpdatesEx.
+
+        Yields one event dict per changed object:
+            {'event': 'enter'|'modify'|'leave', 'type': ..., 'moid': ...,
+             'changes': {path: new value}}
+        starting with an 'enter' for every existing object.
+
+        If the connection drops, waiting resumes from the last version, as
+        the filter lives on in the session.  If the session is lost (the
+        retry layer logs in again) the filter is recreated, and its initial
+        contents are compared with the last known state so only real
+        changes are reported.
+        """
+        # last known serialized value of every watched property, per moid
+        state = dict()
+        failures = 0
+        filter = None
+        session = self.retrier.session
+
+        try:
+            while True:
+                try:
+                    if filter is None or self.relogged_in(session):
+                        # after a relogin the filter and view are gone
+                        session = self.retrier.session
+                        container, filter = self.create_watch_filter(
+                            type_props)
+                        version = None
+                        resyncing = True
+                        unseen = set(state)
+
+                    options = vmodl.query.PropertyCollector.WaitOptions(
+                        maxWaitSeconds=max_wait_seconds)
+                    update = self.content.propertyCollector.WaitForUpdatesEx(
+                        version, options)
+                    failures = 0
+                except vmodl.MethodFault as e:
+                    # the retry layer logged in again and repeated the
+                    # call, for a filter or version of the old session
+                    if not self.relogged_in(session):
+                        raise
+                    if self.debug:
+                        self.print_debug("watch filter lost", e)
+                    continue
+                except (socket.error, http_client.HTTPException) as e:
+                    # dropped connection, resume from version
+                    if self.debug:
+                        self.print_debug("watch connection error", e)
+                    failures += 1
+                    time.sleep(min(2 ** failures, 60))
+                    continue
+
+                if update is None or self.relogged_in(session):
+                    # maxWaitSeconds elapsed without any changes, or the
+                    # filter must be recreated first
+                    continue
 
-            # Loop looking for updates till the state moves to a
-            # completed state.
-            while len(taskList):
-                update = pc.WaitForUpdates(version)
                 for filterSet in update.filterSet:
                     for objSet in filterSet.objectSet:
-                        task = objSet.obj
-                        for change in objSet.changeSet:
-                            if change.name == 'info':
-                                state = change.val.state
-                            elif change.name == 'info.state':
-                                state = change.val
-                            else:
-                                continue
-
-                            if state == vim.TaskInfo.State.success:
-                                # Remove task from taskList
-                                taskList.remove(str(task))
-                            elif state == vim.TaskInfo.State.error:
-                                raise task.info.error
+                        event = self.watch_event(objSet, state, unseen)
+                        if event:
+                            yield event
+
+                if resyncing and not update.truncated:
+                    # objects that disappeared while we were reconnecting
+                    for moid in unseen:
+                        yield {'event': 'leave',
+                               'type': state[moid]['_type'],
+                               'moid': moid, 'changes': {}}
+                        del state[moid]
+                    unseen.clear()
+                    resyncing = False
+
                 # Move to next version
                 version = update.version
         finally:
             if filter:
-                filter.Destroy()
+                try:
+                    filter.Destroy()
+                    container.DestroyView()
+                except Exception:
+                    pass
 
-    def WaitForVirtualMachineShutdown(
-            self,
-            vm_to_poll,
-            timeout_seconds,
-            sleep_period=5
-    ):
+    def watch_event(self, objSet, state, unseen):
         """
-        Guest shutdown requests do not run a task we can wait for.
-        So, we must poll and wait for status to be poweredOff.
+        Turn a PropertyCollector ObjectUpdate into a watch event, updating
+        state.  Returns None if nothing actually changed.
+        """
+        moid = objSet.obj._moId
+        vimtype = objSet.obj._wsdlName
+
+        if objSet.kind == 'leave':
+            state.pop(moid, None)
+            return {'event': 'leave', 'type': vimtype, 'moid': moid,
+                    'changes': {}}
+
+        kind = objSet.kind
+        if moid in unseen:
+            # re-entering after a reconnect, report only differences
+            unseen.discard(moid)
+            kind = 'modify'
+        known = state.setdefault(moid, {'_type': vimtype})
+
+        changes = dict()
+        for change in objSet.changeSet:
+            value = None if change.op == 'remove' else change.val
+            serialized = json.dumps(value, default=self.to_json,
+                                    sort_keys=True)
+            if kind == 'enter' or known.get(change.name) != serialized:
+                known[change.name] = serialized
+                changes[change.name] = value
+
+        if kind == 'modify' and not changes:
+            return None
+
+        return {'event': kind, 'type': vimtype, 'moid': moid,
+                'changes': changes}
 
-        Returns True if shutdown, False if poll expired.
+    def create_watch_filter(self, type_props):
         """
-        seconds_waited = 0  # wait counter
-        while seconds_waited < timeout_seconds:
-            # sleep first, since nothing shuts down instantly
-            seconds_waited += sleep_period
-            time.sleep(sleep_period)
+        Create a PropertyCollector filter over a ContainerView of every
+        object of the types in type_props ({vim type: [paths]})
+        """
+        container = self.content.viewManager.CreateContainerView(
+            self.content.rootFolder, list(type_props), True)
 
-            vm = self.get_vm(vm_to_poll.name)
-            if vm.runtime.powerState == \
-                    vim.VirtualMachinePowerState.poweredOff:
-                return True
+        objSpec = self.view_object_spec(container)
+        propSpecs = [vmodl.query.PropertyCollector.PropertySpec(
+            type=vimtype, pathSet=paths, all=False)
+            for vimtype, paths in type_props.items()]
+        filterSpec = vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=[objSpec], propSet=propSpecs)
 
-        return False
+        return container, self.content.propertyCollector.CreateFilter(
+            filterSpec, True)
+
+    def WaitForVirtualMachineShutdown(self, vm_to_poll, timeout_seconds):
+        """
+        Guest shutdown requests do not run a task we can wait for.
+        So, we must wait for status to be poweredOff (see
+        WaitForPowerState).
+
+        Returns True if shutdown, False if the wait expired.
+        """
+        return self.WaitForPowerState(
+            [vm_to_poll], vim.VirtualMachinePowerState.poweredOff,
+            timeout_seconds)[vm_to_poll._moId]
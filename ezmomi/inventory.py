@@ -0,0 +1,170 @@
+"""Offline inventory snapshot stored in sqlite"""
+import os
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE vm (
+    moid TEXT PRIMARY KEY,
+    name TEXT,
+    power_state TEXT,
+    host TEXT,
+    guest_os TEXT,
+    ip_address TEXT,
+    num_cpu INTEGER,
+    memory_mb INTEGER,
+    template INTEGER,
+    annotation TEXT
+);
+CREATE TABLE host (
+    moid TEXT PRIMARY KEY,
+    name TEXT,
+    cluster TEXT,
+    connection_state TEXT,
+    power_state TEXT
+);
+CREATE TABLE cluster (
+    moid TEXT PRIMARY KEY,
+    name TEXT
+);
+CREATE TABLE datastore (
+    moid TEXT PRIMARY KEY,
+    name TEXT,
+    type TEXT,
+    capacity INTEGER,
+    free_space INTEGER,
+    accessible INTEGER
+);
+CREATE TABLE network (
+    moid TEXT PRIMARY KEY,
+    name TEXT
+);
+CREATE TABLE vm_datastore (
+    vm TEXT,
+    datastore TEXT
+);
+CREATE TABLE vm_network (
+    vm TEXT,
+    network TEXT
+);
+CREATE INDEX vm_name ON vm (name);
+CREATE INDEX vm_power_state ON vm (power_state);
+CREATE INDEX vm_host ON vm (host);
+CREATE INDEX host_name ON host (name);
+CREATE INDEX datastore_name ON datastore (name);
+CREATE INDEX network_name ON network (name);
+CREATE INDEX vm_datastore_vm ON vm_datastore (vm);
+CREATE INDEX vm_datastore_datastore ON vm_datastore (datastore);
+CREATE INDEX vm_network_vm ON vm_network (vm);
+CREATE INDEX vm_network_network ON vm_network (network);
+"""
+
+# properties fetched for each table, in column order after moid
+VM_PROPERTIES = ['name', 'runtime.powerState', 'runtime.host',
+                 'config.guestFullName', 'guest.ipAddress',
+                 'config.hardware.numCPU', 'config.hardware.memoryMB',
+                 'config.template', 'config.annotation']
+HOST_PROPERTIES = ['name', 'parent', 'runtime.connectionState',
+                   'runtime.powerState']
+CLUSTER_PROPERTIES = ['name']
+DATASTORE_PROPERTIES = ['name', 'summary.type', 'summary.capacity',
+                        'summary.freeSpace', 'summary.accessible']
+NETWORK_PROPERTIES = ['name']
+
+# VM report returned by query() when no raw SQL is given
+VM_QUERY = """
+SELECT vm.name AS name,
+       vm.power_state AS power_state,
+       host.name AS host,
+       cluster.name AS cluster,
+       (SELECT group_concat(datastore.name, ',')
+          FROM vm_datastore
+          JOIN datastore ON datastore.moid = vm_datastore.datastore
+         WHERE vm_datastore.vm = vm.moid) AS datastores,
+       vm.ip_address AS ip_address,
+       vm.guest_os AS guest_os
+  FROM vm
+  LEFT JOIN host ON host.moid = vm.host
+  LEFT JOIN cluster ON cluster.moid = host.cluster
+"""
+
+
+def default_path():
+    return "%s/.config/ezmomi/inventory.db" % os.path.expanduser("~")
+
+
+def create(path):
+    """
+    Create an empty inventory database at path.  The snapshot is built in
+    a temporary file which replace() moves into place once complete, so
+    queries never see a half-written inventory.
+    """
+    tmp_path = "%s.tmp" % path
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    db = sqlite3.connect(tmp_path)
+    db.executescript(SCHEMA)
+    return db, tmp_path
+
+
+def replace(db, tmp_path, path):
+    db.commit()
+    db.close()
+    os.rename(tmp_path, path)
+
+
+def query(path, sql=None, params=(), name=None, power_state=None,
+          host=None, cluster=None, datastore=None, network=None):
+    """
+    Run a query against the inventory database at path.  Either pass raw
+    SQL (and its params), or any combination of the VM filters, which are
+    ANDed together.  name is a glob pattern.
+
+    Returns (column names, row iterator).
+    """
+    if not os.path.isfile(path):
+        raise IOError("Inventory database %s does not exist. Run "
+                      "'ezmomi inventory dump' first." % path)
+
+    db = sqlite3.connect(path)
+
+    if sql is None:
+        where = []
+        params = []
+        if name:
+            where.append("vm.name GLOB ?")
+            params.append(name)
+        if power_state:
+            where.append("vm.power_state = ?")
+            params.append(power_state)
+        if host:
+            where.append("host.name = ?")
+            params.append(host)
+        if cluster:
+            where.append("cluster.name = ?")
+            params.append(cluster)
+        if datastore:
+            where.append("vm.moid IN (SELECT vm_datastore.vm "
+                         "FROM vm_datastore JOIN datastore "
+                         "ON datastore.moid = vm_datastore.datastore "
+                         "WHERE datastore.name = ?)")
+            params.append(datastore)
+        if network:
+            where.append("vm.moid IN (SELECT vm_network.vm "
+                         "FROM vm_network JOIN network "
+                         "ON network.moid = vm_network.network "
+                         "WHERE network.name = ?)")
+            params.append(network)
+
+        sql = VM_QUERY
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY vm.name"
+
+    cursor = db.execute(sql, params)
+    columns = [column[0] for column in cursor.description or []]
+    return columns, cursor
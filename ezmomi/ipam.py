@@ -0,0 +1,135 @@
+"""Allocation of free IPv4 addresses in the networks of config.yml"""
+import bisect
+import os
+import sqlite3
+import time
+
+from netaddr import AddrFormatError, IPAddress
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reservation (
+    ip TEXT PRIMARY KEY,
+    network TEXT,
+    hostname TEXT,
+    time REAL
+);
+"""
+
+
+def default_path():
+    return "%s/.config/ezmomi/ip_reservations.db" % os.path.expanduser("~")
+
+
+class AddressIndex(object):
+    """Sorted IPv4 addresses in use, as integers"""
+
+    def __init__(self, addresses=()):
+        used = set()
+        for address in addresses:
+            try:
+                ip = IPAddress(address)
+            except (AddrFormatError, ValueError, TypeError):
+                continue
+            if ip.version == 4:
+                used.add(int(ip))
+        self.used = sorted(used)
+
+    def __len__(self):
+        return len(self.used)
+
+    def __contains__(self, ip):
+        i = bisect.bisect_left(self.used, ip)
+        return i < len(self.used) and self.used[i] == ip
+
+    def add(self, ip):
+        if ip not in self:
+            bisect.insort(self.used, ip)
+
+    def first_free(self, first, last):
+        """
+        Lowest address from first to last (integers) not in use, or None.
+        Used addresses are unique and sorted, so in the range's slice
+        used[lo + k] == first + k holds exactly up to the first gap: a
+        binary search for it takes O(log n).
+        """
+        lo = bisect.bisect_left(self.used, first)
+        hi = bisect.bisect_right(self.used, last)
+        start, end = lo, hi
+        while start < end:
+            middle = (start + end) // 2
+            if self.used[middle] == first + middle - lo:
+                start = middle + 1
+            else:
+                end = middle
+        free = first + start - lo
+        return free if free <= last else None
+
+
+def connect(path):
+    """Open the reservations at path, creating them if needed"""
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    # transactions are begun explicitly, see allocate
+    db = sqlite3.connect(path, timeout=60, isolation_level=None)
+    db.executescript(SCHEMA)
+    return db
+
+
+def allocate(path, index, network, first, last, hostname, excluded=(),
+             ttl=86400):
+    """
+    Reserve the lowest address from first to last (integers) that is
+    neither in index, excluded nor reserved at path, for hostname.
+    Reservations older than ttl seconds are dropped: by then the guest
+    reports its address and index has it.
+
+    The reservations are locked while allocating, so concurrent ezmomi
+    runs never hand out the same address.  Returns the address as a
+    string; raises ValueError when network is full.
+    """
+    db = connect(path)
+    try:
+        # take the write lock before reading, released by COMMIT/ROLLBACK
+        db.execute("BEGIN IMMEDIATE")
+        db.execute("DELETE FROM reservation WHERE time < ?",
+                   (time.time() - ttl,))
+        taken = set(int(IPAddress(ip)) for (ip,) in
+                    db.execute("SELECT ip FROM reservation"))
+        taken.update(int(IPAddress(ip)) for ip in excluded)
+
+        ip = index.first_free(first, last)
+        while ip is not None and ip in taken:
+            ip = index.first_free(ip + 1, last)
+        if ip is None:
+            raise ValueError("No free address left in %s" % network)
+
+        address = str(IPAddress(ip))
+        db.execute("INSERT INTO reservation VALUES (?, ?, ?, ?)",
+                   (address, network, hostname, time.time()))
+        db.execute("COMMIT")
+    except BaseException:
+        try:
+            db.execute("ROLLBACK")
+        except sqlite3.Error:
+            # BEGIN itself failed, e.g. timed out waiting for the lock
+            pass
+        raise
+    finally:
+        db.close()
+
+    index.add(ip)
+    return address
+
+
+def release(path, addresses):
+    """Drop the reservations of addresses, e.g. of a clone not made"""
+    if not addresses:
+        return
+    db = connect(path)
+    try:
+        db.executemany("DELETE FROM reservation WHERE ip = ?",
+                       [(address,) for address in addresses])
+    finally:
+        db.close()
@@ -0,0 +1,126 @@
+"""Journal of vCenter tasks and their latencies, stored in sqlite"""
+import os
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS task (
+    id INTEGER PRIMARY KEY,
+    time REAL,
+    server TEXT,
+    task TEXT,
+    operation TEXT,
+    target TEXT,
+    host TEXT,
+    datastore TEXT,
+    attempt INTEGER,
+    queue_seconds REAL,
+    run_seconds REAL,
+    outcome TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS task_time ON task (time);
+CREATE INDEX IF NOT EXISTS task_operation ON task (operation);
+"""
+
+COLUMNS = ['time', 'server', 'task', 'operation', 'target', 'host',
+           'datastore', 'attempt', 'queue_seconds', 'run_seconds',
+           'outcome', 'error']
+
+# columns stats() can group by
+GROUPS = ['operation', 'host', 'datastore', 'target', 'outcome', 'server']
+
+PERCENTILES = [50, 95, 99]
+
+
+def default_path():
+    return "%s/.config/ezmomi/journal.db" % os.path.expanduser("~")
+
+
+def connect(path):
+    """Open the journal at path, creating it if needed"""
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    db = sqlite3.connect(path)
+    db.executescript(SCHEMA)
+    return db
+
+
+def record(db, **task):
+    """Add a task (a dict of COLUMNS) to the journal"""
+    task.setdefault('time', time.time())
+    db.execute("INSERT INTO task (%s) VALUES (%s)" % (
+        ", ".join(COLUMNS), ", ".join("?" for column in COLUMNS)),
+        [task.get(column) for column in COLUMNS])
+    db.commit()
+
+
+def percentile(values, p):
+    """Nearest-rank percentile p of sorted values, None if empty"""
+    if not values:
+        return None
+    rank = max(1, int(-(-len(values) * p // 100)))
+    return values[rank - 1]
+
+
+def stats(path, group_by=('operation',), operation=None, since=None):
+    """
+    Latency percentiles of the journaled tasks at path, grouped by
+    group_by columns (see GROUPS).  Only tasks of operation and recorded
+    after since (epoch seconds) are counted if given.
+
+    Returns (column names, rows).
+    """
+    if not os.path.isfile(path):
+        raise IOError("Task journal %s does not exist yet. It is written "
+                      "as ezmomi runs tasks." % path)
+
+    for column in group_by:
+        if column not in GROUPS:
+            raise ValueError("Can't group by %s" % column)
+
+    where = []
+    params = []
+    if operation:
+        where.append("operation = ?")
+        params.append(operation)
+    if since:
+        where.append("time >= ?")
+        params.append(since)
+
+    db = sqlite3.connect(path)
+    rows = db.execute(
+        "SELECT %s, outcome, queue_seconds, run_seconds FROM task%s "
+        "ORDER BY %s" % (", ".join(group_by),
+                         " WHERE " + " AND ".join(where) if where else "",
+                         ", ".join(group_by)),
+        params)
+
+    groups = dict()
+    for row in rows:
+        key = row[:len(group_by)]
+        outcome, queue_seconds, run_seconds = row[len(group_by):]
+        group = groups.setdefault(key, {'count': 0, 'failed': 0,
+                                        'queue': [], 'run': []})
+        group['count'] += 1
+        if outcome != 'success':
+            group['failed'] += 1
+        if queue_seconds is not None:
+            group['queue'].append(queue_seconds)
+        if run_seconds is not None:
+            group['run'].append(run_seconds)
+
+    columns = list(group_by) + ['count', 'failed'] + \
+        ['run_p%s' % p for p in PERCENTILES] + \
+        ['queue_p%s' % p for p in PERCENTILES]
+    result = []
+    for key, group in sorted(groups.items(),
+                             key=lambda item: [str(k) for k in item[0]]):
+        run = sorted(group['run'])
+        queue = sorted(group['queue'])
+        result.append(list(key) + [group['count'], group['failed']] +
+                      [percentile(run, p) for p in PERCENTILES] +
+                      [percentile(queue, p) for p in PERCENTILES])
+    return columns, result
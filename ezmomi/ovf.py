@@ -0,0 +1,77 @@
+"""Reading OVF packages: .ova archives or .ovf files with their disks"""
+import os
+import tarfile
+
+
+class Package(object):
+    """
+    An OVF package at path, either an .ova (tar) archive or an .ovf
+    descriptor next to its files.  Files are read straight from the
+    archive, never extracted.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.archive = tarfile.is_tarfile(path)
+        if self.archive:
+            with tarfile.open(path) as tar:
+                self.sizes = dict((member.name, member.size)
+                                  for member in tar.getmembers()
+                                  if member.isfile())
+            descriptors = [name for name in self.sizes
+                           if name.lower().endswith('.ovf')]
+            if len(descriptors) != 1:
+                raise ValueError("%s should hold one .ovf descriptor, not %s"
+                                 % (path, len(descriptors)))
+            self.descriptor_name = descriptors[0]
+        else:
+            self.sizes = None
+            self.descriptor_name = os.path.basename(path)
+
+    def descriptor(self):
+        """The OVF descriptor, as text"""
+        fileobj, size = self.open(self.descriptor_name)
+        with fileobj:
+            return fileobj.read().decode('utf-8')
+
+    def size(self, name):
+        """Size of the file name in the package"""
+        if self.archive:
+            return self.sizes[name]
+        return os.path.getsize(os.path.join(os.path.dirname(self.path),
+                                            name))
+
+    def open(self, name):
+        """
+        (file object, size) of the file name in the package.  Each call
+        opens its own handle, so files can be read from several threads.
+        """
+        if not self.archive:
+            return open(os.path.join(os.path.dirname(self.path), name),
+                        'rb'), self.size(name)
+
+        if name not in self.sizes:
+            raise ValueError("%s has no file %s" % (self.path, name))
+        tar = tarfile.open(self.path)
+        return Member(tar, tar.extractfile(name)), self.sizes[name]
+
+
+class Member(object):
+    """A file in a tar archive, closing the archive along with it"""
+
+    def __init__(self, tar, fileobj):
+        self.tar = tar
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        return self.fileobj.read(size)
+
+    def close(self):
+        self.fileobj.close()
+        self.tar.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
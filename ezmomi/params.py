@@ -10,7 +10,80 @@ def add_boolean_argument(parser, name, default=False):
                        default=default)
 
 
-def arg_setup():
+def add_vm_selector(parser, name_arg="--name"):
+    """
+    Add arguments selecting a single VM by name (or inventory path), BIOS
+    or instance UUID, IP address or DNS name to an ArgumentParser instance.
+    """
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument(name_arg, default="",
+                       help="VM name (case-sensitive) or inventory path, "
+                            "e.g. /DC/vm/folder/name")
+    group.add_argument("--uuid", default="",
+                       help="VM BIOS or instance UUID")
+    group.add_argument("--ip", default="",
+                       help="VM IP address, as reported by VMware Tools")
+    group.add_argument("--dns-name", default="",
+                       help="VM DNS name, as reported by VMware Tools")
+
+
+def add_vm_set_selector(parser, action):
+    """
+    Add arguments selecting any number of VMs by name, name pattern, BIOS
+    or instance UUID, IP address, DNS name and folder to an
+    ArgumentParser instance.
+    """
+    parser.add_argument(
+        "--name",
+        required=False,
+        default=[],
+        nargs="+",
+        help="VM names (case-sensitive)"
+    )
+    parser.add_argument(
+        "--glob",
+        required=False,
+        default=[],
+        nargs="+",
+        help="VM name patterns, e.g. 'test-*'"
+    )
+    parser.add_argument(
+        "--uuid",
+        required=False,
+        default=[],
+        nargs="+",
+        help="VM BIOS or instance UUIDs"
+    )
+    parser.add_argument(
+        "--ip",
+        required=False,
+        default=[],
+        nargs="+",
+        help="VM IP addresses, every VM reporting one of them is selected"
+    )
+    parser.add_argument(
+        "--dns-name",
+        required=False,
+        default=[],
+        nargs="+",
+        help="VM DNS names, every VM reporting one of them is selected"
+    )
+    parser.add_argument(
+        "--folder",
+        required=False,
+        default="",
+        type=str,
+        help="Inventory path of a folder, e.g. /DC/vm/ci. With no --name or "
+             "--glob, every VM in it is %s" % action
+    )
+
+
+def arg_setup(args=None):
+    """Parse the command line, or the given list of arguments"""
+    return build_parser().parse_args(args)
+
+
+def build_parser():
     from .version import __version__
     import argparse
 
@@ -52,10 +125,53 @@ def arg_setup():
         help="vsphere server to connect to."
     )
 
+    # arguments for subcommands that can wait for the guest to be ready
+    ready_parser = argparse.ArgumentParser(
+        add_help=False,
+        description="Guest readiness arguments"
+    )
+
+    ready_parser.add_argument(
+        "--wait-ready",
+        action="store_true",
+        default=False,
+        help="Wait until the guest is ready before returning"
+    )
+
+    ready_parser.add_argument(
+        "--ready-condition",
+        choices=["tools", "ip", "net"],
+        default="ip",
+        help="Guest readiness condition: tools (VMware Tools running), "
+             "ip (tools running and a primary IP reported) or net (tools "
+             "running and every connected NIC has an IP). Default: ip"
+    )
+
+    ready_parser.add_argument(
+        "--ready-timeout",
+        type=int,
+        default=600,
+        help="Seconds to wait for the guest to be ready. Default: 600"
+    )
+
+    # arguments for subcommands that print results
+    output_parser = argparse.ArgumentParser(
+        add_help=False,
+        description="Output format arguments"
+    )
+
+    output_parser.add_argument(
+        "--output",
+        choices=["table", "json", "ndjson", "csv"],
+        default="table",
+        help="Output format. ndjson and csv are streamed, one row at a "
+             "time, as results are retrieved. Default: table"
+    )
+
     # list
     list_parser = subparsers.add_parser(
         "list",
-        parents=[common_parser],
+        parents=[common_parser, output_parser],
         help="List VMware objects on your VMware server"
     )
 
@@ -65,26 +181,28 @@ def arg_setup():
         help="Object type, e.g. Network, VirtualMachine."
     )
 
+    list_parser.add_argument(
+        "--properties",
+        required=False,
+        default="",
+        type=str,
+        help="Comma separated property paths to fetch for every object, "
+             "e.g. runtime.host,config.annotation,guest.guestFullName"
+    )
+
     list_snapshot_parser = subparsers.add_parser(
         "listSnapshots",
+        parents=[output_parser],
         help="List snapshots for a VM"
     )
-    list_snapshot_parser.add_argument(
-        "--vm",
-        required=True,
-        help="VM name (case-sensitive)"
-    )
+    add_vm_selector(list_snapshot_parser, "--vm")
 
     create_snapshot_parser = subparsers.add_parser(
         "createSnapshot",
         parents=[common_parser],
         help="Create snapshot for a VM"
     )
-    create_snapshot_parser.add_argument(
-        "--vm",
-        required=True,
-        help="VM name (case-sensitive)"
-    )
+    add_vm_selector(create_snapshot_parser, "--vm")
     create_snapshot_parser.add_argument(
         "--name",
         required=True,
@@ -115,11 +233,7 @@ def arg_setup():
         parents=[common_parser],
         help="Remove snapshot for a VM"
     )
-    remove_snapshot_parser.add_argument(
-        "--vm",
-        required=True,
-        help="VM name (case-sensitive)"
-    )
+    add_vm_selector(remove_snapshot_parser, "--vm")
     remove_snapshot_parser.add_argument(
         "--name",
         required=True,
@@ -146,11 +260,7 @@ def arg_setup():
         parents=[common_parser],
         help="Revert snapshot for a VM"
     )
-    revert_snapshot_parser.add_argument(
-        "--vm",
-        required=True,
-        help="VM name (case-sensitive)"
-    )
+    add_vm_selector(revert_snapshot_parser, "--vm")
     revert_snapshot_parser.add_argument(
         "--name",
         required=True,
@@ -176,7 +286,7 @@ def arg_setup():
     # clone
     clone_parser = subparsers.add_parser(
         "clone",
-        parents=[common_parser],
+        parents=[common_parser, ready_parser],
         help="Clone a VM template to a new VM"
     )
     clone_parser.add_argument(
@@ -207,10 +317,20 @@ def arg_setup():
     clone_parser.add_argument(
         "--ips",
         type=str,
+        default=[],
         help="Static IPs of new host, separated by a space. "
              "List primary IP first.",
         nargs="+",
     )
+    clone_parser.add_argument(
+        "--auto-ip",
+        type=str,
+        default=[],
+        metavar="NETWORK",
+        help="Networks (CIDRs or network names from config.yml) to "
+             "allocate the next free IP in, after any --ips",
+        nargs="+",
+    )
     clone_parser.add_argument(
         "--cpus",
         type=int,
@@ -267,16 +387,62 @@ def arg_setup():
              "provisioning steps."
     )
 
+    # plan
+    plan_parser = subparsers.add_parser(
+        "plan",
+        parents=[common_parser],
+        help="Resolve and validate a batch of clones, writing a plan file "
+             "for apply"
+    )
+    plan_parser.add_argument(
+        "--batch",
+        required=True,
+        type=str,
+        help="YAML file with a list of clones, each taking the clone "
+             "options, e.g. - {hostname: web01, ips: [10.0.0.5]}"
+    )
+    plan_parser.add_argument(
+        "--plan-file",
+        required=True,
+        type=str,
+        help="Plan file to write"
+    )
+
+    # apply
+    apply_parser = subparsers.add_parser(
+        "apply",
+        parents=[common_parser, ready_parser],
+        help="Submit the clones of a plan file"
+    )
+    apply_parser.add_argument(
+        "--plan-file",
+        required=True,
+        type=str,
+        help="Plan file written by plan"
+    )
+    apply_parser.add_argument(
+        "--concurrency",
+        required=False,
+        default=0,
+        type=int,
+        help="Maximum number of clone tasks running at once. "
+             "Default: the scheduler's max_inflight"
+    )
+
     # destroy
     destroy_parser = subparsers.add_parser(
         "destroy",
         parents=[common_parser],
         help="Destroy/delete a Virtual Machine"
     )
+    add_vm_set_selector(destroy_parser, "destroyed")
     destroy_parser.add_argument(
-        "--name",
-        required=True,
-        help="VM name (case-sensitive)"
+        "--concurrency",
+        required=False,
+        default=0,
+        type=int,
+        help="Maximum number of PowerOff/Destroy tasks running at once. "
+             "Default: the scheduler's max_inflight"
     )
     destroy_parser.add_argument(
         "--silent",
@@ -285,17 +451,310 @@ def arg_setup():
         action="store_true"
     )
 
-    # status
-    status_parser = subparsers.add_parser(
-        "status",
+    # reconfigure
+    reconfigure_parser = subparsers.add_parser(
+        "reconfigure",
+        parents=[common_parser, output_parser],
+        help="Change the configuration of many VMs, skipping those that "
+             "already comply"
+    )
+    add_vm_set_selector(reconfigure_parser, "reconfigured")
+    reconfigure_parser.add_argument(
+        "--spec",
+        required=False,
+        default="",
+        type=str,
+        help="YAML file mapping ConfigSpec property paths to values, e.g. "
+             "cpuHotAddEnabled: true"
+    )
+    reconfigure_parser.add_argument(
+        "--change",
+        required=False,
+        default=[],
+        nargs="+",
+        help="ConfigSpec changes as path=value, e.g. memoryHotAddEnabled=true "
+             "tools.toolsUpgradePolicy=upgradeAtPowerCycle "
+             "extraConfig.disk.EnableUUID=TRUE"
+    )
+    reconfigure_parser.add_argument(
+        "--dry-run",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Only show the changes each VM needs"
+    )
+    reconfigure_parser.add_argument(
+        "--concurrency",
+        required=False,
+        default=0,
+        type=int,
+        help="Maximum number of reconfigure tasks running at once. "
+             "Default: the scheduler's max_inflight"
+    )
+
+    # rolling
+    rolling_parser = subparsers.add_parser(
+        "rolling",
+        parents=[common_parser, ready_parser],
+        help="Shut down, power on, restart or revert VMs in waves, each "
+             "wave waiting for its guests to be ready"
+    )
+    add_vm_set_selector(rolling_parser, "included")
+    rolling_parser.add_argument(
+        "--action",
+        required=True,
+        choices=["shutdown", "powerOn", "restart", "revert"],
+        help="What to do to each wave of VMs. restart is a guest shutdown "
+             "followed by a power on; revert also powers on VMs the "
+             "snapshot left off"
+    )
+    rolling_parser.add_argument(
+        "--snapshot",
+        required=False,
+        default="",
+        type=str,
+        help="Name of the snapshot to revert to"
+    )
+    rolling_parser.add_argument(
+        "--wave-size",
+        required=False,
+        default=0,
+        type=int,
+        help="Maximum number of VMs per wave"
+    )
+    rolling_parser.add_argument(
+        "--wave-percent",
+        required=False,
+        default=0,
+        type=int,
+        help="Maximum percentage of the selected VMs per wave"
+    )
+    rolling_parser.add_argument(
+        "--group-by",
+        required=False,
+        default="",
+        choices=["host", "cluster"],
+        help="One wave per host or cluster, split further by --wave-size "
+             "or --wave-percent"
+    )
+    rolling_parser.add_argument(
+        "--max-failures",
+        required=False,
+        default=0,
+        type=int,
+        help="Abort once more than this many VMs have failed. Default: 0"
+    )
+    rolling_parser.add_argument(
+        "--shutdown-timeout",
+        required=False,
+        default=600,
+        type=int,
+        help="Seconds to wait for guest shutdowns before powering off. "
+             "Default: 600"
+    )
+    rolling_parser.add_argument(
+        "--dry-run",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Only show the waves"
+    )
+    rolling_parser.add_argument(
+        "--silent",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Don't ask for confirmation"
+    )
+
+    # guestexec
+    guestexec_parser = subparsers.add_parser(
+        "guestexec",
+        parents=[common_parser, output_parser],
+        help="Run a command in many guests at once through VMware Tools"
+    )
+    add_vm_set_selector(guestexec_parser, "run the command in")
+    guestexec_parser.add_argument(
+        "--command",
+        required=True,
+        type=str,
+        help="Command line to run, through /bin/sh -c (cmd.exe /c in "
+             "Windows guests)"
+    )
+    guestexec_parser.add_argument(
+        "--guest-user",
+        required=False,
+        default="",
+        type=str,
+        help="Guest user to run the command as. Default: guest_username "
+             "from config.yml; the password is guest_password from "
+             "config.yml or prompted for"
+    )
+    guestexec_parser.add_argument(
+        "--timeout",
+        required=False,
+        default=600,
+        type=int,
+        help="Seconds after which the command is killed. Default: 600"
+    )
+    guestexec_parser.add_argument(
+        "--concurrency",
+        required=False,
+        default=16,
+        type=int,
+        help="Number of guests to call at once. Default: 16"
+    )
+    guestexec_parser.add_argument(
+        "--no-output",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Don't collect the command's output, only its exit code"
+    )
+
+    # upload, download
+    for mode, direction in (("upload", "to"), ("download", "from")):
+        transfer_parser = subparsers.add_parser(
+            mode,
+            parents=[common_parser],
+            help="%s files %s a datastore or, with --vm, a guest"
+                 % (mode.capitalize(), direction)
+        )
+        transfer_parser.add_argument(
+            "--source",
+            required=True,
+            nargs="+",
+            help="Local files" if mode == "upload" else
+                 "Datastore paths like '[datastore1] iso/centos.iso', or "
+                 "guest paths with --vm"
+        )
+        transfer_parser.add_argument(
+            "--destination",
+            required=mode == "upload",
+            default=".",
+            type=str,
+            help="Datastore path like '[datastore1] iso/', or guest path "
+                 "with --vm. End it with / to upload into a directory"
+                 if mode == "upload" else
+                 "Local file or directory. Default: current directory"
+        )
+        transfer_parser.add_argument(
+            "--vm",
+            required=False,
+            default="",
+            type=str,
+            help="VM whose guest to transfer files %s, through VMware "
+                 "Tools" % direction
+        )
+        transfer_parser.add_argument(
+            "--guest-user",
+            required=False,
+            default="",
+            type=str,
+            help="Guest user with --vm. Default: guest_username from "
+                 "config.yml"
+        )
+        transfer_parser.add_argument(
+            "--concurrency",
+            required=False,
+            default=4,
+            type=int,
+            help="Number of files to transfer at once. Default: 4"
+        )
+        if mode == "upload":
+            transfer_parser.add_argument(
+                "--overwrite",
+                required=False,
+                default=False,
+                action="store_true",
+                help="Upload files even if a file of the same size is on "
+                     "the datastore; replace existing guest files"
+            )
+
+    # deploy-ova
+    deploy_ova_parser = subparsers.add_parser(
+        "deploy-ova",
         parents=[common_parser],
-        help="Get a Virtual Machine's power status"
+        help="Deploy a VM or vApp from an OVA or OVF package"
     )
-    status_parser.add_argument(
+    deploy_ova_parser.add_argument(
+        "--ova",
+        required=True,
+        type=str,
+        help="Path of the .ova archive, or of an .ovf descriptor next to "
+             "its disks"
+    )
+    deploy_ova_parser.add_argument(
         "--name",
         required=True,
-        help="VM name (case-sensitive)"
+        type=str,
+        help="Name of the new VM or vApp"
     )
+    deploy_ova_parser.add_argument(
+        "--datastore",
+        required=True,
+        type=str,
+        help="Name of the datastore"
+    )
+    deploy_ova_parser.add_argument(
+        "--cluster",
+        required=False,
+        default="",
+        type=str,
+        help="Cluster to deploy to, or give --host"
+    )
+    deploy_ova_parser.add_argument(
+        "--host",
+        required=False,
+        default="",
+        type=str,
+        help="Host to deploy to"
+    )
+    deploy_ova_parser.add_argument(
+        "--resource-pool",
+        required=False,
+        default="",
+        type=str,
+        help="Resource Pool of the cluster or host, e.g. 'Linux Servers'"
+    )
+    deploy_ova_parser.add_argument(
+        "--destination-folder",
+        required=False,
+        default="",
+        type=str,
+        help="Inventory path of the destination folder. Default: the "
+             "datacenter's VM folder"
+    )
+    deploy_ova_parser.add_argument(
+        "--network",
+        required=False,
+        default=[],
+        nargs="+",
+        help="Networks to connect the package's networks to, as "
+             "ovf_network=network, or just network for all of them"
+    )
+    deploy_ova_parser.add_argument(
+        "--disk-provisioning",
+        required=False,
+        default="thin",
+        choices=["thin", "thick", "eagerZeroedThick"],
+        help="Disk provisioning. Default: thin"
+    )
+    deploy_ova_parser.add_argument(
+        "--concurrency",
+        required=False,
+        default=4,
+        type=int,
+        help="Number of disks to upload at once. Default: 4"
+    )
+
+    # status
+    status_parser = subparsers.add_parser(
+        "status",
+        parents=[common_parser, output_parser],
+        help="Get a Virtual Machine's power status"
+    )
+    add_vm_selector(status_parser)
     status_parser.add_argument(
         "--extra",
         required=False,
@@ -319,11 +778,7 @@ def arg_setup():
         help="Shutdown a Virtual Machine "
              "(will fall back to powerOff if guest tools are not running)"
     )
-    shutdown_parser.add_argument(
-        "--name",
-        required=True,
-        help="VM name (case-sensitive)"
-    )
+    add_vm_selector(shutdown_parser)
 
     # powerOff
     powerOff_parser = subparsers.add_parser(
@@ -331,23 +786,15 @@ def arg_setup():
         parents=[common_parser],
         help="Power Off a Virtual Machine (not a clean shutdown)"
     )
-    powerOff_parser.add_argument(
-        "--name",
-        required=True,
-        help="VM name (case-sensitive)"
-    )
+    add_vm_selector(powerOff_parser)
 
     # powerOn
     powerOn_parser = subparsers.add_parser(
         "powerOn",
-        parents=[common_parser],
+        parents=[common_parser, ready_parser],
         help="Power On a Virtual Machine"
     )
-    powerOn_parser.add_argument(
-        "--name",
-        required=True,
-        help="VM name (case-sensitive)"
-    )
+    add_vm_selector(powerOn_parser)
 
     # syncTimeWithHost
     syncTimeWithHost_parser = subparsers.add_parser(
@@ -355,10 +802,273 @@ def arg_setup():
         parents=[common_parser],
         help="Virtual Machine syncs time with host"
     )
-    syncTimeWithHost_parser.add_argument(
+    add_vm_selector(syncTimeWithHost_parser)
+    add_boolean_argument(syncTimeWithHost_parser, "value", default=True)
+
+    # watch
+    watch_parser = subparsers.add_parser(
+        "watch",
+        parents=[common_parser],
+        help="Stream inventory changes as NDJSON events"
+    )
+    watch_parser.add_argument(
+        "--type",
+        required=False,
+        default=["VirtualMachine"],
+        nargs="+",
+        help="Object types to watch, e.g. VirtualMachine HostSystem. "
+             "Default: VirtualMachine"
+    )
+    watch_parser.add_argument(
+        "--properties",
+        required=False,
+        default="",
+        type=str,
+        help="Comma separated property paths to watch on every type. "
+             "Default: name,runtime.powerState,runtime.host for "
+             "VirtualMachine, name for other types"
+    )
+    watch_parser.add_argument(
+        "--max-wait",
+        required=False,
+        default=60,
+        type=int,
+        help="Seconds each server-side wait for updates may block before "
+             "the connection is checked. Default: 60"
+    )
+
+    # exporter
+    exporter_parser = subparsers.add_parser(
+        "exporter",
+        parents=[common_parser],
+        help="Serve inventory metrics for Prometheus on /metrics"
+    )
+    exporter_parser.add_argument(
+        "--listen-address",
+        required=False,
+        default="127.0.0.1",
+        type=str,
+        help="Address to serve metrics on. Default: 127.0.0.1"
+    )
+    exporter_parser.add_argument(
+        "--listen-port",
+        required=False,
+        default=9272,
+        type=int,
+        help="Port to serve metrics on. Default: 9272"
+    )
+
+    # perf
+    perf_parser = subparsers.add_parser(
+        "perf",
+        parents=[common_parser, output_parser],
+        help="Query performance counters for many VMs or hosts"
+    )
+    perf_parser.add_argument(
+        "--type",
+        required=False,
+        default="VirtualMachine",
+        choices=["VirtualMachine", "HostSystem"],
+        help="Entity type. Default: VirtualMachine"
+    )
+    perf_parser.add_argument(
+        "--names",
+        required=False,
+        default=[],
+        nargs="+",
+        help="Entity names (case-sensitive). Default: all entities of --type"
+    )
+    perf_parser.add_argument(
+        "--counters",
+        required=False,
+        default="cpu.usage.average,mem.usage.average,disk.usage.average,"
+                "net.usage.average",
+        type=str,
+        help="Comma separated counters as group.name.rollup. "
+             "Default: cpu.usage.average,mem.usage.average,"
+             "disk.usage.average,net.usage.average"
+    )
+    perf_parser.add_argument(
+        "--all-instances",
+        required=False,
+        action="store_true",
+        default=False,
+        help="Return per-instance values (per CPU, disk, NIC...) as well as "
+             "the aggregate"
+    )
+    perf_parser.add_argument(
+        "--interval",
+        required=False,
+        default=20,
+        type=int,
+        help="Sampling interval in seconds, 20 for real-time stats or a "
+             "historical interval such as 300. Default: 20"
+    )
+    perf_parser.add_argument(
+        "--max-sample",
+        required=False,
+        default=1,
+        type=int,
+        help="Number of most recent samples per counter. Default: 1"
+    )
+    perf_parser.add_argument(
+        "--batch-size",
+        required=False,
+        default=100,
+        type=int,
+        help="Entities per QueryPerf call. Default: 100"
+    )
+
+    # inventory
+    inventory_parser = subparsers.add_parser(
+        "inventory",
+        help="Dump the inventory to a local sqlite file and query it offline"
+    )
+    inventory_subparsers = inventory_parser.add_subparsers(
+        help="Inventory command",
+        dest="inventory_mode"
+    )
+    inventory_subparsers.required = True
+
+    inventory_dump_parser = inventory_subparsers.add_parser(
+        "dump",
+        parents=[common_parser],
+        help="Export VMs, hosts, clusters, datastores, networks and their "
+             "relations to a sqlite file"
+    )
+    inventory_dump_parser.add_argument(
+        "--db",
+        required=False,
+        default="",
+        type=str,
+        help="Inventory database file. "
+             "Default: ~/.config/ezmomi/inventory.db"
+    )
+
+    inventory_query_parser = inventory_subparsers.add_parser(
+        "query",
+        parents=[output_parser],
+        help="Query an inventory dump without connecting to vSphere"
+    )
+    inventory_query_parser.add_argument(
+        "--db",
+        required=False,
+        default="",
+        type=str,
+        help="Inventory database file. "
+             "Default: ~/.config/ezmomi/inventory.db"
+    )
+    inventory_query_parser.add_argument(
         "--name",
-        required=True,
-        help="VM name (case-sensitive)"
+        required=False,
+        default="",
+        type=str,
+        help="VM name glob, e.g. 'web*'"
     )
-    add_boolean_argument(syncTimeWithHost_parser, "value", default=True)
-    return main_parser.parse_args()
+    inventory_query_parser.add_argument(
+        "--power-state",
+        required=False,
+        default="",
+        choices=["", "poweredOn", "poweredOff", "suspended"],
+        help="VM power state"
+    )
+    inventory_query_parser.add_argument(
+        "--host",
+        required=False,
+        default="",
+        type=str,
+        help="Name of the host the VM runs on"
+    )
+    inventory_query_parser.add_argument(
+        "--cluster",
+        required=False,
+        default="",
+        type=str,
+        help="Name of the cluster the VM runs in"
+    )
+    inventory_query_parser.add_argument(
+        "--datastore",
+        required=False,
+        default="",
+        type=str,
+        help="Name of a datastore the VM uses"
+    )
+    inventory_query_parser.add_argument(
+        "--network",
+        required=False,
+        default="",
+        type=str,
+        help="Name of a network the VM is connected to"
+    )
+    inventory_query_parser.add_argument(
+        "--sql",
+        required=False,
+        default="",
+        type=str,
+        help="Raw SQL to run instead of the VM filters. Tables: vm, host, "
+             "cluster, datastore, network, vm_datastore, vm_network, meta"
+    )
+
+    # stats
+    stats_parser = subparsers.add_parser(
+        "stats",
+        parents=[output_parser],
+        help="Task latency percentiles from the local task journal"
+    )
+    stats_parser.add_argument(
+        "--db",
+        required=False,
+        default="",
+        type=str,
+        help="Path of the task journal. Default: journal_db from "
+             "config.yml, or ~/.config/ezmomi/journal.db"
+    )
+    stats_parser.add_argument(
+        "--group-by",
+        required=False,
+        default=["operation"],
+        nargs="+",
+        choices=["operation", "host", "datastore", "target", "outcome",
+                 "server"],
+        help="Columns to group tasks by. Default: operation"
+    )
+    stats_parser.add_argument(
+        "--operation",
+        required=False,
+        default="",
+        type=str,
+        help="Only count tasks of this operation, e.g. VirtualMachine.clone"
+    )
+    stats_parser.add_argument(
+        "--days",
+        required=False,
+        default=0,
+        type=int,
+        help="Only count tasks of the last days"
+    )
+
+    # shell
+    subparsers.add_parser(
+        "shell",
+        parents=[common_parser],
+        help="Run commands interactively over a single session, with tab "
+             "completion of VM, host and datastore names"
+    )
+
+    # completion
+    completion_parser = subparsers.add_parser(
+        "completion",
+        parents=[common_parser],
+        help="Print the bash completion script, enable it with "
+             "eval \"$(ezmomi completion)\""
+    )
+    completion_parser.add_argument(
+        "--refresh",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Fetch the object names completed from vSphere now, instead "
+             "of printing the script"
+    )
+
+    return main_parser
@@ -0,0 +1,77 @@
+"""Bookkeeping of template replicas kept on clone target datastores"""
+import json
+import os
+import sqlite3
+import time
+
+# replicas are marked by a JSON annotation holding this key
+MARKER = 'ezmomi_replica_of'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS replica_use (
+    server TEXT,
+    moid TEXT,
+    used REAL,
+    PRIMARY KEY (server, moid)
+);
+"""
+
+
+def default_path():
+    return "%s/.config/ezmomi/replicas.db" % os.path.expanduser("~")
+
+
+def annotation(template, version):
+    """Annotation of a replica of template (a MOID) at version"""
+    return json.dumps({MARKER: template, 'version': version,
+                       'created': time.time()}, sort_keys=True)
+
+
+def parse_annotation(text):
+    """The replica annotation dict in text, None for other VMs"""
+    if not text or MARKER not in text:
+        return None
+    try:
+        replica = json.loads(text)
+    except ValueError:
+        return None
+    return replica if isinstance(replica, dict) else None
+
+
+def connect(path):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    db = sqlite3.connect(path, timeout=30)
+    db.executescript(SCHEMA)
+    return db
+
+
+def touch(path, server, moid):
+    """Record that the replica moid was cloned from just now"""
+    db = connect(path)
+    try:
+        db.execute("INSERT OR REPLACE INTO replica_use VALUES (?, ?, ?)",
+                   (server, moid, time.time()))
+        db.commit()
+    finally:
+        db.close()
+
+
+def least_recently_used(path, server, replicas):
+    """
+    replicas, a list of (moid, annotation dict), least recently used
+    first.  Replicas never cloned from here count as used when created.
+    """
+    used = dict()
+    if os.path.isfile(path):
+        db = connect(path)
+        try:
+            used = dict(db.execute(
+                "SELECT moid, used FROM replica_use WHERE server = ?",
+                (server,)))
+        finally:
+            db.close()
+    return sorted(replicas, key=lambda replica: used.get(
+        replica[0], replica[1].get('created', 0)))
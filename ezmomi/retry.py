@@ -0,0 +1,150 @@
+"""Retries with exponential backoff for transient vSphere errors"""
+import random
+import socket
+import threading
+import time
+
+from pyVmomi import vim, vmodl
+from six.moves import http_client
+
+# the request may or may not have reached vCenter
+CONNECTION_ERRORS = (socket.error, http_client.HTTPException)
+
+# vCenter could not reach a host or service in time
+TRANSIENT_FAULTS = (
+    vmodl.fault.HostCommunication,
+    vim.fault.HostConnectFault,
+)
+
+# methods that only read state, safe to repeat whatever happened to the
+# first attempt
+IDEMPOTENT_PREFIXES = (
+    'Retrieve',
+    'ContinueRetrieve',
+    'CancelRetrieve',
+    'WaitForUpdates',
+    'CheckForUpdates',
+    'Find',
+    'Query',
+    'CurrentTime',
+    'ListProcessesInGuest',
+)
+
+# never retried through the stub, relogin() calls these itself
+SESSION_METHODS = ('Login', 'LoginByToken', 'Logout')
+
+DEFAULTS = {
+    'max_attempts': 5,
+    'base_delay': 1,    # seconds
+    'max_delay': 30,    # seconds
+}
+
+
+class Retrier(object):
+    """
+    Retries vSphere calls that fail transiently:
+
+     - NotAuthenticated (session expired): log in again and repeat the
+       call.  The server rejected the call, so this is safe for any method.
+     - connection errors and transient faults: repeat read-only calls
+       (see IDEMPOTENT_PREFIXES) after an exponential backoff with full
+       jitter.  Anything else, e.g. task submissions, may already have
+       been executed, so is not resubmitted blindly and the error is
+       raised.
+
+    Busy faults from task submission are left to the task scheduler, which
+    paces resubmission for all tasks together.
+
+    Counts are kept in stats for instrumentation.
+    """
+
+    def __init__(self, login, max_attempts=None, base_delay=None,
+                 max_delay=None, debug=False):
+        settings = dict(DEFAULTS)
+        settings.update((key, value) for key, value in dict(
+            max_attempts=max_attempts, base_delay=base_delay,
+            max_delay=max_delay,
+        ).items() if value is not None)
+
+        self.login = login
+        self.max_attempts = settings['max_attempts']
+        self.base_delay = settings['base_delay']
+        self.max_delay = settings['max_delay']
+        self.debug = debug
+
+        self.stats = {
+            'retries_total': 0,
+            'relogins_total': 0,
+            'retries_exhausted_total': 0,
+        }
+        self._login_lock = threading.Lock()
+        self._session = 0
+
+    @property
+    def session(self):
+        """
+        Number of logins since the first.  Views, collectors and filters
+        created before it last changed went with the old session.
+        """
+        return self._session
+
+    def delay(self, attempt):
+        """Backoff before retry number attempt (0-based), with full jitter"""
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def relogin(self, session):
+        """
+        Log in again, unless another thread already did since session
+        (the value of self._session when the failed call started)
+        """
+        with self._login_lock:
+            if self._session == session:
+                self.login()
+                self._session += 1
+                self.stats['relogins_total'] += 1
+
+    def call(self, func, idempotent=True, description=''):
+        """Call func(), retrying transient failures"""
+        attempt = 0
+        while True:
+            session = self._session
+            try:
+                return func()
+            except vim.fault.NotAuthenticated:
+                if attempt + 1 >= self.max_attempts:
+                    self.stats['retries_exhausted_total'] += 1
+                    raise
+                if self.debug:
+                    print("DEBUG: %s: session expired, logging in again"
+                          % description)
+                self.relogin(session)
+            except CONNECTION_ERRORS + TRANSIENT_FAULTS as e:
+                if not idempotent:
+                    raise
+                if attempt + 1 >= self.max_attempts:
+                    self.stats['retries_exhausted_total'] += 1
+                    raise
+                delay = self.delay(attempt)
+                if self.debug:
+                    print("DEBUG: %s failed (%s), retrying in %.1fs"
+                          % (description, e, delay))
+                time.sleep(delay)
+
+            attempt += 1
+            self.stats['retries_total'] += 1
+
+    def install(self, stub):
+        """Route every method call made through a pyVmomi stub via call()"""
+        invoke_method = stub.InvokeMethod
+
+        def InvokeMethod(mo, info, args, *extra):
+            if info.wsdlName in SESSION_METHODS:
+                return invoke_method(mo, info, args, *extra)
+
+            return self.call(
+                lambda: invoke_method(mo, info, args, *extra),
+                idempotent=info.wsdlName.startswith(IDEMPOTENT_PREFIXES),
+                description=info.wsdlName)
+
+        stub.InvokeMethod = InvokeMethod
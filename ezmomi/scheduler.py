@@ -0,0 +1,152 @@
+"""Pacing of vCenter task submission"""
+import time
+
+from pyVmomi import vim
+
+# task faults meaning "vCenter or the host is busy, try again later"
+BUSY_FAULTS = (
+    vim.fault.TooManyConcurrentNativeClones,
+    vim.fault.TaskInProgress,
+    vim.fault.ResourceInUse,
+    vim.fault.ConcurrentAccess,
+)
+
+DEFAULTS = {
+    'rate': 10.0,               # task submissions per second
+    'burst': 10,                # submissions allowed at once after idling
+    'max_inflight': 32,         # tasks running at once
+    'max_per_host': 8,          # tasks running at once per host
+    'max_per_datastore': 32,    # tasks running at once per datastore
+    'max_attempts': 5,          # submissions per job, for busy faults
+    'max_backoff': 60,          # seconds
+}
+
+
+class Job(object):
+    """
+    A unit of work for EZMomi.run_tasks.
+
+    submit is called without arguments to create the vim.Task, when the
+    scheduler allows it; the task is then available as job.task.  host
+    and datastores are managed objects (or moids) used for the per-host
+    and per-datastore caps.  on_done, if set, is called with the finished
+    task and may return follow-up Jobs.
+    """
+
+    def __init__(self, submit, description='', host=None, datastores=(),
+                 on_done=None):
+        self.submit = submit
+        self.description = description
+        self.host = getattr(host, '_moId', host)
+        self.datastores = [getattr(ds, '_moId', ds) for ds in datastores]
+        self.on_done = on_done
+        self.attempts = 0
+        self.task = None
+
+
+class TaskScheduler(object):
+    """
+    Decides when the next Job may be submitted:
+
+     - a token bucket limits the submission rate,
+     - running tasks are capped overall, per host and per datastore,
+     - the overall cap adapts: it is halved and submissions pause (with
+       exponential back-off) when tasks queue up in vCenter or fail with
+       busy faults, and grows back by one every cap successes.
+    """
+
+    def __init__(self, rate=None, burst=None, max_inflight=None,
+                 max_per_host=None, max_per_datastore=None,
+                 max_attempts=None, max_backoff=None, clock=time.time):
+        settings = dict(DEFAULTS)
+        settings.update((key, value) for key, value in dict(
+            rate=rate, burst=burst, max_inflight=max_inflight,
+            max_per_host=max_per_host, max_per_datastore=max_per_datastore,
+            max_attempts=max_attempts, max_backoff=max_backoff,
+        ).items() if value is not None)
+
+        self.rate = float(settings['rate'])
+        self.burst = float(settings['burst'])
+        self.max_inflight = settings['max_inflight']
+        self.max_per_host = settings['max_per_host']
+        self.max_per_datastore = settings['max_per_datastore']
+        self.max_attempts = settings['max_attempts']
+        self.max_backoff = settings['max_backoff']
+        self.clock = clock
+
+        self.limit = float(self.max_inflight)
+        self.tokens = self.burst
+        self.refilled = clock()
+        self.paused_until = 0
+        self.backoff = 1
+
+        self.inflight = 0
+        self.per_host = dict()
+        self.per_datastore = dict()
+
+    def set_max_inflight(self, max_inflight):
+        self.max_inflight = max_inflight
+        self.limit = min(self.limit, float(max_inflight))
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+    def can_submit(self):
+        """Whether the rate limit and overall cap allow a submission now"""
+        self._refill()
+        return self.clock() >= self.paused_until and self.tokens >= 1 and \
+            self.inflight < int(self.limit)
+
+    def fits(self, job):
+        """Whether job's host and datastores are below their caps"""
+        if job.host and \
+                self.per_host.get(job.host, 0) >= self.max_per_host:
+            return False
+        for ds in job.datastores:
+            if self.per_datastore.get(ds, 0) >= self.max_per_datastore:
+                return False
+        return True
+
+    def delay(self):
+        """Seconds until a token is available and any pause is over"""
+        self._refill()
+        return max(0, self.paused_until - self.clock(),
+                   (1 - self.tokens) / self.rate)
+
+    def started(self, job):
+        self.tokens -= 1
+        job.attempts += 1
+        self.inflight += 1
+        if job.host:
+            self.per_host[job.host] = self.per_host.get(job.host, 0) + 1
+        for ds in job.datastores:
+            self.per_datastore[ds] = self.per_datastore.get(ds, 0) + 1
+
+    def finished(self, job, success=True):
+        self.inflight -= 1
+        if job.host:
+            self.per_host[job.host] -= 1
+        for ds in job.datastores:
+            self.per_datastore[ds] -= 1
+
+        if success:
+            # additive increase: one more slot per limit successes
+            self.limit = min(self.max_inflight, self.limit + 1 / self.limit)
+            self.backoff = 1
+
+    def congested(self):
+        """
+        vCenter is queueing our tasks or rejecting them as busy: halve the
+        concurrency limit and pause submissions
+        """
+        self.limit = max(1.0, self.limit / 2)
+        self.paused_until = self.clock() + self.backoff
+        self.backoff = min(self.max_backoff, self.backoff * 2)
+
+    def retryable(self, job, fault):
+        """Whether a failed job should be submitted again"""
+        return isinstance(fault, BUSY_FAULTS) and \
+            job.attempts < self.max_attempts
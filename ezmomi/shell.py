@@ -0,0 +1,159 @@
+"""Interactive ezmomi shell over a single vSphere session"""
+from __future__ import print_function
+import cmd
+import os
+import shlex
+import traceback
+
+from pyVmomi import vim, vmodl
+
+from .complete import object_type
+from .exceptions import EZMomiError
+from .params import build_parser
+from .scheduler import TaskScheduler
+
+try:
+    import readline
+except ImportError:
+    # completion and history are unavailable, e.g. on Windows
+    readline = None
+
+# commands adding or removing VMs, after which VM names are fetched again
+VM_CHANGING_COMMANDS = ('clone', 'apply', 'destroy')
+
+
+class Shell(cmd.Cmd):
+    """
+    Runs ezmomi commands, parsed by the command line's own parser, on one
+    EZMomi instance: its connection, container views and name indexes are
+    kept between commands.
+    """
+    intro = ("ezmomi shell. Run any ezmomi command, e.g. status --name "
+             "web01; 'help' lists them, 'refresh' reloads names, 'exit' "
+             "quits.")
+    history_file = "%s/.config/ezmomi/shell_history" % os.path.expanduser(
+        "~")
+
+    def __init__(self, ez, dispatch):
+        cmd.Cmd.__init__(self)
+        self.ez = ez
+        self.dispatch = dispatch
+        self.parser = build_parser()
+        self.commands = sorted(
+            self.parser._subparsers._group_actions[0].choices)
+        self.config = dict(ez.config)
+        self.prompt = "ezmomi %s> " % self.config['server']
+
+        ez.cache_names = True
+
+    def cmdloop(self, intro=None):
+        if readline:
+            if os.path.isfile(self.history_file):
+                readline.read_history_file(self.history_file)
+            # VM names often contain dashes and dots
+            readline.set_completer_delims(' \t\n')
+
+        try:
+            cmd.Cmd.cmdloop(self, intro)
+        finally:
+            if readline and os.path.isdir(os.path.dirname(self.history_file)):
+                readline.write_history_file(self.history_file)
+
+    def emptyline(self):
+        pass
+
+    def do_exit(self, line):
+        """Leave the shell"""
+        return True
+
+    do_quit = do_exit
+
+    def do_EOF(self, line):
+        print()
+        return True
+
+    def do_refresh(self, line):
+        """Fetch VM, host and datastore names again"""
+        self.ez.forget_names()
+
+    def do_help(self, line):
+        """List commands, or show a command's options"""
+        if line.strip():
+            self.default("%s --help" % line)
+        else:
+            self.parser.print_help()
+            print("\nShell commands: refresh, exit")
+
+    def default(self, line):
+        try:
+            args = self.parser.parse_args(shlex.split(line))
+        except SystemExit:
+            # argparse printed the usage error, or --help
+            return
+        except ValueError as e:
+            # e.g. unbalanced quotes
+            print("Error: %s" % e)
+            return
+
+        if args.mode == 'shell':
+            print("Error: already in the shell")
+            return
+        if getattr(args, 'server', None) not in \
+                (None, self.config['server']):
+            print("Error: this shell is connected to %s"
+                  % self.config['server'])
+            return
+
+        ez = self.ez
+        try:
+            ez.config = ez.get_configs(vars(args), self.config)
+            ez.debug = ez.config['debug']
+            # settings such as --concurrency apply to one command
+            ez.scheduler = TaskScheduler(**ez.config.get('scheduler') or {})
+            self.dispatch(ez, vars(args))
+        except (EZMomiError, vmodl.MethodFault) as e:
+            print("Error: %s" % (getattr(e, 'msg', None) or e))
+        except Exception as e:
+            # e.g. a dropped connection: keep the shell and its session
+            if ez.debug:
+                traceback.print_exc()
+            print("Error: %s" % e)
+        except KeyboardInterrupt:
+            print("Interrupted")
+        finally:
+            if args.mode in VM_CHANGING_COMMANDS:
+                ez.forget_names(vim.VirtualMachine)
+
+    def completenames(self, text, *ignored):
+        return [name for name in self.commands + ['exit', 'refresh']
+                if name.startswith(text)]
+
+    def completedefault(self, text, line, begidx, endidx):
+        try:
+            words = shlex.split(line[:begidx])
+        except ValueError:
+            # inside a quoted value
+            return []
+        if not words or words[0] not in self.commands:
+            return []
+
+        if text.startswith('-'):
+            return self.complete_options(words[0], text)
+
+        # complete the value of the last option given
+        options = [word for word in words[1:] if word.startswith('--')]
+        if not options:
+            return []
+        vimtype = object_type(words[0], options[-1])
+        if vimtype is None:
+            return []
+        try:
+            names = self.ez.name_index(getattr(vim, vimtype))
+        except (EZMomiError, vmodl.MethodFault):
+            return []
+        return sorted(name for name in names if name.startswith(text))
+
+    def complete_options(self, command, text):
+        subparser = self.parser._subparsers._group_actions[0].choices[command]
+        return sorted(option for option in subparser._option_string_actions
+                      if option.startswith(text))
@@ -0,0 +1,124 @@
+"""Streaming HTTP file transfers to and from datastores and guests"""
+import os
+import re
+
+CHUNK_SIZE = 1024 * 1024
+
+# [datastore] path/to/file
+DATASTORE_PATH = re.compile(r'^\[(?P<datastore>[^\]]+)\]\s*(?P<path>.*)$')
+
+
+def parse_datastore_path(path):
+    """(datastore, path) of a '[datastore] path' string, or None"""
+    match = DATASTORE_PATH.match(path)
+    if not match:
+        return None
+    return match.group('datastore'), match.group('path').lstrip('/')
+
+
+def target_path(source, destination, many, separator='/'):
+    """
+    Where source goes: into directory destination when transferring many
+    files or destination ends with a separator, else destination itself.
+    """
+    if many or destination.endswith(separator) or not destination:
+        name = re.split(r'[\\/]', source.rstrip('/\\'))[-1]
+        if destination and not destination.endswith(separator):
+            destination += separator
+        return destination + name
+    return destination
+
+
+def remote_size(session, url, **kwargs):
+    """Size of the file at url from a HEAD request, None if missing"""
+    response = session.head(url, allow_redirects=True, **kwargs)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    length = response.headers.get('Content-Length')
+    return int(length) if length is not None else None
+
+
+def put(session, url, path, **kwargs):
+    """
+    PUT the local file at path to url, see send.  Returns the number of
+    bytes sent.
+    """
+    with open(path, 'rb') as f:
+        return send(session, 'PUT', url, f, os.path.getsize(path),
+                    **kwargs)
+
+
+def send(session, method, url, fileobj, size, on_progress=None, **kwargs):
+    """
+    Send size bytes read from fileobj to url.  The body is streamed with
+    its Content-Length, a block at a time, so memory use does not grow
+    with the file; on_progress(bytes) is called for every block read.
+    Returns size.
+    """
+    headers = dict(kwargs.pop('headers', None) or {})
+    headers['Content-Length'] = str(size)
+    headers.setdefault('Content-Type', 'application/octet-stream')
+    response = session.request(method, url,
+                               data=Reader(fileobj, size, on_progress),
+                               headers=headers, **kwargs)
+    response.raise_for_status()
+    return size
+
+
+class Reader(object):
+    """File object wrapper reporting the bytes read from it"""
+
+    def __init__(self, fileobj, size, on_progress=None):
+        self.fileobj = fileobj
+        self.remaining = size
+        self.on_progress = on_progress
+
+    def __len__(self):
+        # requests sends a Content-Length rather than chunks
+        return self.remaining
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.remaining -= len(data)
+        if self.on_progress and data:
+            self.on_progress(len(data))
+        return data
+
+
+def get(session, url, path, resume=True, **kwargs):
+    """
+    GET url into the local file path, CHUNK_SIZE bytes at a time.  The
+    download is written to path.part and renamed once complete; with
+    resume, an existing path.part is continued with a Range request
+    (restarted if the server ignores the range).  Returns the number of
+    bytes received.
+    """
+    partial = path + '.part'
+    offset = os.path.getsize(partial) \
+        if resume and os.path.isfile(partial) else 0
+
+    headers = dict(kwargs.pop('headers', None) or {})
+    if offset:
+        headers['Range'] = 'bytes=%s-' % offset
+    response = session.get(url, headers=headers, stream=True, **kwargs)
+    try:
+        if response.status_code == 416:
+            # the partial file is already complete
+            received = 0
+        else:
+            response.raise_for_status()
+            if response.status_code != 206:
+                offset = 0
+            received = 0
+            with open(partial, 'ab' if offset else 'wb') as f:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+                    received += len(chunk)
+    finally:
+        response.close()
+
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(partial, path)
+    return received
@@ -0,0 +1,33 @@
+"""Splitting of VM sets into waves for rolling operations"""
+import math
+
+
+def split(items, size=0, percent=0, key=None):
+    """
+    Split items into waves.  With key, items sharing key(item) (e.g. a
+    host) are kept together, one group per wave; size and percent then
+    split groups further.  percent is of all items, so percent=10 gives
+    about ten waves.
+
+    Returns a list of (label, [items]), in a stable order.
+    """
+    items = list(items)
+    if percent:
+        size = max(1, int(math.ceil(len(items) * percent / 100.0)))
+
+    if key:
+        groups = dict()
+        for item in items:
+            groups.setdefault(key(item) or '', []).append(item)
+        grouped = sorted(groups.items())
+    else:
+        grouped = [('', items)]
+
+    waves = list()
+    for label, group in grouped:
+        if not size or len(group) <= size:
+            waves.append((label, group))
+            continue
+        for start in range(0, len(group), size):
+            waves.append((label, group[start:start + size]))
+    return waves